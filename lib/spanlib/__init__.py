@@ -26,4 +26,4 @@ import analyzer
 del docs
 __version__ = "2.3.0"
 
-__all__ = ['Data', 'Dataset', 'Analyzer', 'SVDModel', 'RedNoise', 'Filler',  'freqfilter', 'SpanlibError', 'phase_composites']
+__all__ = ['Data', 'Dataset', 'Analyzer', 'SVDModel', 'RedNoise', 'Filler', 'TiledFiller', 'fill_sweep', 'fill_batch', 'freqfilter', 'SpanlibError', 'phase_composites']
@@ -19,6 +19,7 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
 import gc
+from multiprocessing import Pool, cpu_count
 import numpy as N
 npy = N
 from data import (has_cdat_support, cdms2_isVariable, Data, Dataset,
@@ -29,15 +30,76 @@ if has_cdat_support:
 #from spanlib.util import Logger, broadcast, SpanlibIter, dict_filter
 import _core
 from .util import Logger, broadcast, SpanlibIter, dict_filter
+from .engines import (rsvd_pca, lanczos_pca, lanczos_mssa, trajectory_mssa, get_anomalies,
+    get_valid, get_random_state, stcov, mssa_mcev, CovarianceAccumulator)
 
 docs = dict(
     npca="""- *npca*: int | ``None``
                 Number of PCA modes to keep in analysis (defaults to 10).""",
+    pcasolver="""- *solver*: str | ``None``
+                Eigen solver used to diagonalize the PCA covariance matrix:
+
+                    - ``"auto"`` (default): ``"syevr"`` if ``npca`` is lower than
+                      the number of channels, else ``"syevd"``.
+                    - ``"syev"``: LAPACK standard driver (full spectrum).
+                    - ``"syevr"`` or ``"syevx"``: LAPACK subset drivers that only compute
+                      the leading ``npca`` modes.
+                    - ``"syevd"``: LAPACK divide-and-conquer driver (full spectrum).
+                    - ``"randomized"``: Randomized truncated SVD computed directly
+                      from packed data, without any covariance matrix
+                      (see :func:`~spanlib.engines.rsvd_pca`). It is suited to
+                      cases where both space and time dimensions are very large.
+                      It is configured with ``rsvd_<param>`` keywords
+                      (``rsvd_oversampling``, ``rsvd_niter``,
+                      ``rsvd_chunksize`` and ``rsvd_seed``).
+                    - ``"lanczos"``: Block Lanczos solver applied to the covariance
+                      matrix, that is never formed for gap-free data
+                      (see :func:`~spanlib.engines.lanczos_pca`).
+                      It is configured with ``lanczos_<param>`` keywords
+                      (``lanczos_blocksize``, ``lanczos_nsteps``,
+                      ``lanczos_maxiter``, ``lanczos_tol`` and
+                      ``lanczos_seed``).
+
+                Only the ``"syev"`` solver limits the number of modes
+                to 100.""",
+    evtarget="""- *evtarget*: float | ``None``
+                Stop the PCA at the first mode for which the cumulated
+                explained variance reaches this percentage. ``npca`` is then
+                an upper bound of the number of modes.""",
     prepca="""- *prepca*: int | bool | ``None``
                 Number of pre-PCA modes to keep before MSSA and SVD analyses (defaults to ``npca`` if ``True``).
                 If the number of input channels is greater than 30, it is automatically switch to ``True``.""",
     nmssa="""- *nmssa*: int | ``None``
                 Number of MSSA modes to keep in analysis (defaults to 10).""",
+    mssasolver="""- *solver*: str | ``None``
+                Eigen solver used by MSSA:
+
+                    - ``"syev"`` (default): LAPACK standard driver applied to
+                      the block-Toeplitz covariance matrix.
+                    - ``"auto"``: ``"lanczos"`` if the number of
+                      ST-EOFs (number of channels times window size) is
+                      greater than 1000, else ``"syev"``.
+                    - ``"lanczos"``: Matrix-free block Lanczos solver that
+                      applies the covariance matrix with FFT convolutions of
+                      the lagged covariances, without forming it
+                      (see :func:`~spanlib.engines.lanczos_mssa`).
+                      It is configured with ``lanczos_<param>`` keywords
+                      (``lanczos_blocksize``, ``lanczos_nsteps``,
+                      ``lanczos_maxiter``, ``lanczos_tol`` and
+                      ``lanczos_seed``).
+                    - ``"svd"``: Randomized truncated SVD of the trajectory
+                      matrix, that gives ST-EOFs and ST-PCs at once, without
+                      covariance matrix nor projection for gap-free data
+                      (see :func:`~spanlib.engines.trajectory_mssa`).
+                      Eigenvalues are those of the trajectory covariance matrix.
+                      It is configured with ``rsvd_oversampling``,
+                      ``rsvd_niter`` and ``rsvd_seed``.""",
+    warmstart="""- *warmstart*: bool
+                When results of a previous analysis are available, use the
+                ``"lanczos"`` solver starting from the previous EOFs, whatever
+                the current solver. It speeds up analyses of data that
+                slightly differ from the previous ones, like successive
+                analyses of the :class:`~spanlib.filler.Filler`.""",
     window="""- *window*: int | ``None``
                 Size of the MSSA window parameter (defaults to 1/3 the time length).""",
     nsvd="""- *nsvd*: int | ``None``
@@ -155,7 +217,7 @@ class _BasicAnalyzer_(object):
         if not self._prepca:
             nchan = self.ns
         else:
-            nchan = self._prepca
+            nchan = self.prepca
         channel_axes = getattr(self,'_%s_channel_axes'%name)
         if not self.has_cdat():
             channel_axes = nchan
@@ -220,9 +282,15 @@ class Analyzer(_BasicAnalyzer_, Dataset):
     _nmssa_default = _nsvd_default = 8
     _nmssa_max = 20 #_nsvd_max = 20
     _window_default = 1/3. # Relative to time length
+    _pcasolver_default = 'auto'
+    _pca_solvers = dict(auto=0, syev=1, syevr=2, syevx=3, syevd=4,
+        randomized=None, lanczos=None)
+    _mssasolver_default = 'syev'
+    _mssa_solvers = ['auto', 'syev', 'lanczos', 'svd']
+    _mssa_lanczos_min = 1000 # Min number of ST-EOFs for the auto lanczos solver
     _pca_params = ['npca', 'prepca', 'minecvalid', 'zerofill', 'useteof',
-        'notpc', 'pcapf']
-    _mssa_params = _pca_params+['nmssa', 'prepca', 'window']
+        'notpc', 'pcapf', 'pcasolver', 'pcaevtarget']
+    _mssa_params = _pca_params+['nmssa', 'prepca', 'window', 'mssasolver']
 #    _svd_params = _pca_params+['nsvd']
     _params = dict(pca=_pca_params, mssa=_pca_params+_mssa_params)#, svd=_pca_params+_svd_params)
     _all_params = list(set(_pca_params+_mssa_params))#+_svd_params
@@ -237,6 +305,9 @@ class Analyzer(_BasicAnalyzer_, Dataset):
         Dataset.__init__(self, dataset, weights=weights, norms=norms, zerofill=zerofill,
             minvalid=minvalid, clean_weights=clean_weights, keep_invalids=keep_invalids)
         self._quiet=False
+        self._kwrsvd = dict_filter(kwargs, 'rsvd_')
+        self._kwlanczos = dict_filter(kwargs, 'lanczos_')
+        self._pca_stats = None
 
         # Init results
         self.clean()
@@ -372,6 +443,15 @@ class Analyzer(_BasicAnalyzer_, Dataset):
         if anatype is None: return False
         return getattr(self, '_%s_raw_eof'%anatype) is not None
 
+    def _get_warmstart_(self, anatype, nrow):
+        """Get raw EOFs of a previous analysis as initial vectors of
+        an iterative eigen solver, or ``None`` if not available or
+        if they have not ``nrow`` rows"""
+        raw_eof = getattr(self, '_%s_raw_eof'%anatype, None)
+        if raw_eof is None or raw_eof.ndim!=2 or raw_eof.shape[0]!=nrow:
+            return
+        return raw_eof.copy()
+
     def _has_changed_(self, old, param):
         """Check if a parameter has changed
 
@@ -415,11 +495,31 @@ class Analyzer(_BasicAnalyzer_, Dataset):
         # Initialize old values and defaults changed to False
         if 'win' in kwargs:
             kwargs['window'] = kwargs.pop('win')
+        if anatype is not None:
+            for param in 'solver', 'evtarget':
+                if param in kwargs:
+                    kwargs[anatype+param] = kwargs.pop(param)
         old = {}
         for param in self._all_params:
             old[param] = getattr(self, '_'+param, None)
             setattr(self, '_'+param, kwargs.pop(param, old[param]))
 
+        # PCA eigen solver
+        if self._pcasolver is None:
+            self._pcasolver = SpAn._pcasolver_default
+        self._pcasolver = str(self._pcasolver).lower()
+        if self._pcasolver not in SpAn._pca_solvers:
+            self.error('Invalid PCA solver: %s. Please choose one of: %s'
+                %(self._pcasolver, ', '.join(sorted(SpAn._pca_solvers))))
+
+        # MSSA eigen solver
+        if self._mssasolver is None:
+            self._mssasolver = SpAn._mssasolver_default
+        self._mssasolver = str(self._mssasolver).lower()
+        if self._mssasolver not in SpAn._mssa_solvers:
+            self.error('Invalid MSSA solver: %s. Please choose one of: %s'
+                %(self._mssasolver, ', '.join(SpAn._mssa_solvers)))
+
         # Number of PCA modes
         # - Guess a value
         if self._npca is None:
@@ -431,7 +531,10 @@ class Analyzer(_BasicAnalyzer_, Dataset):
         if self._prepca is not None:
             self._npca = max(self._npca, self._prepca)
         # - max
-        self._npca = npy.clip(self._npca, 1, min(SpAn._npca_max, self.ns, self.nt))
+        npcamax = min(self.ns, self.nt)
+        if self._pcasolver=='syev':
+            npcamax = min(SpAn._npca_max, npcamax)
+        self._npca = npy.clip(self._npca, 1, npcamax)
 
         # Number of pre-PCA modes before MSSA and SVD
         if self._prepca is None: # Default: pre-PCA needed over max (for MSSA and SVD)
@@ -498,7 +601,8 @@ class Analyzer(_BasicAnalyzer_, Dataset):
         rerun['pca'] = self._has_run_('pca') and (
             self._has_changed_(old, 'npca')>0 or
             self._has_changed_(old, 'useteof') or
-            self._has_changed_(old, 'notpc')
+            self._has_changed_(old, 'notpc') or
+            self._has_changed_(old, 'pcaevtarget')
         )
         rerun['mssa'] = self._has_run_('mssa') and (
             self._has_changed_(old, 'nmssa')<0 or
@@ -508,7 +612,7 @@ class Analyzer(_BasicAnalyzer_, Dataset):
         # - PCA
         if rerun['pca']:
             self.debug('Re-running PCA because some important parameters changed')
-            self.pca()
+            self.pca(force=True)
         # - MSSA
         if rerun['mssa']:
             self.debug('Re-running MSSA because some important parameters changed')
@@ -548,7 +652,7 @@ class Analyzer(_BasicAnalyzer_, Dataset):
     ## PCA
     #################################################################
     @_filldocs_
-    def pca(self, force=False, **kwargs):
+    def pca(self, force=False, warmstart=False, **kwargs):
         """
         Principal Components Analysis (PCA)
 
@@ -558,37 +662,91 @@ class Analyzer(_BasicAnalyzer_, Dataset):
 
         :Parameters:
             %(npca)s
+            %(pcasolver)s
+            %(evtarget)s
+            %(warmstart)s
         """
 
         # Update params
+        self._kwrsvd.update(dict_filter(kwargs, 'rsvd_'))
+        self._kwlanczos.update(dict_filter(kwargs, 'lanczos_'))
         self.update_params('pca', **kwargs)
 
         # Check if old results can be used when npca is lower
         if not force and self._pca_raw_pc is not None and \
-            self._pca_raw_pc.shape[-1] >= self._npca:
+            self._pca_raw_pc.shape[-1] >= self.npca:
             return
 
+        # Initial EOFs (T-EOFs differ from S-EOFs with gaps)
+        solver = self._pcasolver
+        if warmstart and (not self._useteof or self._zerofill==1 or
+                get_valid(self.stacked_data).all()):
+            v0 = self._get_warmstart_('pca', self.stacked_data.shape[0])
+        else:
+            v0 = None
+        if v0 is not None:
+            solver = 'lanczos'
+
         # Remove old results
-        for att in 'raw_eof','raw_pc','raw_ev','ev_sum':
+        for att in 'raw_eof','raw_pc','raw_ev','ev_sum','nkept':
             self._cleanattr_('_pca_'+att)
 
         # Compute PCA
         pdata = self.stacked_data
-        if pdata.shape[1] == 1: # One single channel, so result is itself
+        if self._pca_stats is not None: # Statistics from partial_fit
+            raw_eof, raw_ev, ev_sum = self._pca_stats.eigen(self._npca,
+                default_missing_value)
+            raw_pc = None
+            nkept = raw_ev.shape[0]
+            if self._pcaevtarget:
+                cumev = 100.*raw_ev.cumsum()/ev_sum
+                nkept = min(nkept, cumev.searchsorted(self._pcaevtarget)+1)
+
+        elif pdata.shape[1] == 1: # One single channel, so result is itself
             raw_eof = npy.ones(1, dtype=pdata.dtype)
             raw_pc = pdata
             ev_sum = raw_pc.var()
             raw_ev = npy.atleast_1d(ev_sum)
 
+        elif solver in ('randomized', 'lanczos'): # Computed from packed data
+            if solver=='randomized':
+                raw_eof, raw_ev, ev_sum = rsvd_pca(pdata, self._npca,
+                    default_missing_value, zerofill=self._zerofill, **self._kwrsvd)
+            else:
+                raw_eof, raw_ev, ev_sum = lanczos_pca(pdata, self._npca,
+                    default_missing_value, v0=v0, zerofill=self._zerofill,
+                    **self._kwlanczos)
+            nkept = raw_ev.shape[0]
+            if self._pcaevtarget:
+                cumev = 100.*raw_ev.cumsum()/ev_sum
+                nkept = min(nkept, cumev.searchsorted(self._pcaevtarget)+1)
+                raw_eof = raw_eof[:, :nkept]
+            raw_pc = _core.pca_getec(pdata, raw_eof, mv=default_missing_value,
+                minvalid=self._minecvalid, zerofill=int(self._zerofill==2),
+                demean=1)
+
         else: # Several channels
 #            weights = npy.asfortranarray(self.stacked_weights)
 #            pdata = npy.asfortranarray(pdata)
-            raw_eof, raw_pc, raw_ev, ev_sum, errmsg = \
+            raw_eof, raw_pc, raw_ev, ev_sum, nkept, errmsg = \
                 _core.pca(pdata, self._npca, default_missing_value,
                 useteof=self._useteof, notpc=self._notpc, minecvalid=self._minecvalid,
-                zerofill=self._zerofill)
+                zerofill=self._zerofill,
+                solver=SpAn._pca_solvers[solver],
+                evtarget=self._pcaevtarget or 0.)
             self.check_fortran_errmsg(errmsg)
 
+        # Less modes than expected (explained variance target reached)
+        if raw_eof.ndim==2 and nkept < self._npca:
+            if self._pcaevtarget:
+                self.debug('Explained variance target (%g%%) reached with %i PCA modes'
+                    %(self._pcaevtarget, nkept))
+            raw_eof = raw_eof[:, :nkept]
+            if raw_pc is not None:
+                raw_pc = raw_pc[:, :nkept]
+            raw_ev = raw_ev[:nkept]
+            self._pca_nkept = nkept
+
         # Post filtering
         if callable(self._pcapf):
             self._pcapf(pdata, raw_eof, raw_pc, raw_ev, default_missing_value)
@@ -610,6 +768,49 @@ class Analyzer(_BasicAnalyzer_, Dataset):
         """Check if PCA has already run"""
         return self._has_run_('pca')
 
+    @_filldocs_
+    def partial_fit(self, dataset, reset=False, **kwargs):
+        """Update PCA with a new chunk of data along time
+
+        It makes it possible to perform a PCA of datasets that do not fit
+        into memory: the sufficient statistics of the covariance matrix
+        of channels (means, cross-products and valid pair counts) are
+        accumulated chunk by chunk (see
+        :class:`~spanlib.engines.CovarianceAccumulator`).
+        EOFs and eigenvalues are computed from these statistics the next
+        time they are requested, and PCs of each chunk can then be computed
+        in a second pass with :meth:`pca_ec`.
+
+        Channels, normalisation factors and the scaling mean are taken from
+        the initialization dataset, which is not accumulated.
+
+        :Params:
+
+            - **dataset**: Chunk of data in the same form as initialization
+              data, except for the time length.
+            - **reset**, optional: Restart the accumulation from scratch.
+
+        :PCA parameters:
+            %(npca)s
+            %(evtarget)s
+
+        :Example:
+
+        >>> span = Analyzer(chunks[0], npca=5)
+        >>> for chunk in chunks:
+        ...     span.partial_fit(chunk)
+        >>> eof = span.pca_eof()
+        >>> pcs = [span.pca_ec(xdata=chunk) for chunk in chunks]
+        """
+        self.update_params('pca', **kwargs)
+        if reset or self._pca_stats is None:
+            self._pca_stats = CovarianceAccumulator(self.ns)
+        pdata = self.restack(self.remap(dataset), scale=True)
+        self._pca_stats.update(pdata, default_missing_value,
+            zerofill=self._zerofill)
+        self.clean(pca=True)
+        return self
+
 
     @_filldocs_
     def pca_eof(self, scale=False, raw=False, unmap=True, format=True, **kwargs):
@@ -703,6 +904,9 @@ class Analyzer(_BasicAnalyzer_, Dataset):
 
         # First PCA analysis?
         if self._pca_raw_pc is None: self.pca()
+        if self._pca_raw_pc is None:
+            self.error('PCs are not available after partial_fit: '
+                'please use pca_ec with chunks of data')
 
         # Raw ?
         if raw:
@@ -784,6 +988,10 @@ class Analyzer(_BasicAnalyzer_, Dataset):
         if ev is None: ev = self._pca_raw_ev
         if ev is False: ev = ev*0-1
 
+        # Mean of data accumulated with partial_fit
+        if self._pca_stats is not None and not xraw:
+            raw_data = self._pca_stats.center(raw_data, default_missing_value)
+
         # Projection
         raw_data = npy.asfortranarray(raw_data)
         raw_eof = npy.asfortranarray(raw_eof)
@@ -1006,7 +1214,7 @@ class Analyzer(_BasicAnalyzer_, Dataset):
 
 
     @_filldocs_
-    def mssa(self, force=False, **kwargs):
+    def mssa(self, force=False, warmstart=False, **kwargs):
         """ MultiChannel Singular Spectrum Analysis (MSSA)
 
         It is called everytime needed by :meth:`mssa_eof`, :meth:`mssa_pc`, :meth:`mssa_ev` and :meth:`mssa_rec`.
@@ -1016,28 +1224,65 @@ class Analyzer(_BasicAnalyzer_, Dataset):
             %(nmssa)s
             %(window)s
             %(prepca)s
+            %(mssasolver)s
+            %(warmstart)s
         """
 
         # Parameters
+        self._kwlanczos.update(dict_filter(kwargs, 'lanczos_'))
+        self._kwrsvd.update(dict_filter(kwargs, 'rsvd_'))
         self.update_params('mssa', **kwargs)
 
         # Check if old results can be used when nmssa is lower
         if not force and self._mssa_raw_pc is not None and self._mssa_raw_pc.shape[-1] >= self._nmssa:
             return
 
+        # Get input to MSSA
+        raw_input = self.preproc_raw_output(force=force)
+
+        # Initial ST-EOFs
+        solver = self._mssasolver
+        if warmstart:
+            v0 = self._get_warmstart_('mssa', raw_input.shape[0]*self._window)
+        else:
+            v0 = None
+        if v0 is not None:
+            solver = 'lanczos'
+
         # Remove old results
         for att in 'raw_eof','raw_pc','raw_ev','ev_sum':
             self._cleanattr_('_mssa_'+att)
 
-        # Get input to MSSA
-        raw_input = self.preproc_raw_output(force=force)
-
         # Run MSSA
-        raw_eof, raw_pc, raw_ev, ev_sum, errmsg = \
-            _core.mssa(raw_input, self._window, self._nmssa,
-                default_missing_value, minecvalid=self._minecvalid,
-                zerofill=self._zerofill)
-        self.check_fortran_errmsg(errmsg)
+        if solver=='auto':
+            if raw_input.shape[0]*self._window > SpAn._mssa_lanczos_min:
+                solver = 'lanczos'
+            else:
+                solver = 'syev'
+        if solver=='lanczos': # Matrix-free
+            raw_eof, raw_ev, ev_sum = lanczos_mssa(raw_input, self._window,
+                self._nmssa, default_missing_value, v0=v0, **self._kwlanczos)
+            raw_pc = _core.mssa_getec(
+                get_anomalies(raw_input, default_missing_value, self._zerofill),
+                raw_eof, self._window, default_missing_value,
+                minvalid=self._minecvalid, zerofill=int(self._zerofill==2))
+        elif solver=='svd': # Trajectory matrix
+            kwrsvd = self._kwrsvd.copy()
+            kwrsvd.pop('chunksize', None)
+            raw_eof, raw_pc, raw_ev, ev_sum = trajectory_mssa(raw_input,
+                self._window, self._nmssa, default_missing_value,
+                zerofill=self._zerofill, **kwrsvd)
+            if self._zerofill!=1 and not get_valid(raw_input).all():
+                raw_pc = _core.mssa_getec(
+                    get_anomalies(raw_input, default_missing_value),
+                    raw_eof, self._window, default_missing_value,
+                    minvalid=self._minecvalid, zerofill=int(self._zerofill==2))
+        else:
+            raw_eof, raw_pc, raw_ev, ev_sum, errmsg = \
+                _core.mssa(raw_input, self._window, self._nmssa,
+                    default_missing_value, minecvalid=self._minecvalid,
+                    zerofill=self._zerofill)
+            self.check_fortran_errmsg(errmsg)
 
         # Save results
         self._mssa_raw_pc = raw_pc
@@ -1241,10 +1486,10 @@ class Analyzer(_BasicAnalyzer_, Dataset):
         if self._prepca:
             nw = self._window
             nc = raw_eof.shape[0]/nw
-            if nc > self._prepca:
+            if nc > self.prepca:
                 raw_eof = raw_eof.reshape(nc, nw, -1)
-                raw_eof = raw_eof[:self._prepca]
-                raw_eof = raw_eof.reshape(self._prepca*nw, -1)
+                raw_eof = raw_eof[:self.prepca]
+                raw_eof = raw_eof.reshape(self.prepca*nw, -1)
 
         # Data to project on ST-EOFs
         if xdata is None: # From input
@@ -1299,7 +1544,9 @@ class Analyzer(_BasicAnalyzer_, Dataset):
 
     @_filldocs_
     def mssa_ev(self, relative=False, sum=False, cumsum=False,
-        mctest=False, mcnens=100, mcqt=90, format=True, unmap=True, **kwargs):
+        mctest=False, mcnens=100, mcqt=90, mcseed=None, mcnproc=1,
+        mcchunksize=None, mcmethod='auto', stcov_method='auto', format=True,
+        unmap=True, **kwargs):
         """Get eigen values from current MSSA decomposition
 
         :Options:
@@ -1321,6 +1568,29 @@ class Analyzer(_BasicAnalyzer_, Dataset):
                 Size of the ensemble fo compute quantiles.
             - *mcqt*: float|int
                 Value of the higher quantile in %% (the lower is ``100-mcqt``).
+            - *mcseed*: int
+                Seed used to draw the seeds of the ensemble members, which makes
+                the test reproducible whatever ``mcnproc`` and ``mcchunksize``.
+                The global :mod:`numpy.random` state is used when ``None``.
+            - *mcnproc*: int
+                Number of processes sharing the ensemble.
+            - *mcchunksize*: int
+                Number of members given at once to each process.
+            - *mcmethod*: str
+                Method used to compute fake eigenvalues of surrogate data:
+
+                    - ``"cov"``: Projection of the covariance matrix of each
+                      surrogate onto ST-EOFs.
+                    - ``"lags"``: Contraction of lagged covariances of
+                      surrogates with lagged products of ST-EOFs, by batches
+                      of surrogates and without covariance matrix
+                      (see :func:`~spanlib.engines.mssa_mcev`).
+                    - ``"auto"``: ``"lags"`` when ``nmssa`` is lower than
+                      a quarter of the number of ST-EOFs, else ``"cov"``.
+
+            - *stcov_method*: str
+                Method used to compute the covariance matrix of surrogate
+                data with ``mcmethod="cov"`` (see :func:`~spanlib.engines.stcov`).
 
         :Returns:
 
@@ -1358,33 +1628,36 @@ class Analyzer(_BasicAnalyzer_, Dataset):
         # Mont-Carlo test
         if mctest:
 
-            # Get reference data
-            if self._prepca:
-                data = self._pca_raw_pc
+            # Red noise generator fitted to reference data (nt,nchan)
+            rn = RedNoise(self.preproc_raw_output().T)
+
+            # Seeds of members
+            seeds = get_random_state(mcseed).randint(0, 2**31-1, size=mcnens)
+
+            # Tasks
+            steof = npy.ascontiguousarray(self._mssa_raw_eof[:, :self._nmssa])
+            if mcmethod=='auto':
+                mcmethod = 'lags' if 4*self._nmssa<steof.shape[0] else 'cov'
+            if not mcnproc or mcnproc<1:
+                mcnproc = cpu_count()
+            if not mcchunksize:
+                mcchunksize = int(npy.ceil(mcnens/(4.*mcnproc)))
+            tasks = [(rn, steof, self.window, mcmethod, stcov_method,
+                seeds[i0:i0+mcchunksize])
+                for i0 in xrange(0, mcnens, mcchunksize)]
+
+            # Fake eigen values of an ensemble of surrogate data
+            if mcnproc==1:
+                mcev = map(_mssa_mcev_, tasks)
             else:
-                data = self.stacked_data
-
-            # Inits
-            rn = RedNoise(data.T) # red noise generator
-            mcev = npy.zeros((mcnens, self.nmssa))
-
-            # Generate and ensemble of surrogate data
-            for iens in xrange(mcnens):
-
-                # Create a sample red noise (nt,nchan)
-                red_noise = rn.sample().T
-
-                # Block-covariance matrix (nchan*nwindow,nchan*nwindow,)
-                cov = _core.stcov(npy.asfortranarray(red_noise),
-                    self.window, default_missing_value)
-                cov = npy.ascontiguousarray(cov)
-                del red_noise
-
-                # Fake eigen values (EOFt.COV.EOF)
-                ce = npy.dot(cov, self._mssa_raw_eof) #; del cov
-                evmat = npy.dot(self._mssa_raw_eof.T, ce) #; del ce
-                mcev[iens] = npy.diag(evmat)[:nmssa] ; del evmat
-
+                self.debug('Running MSSA Monte-Carlo test with %i processes'%mcnproc)
+                pool = Pool(mcnproc)
+                try:
+                    mcev = pool.map(_mssa_mcev_, tasks)
+                finally:
+                    pool.close()
+                    pool.join()
+            mcev = npy.concatenate(mcev)
             mcev.sort(axis=0) # Sort by value inside ensemble
 
             # Confidence interval
@@ -1392,12 +1665,12 @@ class Analyzer(_BasicAnalyzer_, Dataset):
             imini, iminf = divmod((1-mcqt/100.)*(mcnens-1), 1)
             evmin = mcev[int(imini)]
             if int(imini) != mcnens-1:
-                evmin += (1-iminf)*mcev[int(imini)] + iminf*mcev[int(imini)+1]
+                evmin = (1-iminf)*mcev[int(imini)] + iminf*mcev[int(imini)+1]
             # - max
             imaxi, imaxf = divmod(mcqt/100.*(mcnens-1), 1)
             evmax = mcev[int(imaxi)]
             if int(imaxi) != mcnens-1:
-                evmax += (1-imaxf)*mcev[int(imaxi)] + imaxf*mcev[int(imaxi)+1]
+                evmax = (1-imaxf)*mcev[int(imaxi)] + imaxf*mcev[int(imaxi)+1]
             ev.extend([evmin, evmax])
 
         # Special outputs
@@ -1677,7 +1950,7 @@ class Analyzer(_BasicAnalyzer_, Dataset):
                 for cc in 'eof','pc','ev':
                     nones.append('_%s_%s_%s'%(aa,bb,cc))
         if pca:
-            nones.extend(['_pca_raw_pc_mean'])
+            nones.extend(['_pca_raw_pc_mean', '_pca_nkept'])
         if mssa:
             nones.extend(['_mssa_window_axes','_mssa_pctime_axes', '_mssa_channel_axes'])
 #        lists = ['_mssa_pairs','_nt','_ns','_ndata','_pdata']
@@ -1698,9 +1971,14 @@ class Analyzer(_BasicAnalyzer_, Dataset):
     def get_npca(self):
         """Get :attr:`npca`
 
+        It is lower than the requested number of modes when the last PCA
+        reached its explained variance target with less modes.
+
         :Returns:
             integer
         """
+        if self._pca_nkept is not None:
+            return min(self._npca, self._pca_nkept)
         return self._npca
     def set_npca(self, npca):
         """Set :attr:`npca`"""
@@ -1710,9 +1988,14 @@ class Analyzer(_BasicAnalyzer_, Dataset):
     def get_prepca(self):
         """Get :attr:`prepca`
 
+        Like :attr:`npca`, it is limited by the number of PCA modes kept
+        with an explained variance target.
+
         :Returns:
             integer
         """
+        if self._prepca and self._pca_nkept is not None:
+            return min(self._prepca, self._pca_nkept)
         return self._prepca
     def set_prepca(self, prepca):
         """Set :attr:`prepca`"""
@@ -2040,6 +2323,44 @@ def phase_composites(data,  nphase=8, minamp=.5, firstphase=0, index=None, forma
 
 
 
+def _mssa_mcev_(task):
+    """Fake MSSA eigen values of surrogate data for :meth:`Analyzer.mssa_ev`
+
+    :Params:
+
+        - **task**: ``(rn, steof, nwindow, mcmethod, stcov_method, seeds)``
+          where ``rn`` is a :class:`RedNoise` instance and ``seeds``
+          the seeds of members.
+
+    :Returns: A ``(len(seeds),nmssa)`` array.
+    """
+    rn, steof, nwindow, mcmethod, stcov_method, seeds = task
+
+    # Without covariance matrix
+    if mcmethod=='lags':
+        surrogates = rn.sample(len(seeds), seed=seeds).transpose(0, 2, 1)
+        return mssa_mcev(surrogates, steof, nwindow)
+
+    # Projection of covariance matrices
+    mcev = npy.zeros((len(seeds), steof.shape[1]))
+    for iens, seed in enumerate(seeds):
+
+        # Create a sample red noise (nchan,nt)
+        red_noise = rn.sample(seed=seed).T
+
+        # Block-covariance matrix (nchan*nwindow,nchan*nwindow,)
+        cov = stcov(red_noise, nwindow, default_missing_value,
+            method=stcov_method)
+        cov = npy.ascontiguousarray(cov)
+        del red_noise
+
+        # Fake eigen values (EOFt.COV.EOF)
+        mcev[iens] = (steof*npy.dot(cov, steof)).sum(axis=0)
+        del cov
+
+    return mcev
+
+
 class RedNoise(object):
     """Create a red noise generated based on lag-0 and lag-1 autocovariances of a variable
 
@@ -2090,6 +2411,9 @@ class RedNoise(object):
     >>> noiser = RedNoise(data)
     >>> noise1 = noiser.sample()
     >>> noise2 = noiser.sample()
+    >>> noises = noiser.sample(1000, seed=0, dtype='f') # (1000,nt,nchan)
+    >>> for noises in noiser.iter_samples(10000, batchsize=500):
+    ...     pass
     """
 
     # Bias
@@ -2132,20 +2456,98 @@ class RedNoise(object):
         alpha2 = c0
         alpha2 *= 1-self.gamma**2
         self.alpha = npy.sqrt(alpha2) ; del alpha2
-        self.gg = npy.repeat(self.gamma[npy.newaxis, :], nt, axis=0) # (nt,nchan)
-        self.gg = self.gg.cumprod(axis=0, out=self.gg)
-
-
-    def sample(self):
-        """Get a red noise sample fitted to input data"""
-        white_noise = npy.random.randn(*self.shape) # (nt,nchan)
-        white_noise /= white_noise.std(axis=0, ddof=1)
-        white_noise *= self.alpha
-        white_noise *= self.gg[::-1]
-        red_noise = white_noise.cumsum(axis=0, out=white_noise)
-        red_noise /= self.gg[::-1]
-        red_noise -= red_noise.mean(axis=0)
-        return red_noise
+
+
+    def sample(self, n=None, seed=None, dtype='d'):
+        """Get red noise samples fitted to input data
+
+        :Params:
+
+            - **n**, optional: Number of samples. A single sample
+              is returned if ``None``.
+            - **seed**, optional: Seed or random state
+              (see :func:`~spanlib.engines.get_random_state`),
+              like a :class:`numpy.random.RandomState` or a
+              :class:`numpy.random.Generator`. It can also be a list
+              of ``n`` seeds, one per sample.
+            - **dtype**, optional: Data type of samples, like ``'f'``
+              to halve memory usage.
+
+        :Returns: An array of shape ``(nt,nchan)`` if ``n`` is ``None``,
+            else ``(n,nt,nchan)``.
+        """
+        nt, nchan = self.shape
+        nn = 1 if n is None else n
+
+        # White noise of unit variance
+        if npy.ndim(seed)==1:
+            white_noise = npy.array([self._white_noise_(get_random_state(sd),
+                (nt, nchan), dtype) for sd in seed])
+        else:
+            white_noise = self._white_noise_(get_random_state(seed),
+                (nn, nt, nchan), dtype)
+        white_noise /= white_noise.std(axis=1, ddof=1)[:, None]
+        white_noise *= self.alpha.astype(dtype)
+
+        # AR(1) recursive filter
+        red_noise = self._ar1_filter_(white_noise, self.gamma).astype(dtype)
+        del white_noise
+        red_noise -= red_noise.mean(axis=1)[:, None]
+
+        return red_noise[0] if n is None else red_noise
+
+    @staticmethod
+    def _ar1_filter_(white_noise, gamma):
+        """Apply the AR(1) recursive filter :math:`u_t = \gamma u_{t-1} + w_t`
+        along the time axis of ``(n,nt,nchan)`` samples
+
+        Time is split into about :math:`\sqrt{nt}` blocks that are all filtered
+        at once, then the last value of each block is propagated to the next
+        ones, so that only :math:`O(\sqrt{nt})` vectorized steps are needed.
+        """
+        n, nt, nchan = white_noise.shape
+        nblock = int(npy.ceil(npy.sqrt(nt)))
+        nb = -(-nt//nblock)
+        gamma = npy.asarray(gamma, 'd')
+        red_noise = npy.zeros((n, nb*nblock, nchan))
+        red_noise[:, :nt] = white_noise
+        blocks = red_noise.reshape(n, nb, nblock, nchan)
+
+        # Inside blocks
+        for it in xrange(1, nblock):
+            blocks[:, :, it] += gamma*blocks[:, :, it-1]
+
+        # Across blocks
+        last = blocks[:, :, -1]
+        gammab = gamma**nblock
+        for ib in xrange(1, nb):
+            last[:, ib] += gammab*last[:, ib-1]
+        blocks[:, 1:, :-1] += (gamma**npy.arange(1, nblock)[:, None] *
+            last[:, :-1, None])
+
+        return red_noise[:, :nt]
+
+    @staticmethod
+    def _white_noise_(rng, shape, dtype):
+        try: # numpy.random.Generator
+            return rng.standard_normal(shape, dtype=dtype)
+        except TypeError:
+            return rng.standard_normal(shape).astype(dtype)
+
+    def iter_samples(self, n, batchsize=100, seed=None, dtype='d'):
+        """Iterate over batches of red noise samples
+
+        :Params:
+
+            - **n**: Total number of samples.
+            - **batchsize**, optional: Number of samples per batch.
+            - Other parameters are passed to :meth:`sample`.
+
+        :Yields: Arrays of shape ``(batchsize,nt,nchan)``.
+        """
+        rng = get_random_state(seed)
+        for i0 in xrange(0, n, batchsize):
+            yield self.sample(min(batchsize, n-i0), seed=rng, dtype=dtype)
 
 def freqfilter(data, low_freq, high_freq, **kwargs):
     """Filter out frequencies using FFT applied to MSSA PCs"""
@@ -0,0 +1,912 @@
+#################################################################################
+# File: engines.py
+#
+# This file is part of the SpanLib library.
+# Copyright (C) 2006-2015  Stephane Raynaud
+# Contact: stephane dot raynaud at gmail dot com
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#################################################################################
+"""Numerical engines written with :mod:`numpy` that complement the fortran core
+
+They work on packed arrays, like those of :attr:`Dataset.stacked_data`,
+where missing values are flagged with :data:`default_missing_value`.
+"""
+
+from warnings import warn
+import numpy as npy
+from data import default_missing_value
+from util import SpanlibError
+
+mvtol = npy.finfo('d').eps
+
+#: Fortran codes of :func:`stcov` methods
+stcov_methods = dict(loop=1, gemm=2)
+
+#: Minimal window size for which :func:`stcov` uses FFTs
+stcov_fft_min_window = 256
+
+
+def get_valid(data, mv=default_missing_value):
+    """Get a boolean array that is True where data are not missing"""
+    return npy.abs((data-mv)/mv) > mvtol
+
+
+def get_random_state(seed=None):
+    """Get a :class:`numpy.random.RandomState` instance
+
+    :Params:
+
+        - **seed**, optional: Integer seed, a random state or generator
+          instance, or ``None`` to use the global :mod:`numpy.random` state.
+    """
+    if seed is None:
+        return npy.random
+    if hasattr(seed, 'standard_normal'): # RandomState, Generator...
+        return seed
+    return npy.random.RandomState(seed)
+
+
+def iter_anomalies(pdata, mv=default_missing_value, chunksize=None,
+        zerofill=0):
+    """Iterate over blocks of channels of packed data as centered anomalies
+
+    Missing values are set to zero.
+
+    :Params:
+
+        - **pdata**: Packed data ``(ns,nt)``.
+        - **chunksize**, optional: Number of channels per block.
+          All channels are processed at once by default.
+        - **zerofill**, optional: If ``1``, missing values are
+          considered as valid zeros.
+
+    :Yields: ``(slice, anom, valid)`` where ``anom`` is the block
+        of anomalies and ``valid`` its validity mask.
+    """
+    ns, nt = pdata.shape
+    if not chunksize:
+        chunksize = ns
+    for i0 in xrange(0, ns, chunksize):
+        sl = slice(i0, min(i0+chunksize, ns))
+        block = npy.asarray(pdata[sl], dtype='d')
+        anom = npy.where(get_valid(block, mv), block, 0.)
+        if zerofill==1:
+            valid = npy.ones(block.shape, '?')
+        else:
+            valid = get_valid(block, mv)
+        count = valid.sum(axis=1)
+        mean = anom.sum(axis=1)/npy.clip(count, 1, nt)
+        anom -= mean[:, None]
+        anom[~valid] = 0.
+        yield sl, anom, valid
+
+
+def get_anomalies(pdata, mv=default_missing_value, zerofill=0):
+    """Get centered anomalies of packed data with missing values
+
+    :Params:
+
+        - **pdata**: Packed data ``(ns,nt)``.
+        - **zerofill**, optional: See :func:`iter_anomalies`.
+
+    :Returns: A fortran ordered array where invalid points are
+        set to ``mv``.
+    """
+    sl, anom, valid = iter_anomalies(pdata, mv, zerofill=zerofill).next()
+    anom[~valid] = mv
+    return npy.asfortranarray(anom)
+
+
+def rsvd_pca(pdata, nkeep, mv=default_missing_value, oversampling=10, niter=2,
+        chunksize=None, zerofill=0, seed=None):
+    """Randomized truncated PCA of packed data
+
+    The leading left singular vectors of the anomalies are estimated
+    with a randomized range finder followed by power iterations,
+    and the SVD of the small projected matrix.
+    Anomalies are formed block by block, so that no dense covariance
+    matrix nor full copy of the data is created.
+
+    :Params:
+
+        - **pdata**: Packed data ``(ns,nt)``.
+        - **nkeep**: Number of modes.
+        - **oversampling**, optional: Number of extra random vectors.
+        - **niter**, optional: Number of power iterations.
+        - **chunksize**, optional: Number of channels processed at once.
+        - **zerofill**, optional: See :func:`iter_anomalies`.
+        - **seed**, optional: See :func:`get_random_state`.
+
+    :Returns: ``eof, ev, ev_sum`` where ``eof`` has missing values
+        on channels that are never valid.
+
+    .. note:: With gaps, eigenvalues are those of the covariance
+        matrix of the zero-filled anomalies divided by the number of
+        valid time steps, which is an approximation of the pairwise
+        covariance matrix used by :f:func:`sl_pca`.
+    """
+    ns, nt = pdata.shape
+    kw = dict(mv=mv, chunksize=chunksize, zerofill=zerofill)
+    rng = get_random_state(seed)
+
+    # Valid channels and time steps
+    counts = npy.zeros(ns, 'l')
+    tvalid = npy.zeros(nt, '?')
+    ev_sum = 0.
+    for sl, anom, valid in iter_anomalies(pdata, **kw):
+        count = counts[sl] = valid.sum(axis=1)
+        tvalid |= valid.any(axis=0)
+        ev_sum += ((anom**2).sum(axis=1)[count>0]/count[count>0]).sum()
+    ntv = max(1, tvalid.sum())
+    nsv = (counts>0).sum()
+    nkeep = min(nkeep, nsv, ntv)
+    nrand = min(nkeep+oversampling, nsv, nt)
+
+    # Range finder: Y = X.Omega
+    omega = rng.standard_normal((nt, nrand))
+    yy = npy.zeros((ns, nrand))
+    for sl, anom, valid in iter_anomalies(pdata, **kw):
+        yy[sl] = npy.dot(anom, omega)
+    del omega
+    qq = npy.linalg.qr(yy)[0]
+
+    # Power iterations with re-orthonormalisation
+    for i in xrange(niter):
+        zz = npy.zeros((nt, nrand))
+        for sl, anom, valid in iter_anomalies(pdata, **kw):
+            zz += npy.dot(anom.T, qq[sl])
+        zz = npy.linalg.qr(zz)[0]
+        for sl, anom, valid in iter_anomalies(pdata, **kw):
+            yy[sl] = npy.dot(anom, zz)
+        qq = npy.linalg.qr(yy)[0]
+    del yy
+
+    # SVD of the projection B = Q^T.X
+    bb = npy.zeros((nrand, nt))
+    for sl, anom, valid in iter_anomalies(pdata, **kw):
+        bb += npy.dot(qq[sl].T, anom)
+    ub, ss = npy.linalg.svd(bb, full_matrices=False)[:2]
+    del bb
+    eof = npy.dot(qq, ub[:, :nkeep])
+    ev = ss[:nkeep]**2/ntv
+
+    # First valid channel of an EOF is >= 0
+    cvalid = counts>0
+    ifirst = cvalid.argmax()
+    eof[:, eof[ifirst]<0] *= -1
+    eof[~cvalid] = mv
+
+    return npy.asfortranarray(eof), ev, ev_sum
+
+
+class CovarianceAccumulator(object):
+    """Sufficient statistics of the covariance matrix of packed data
+
+    Statistics are accumulated chunk by chunk along time, so that
+    the covariance matrix of channels can be computed without
+    having all time steps in memory:
+    cross-products of zero-filled data, sums of data over
+    valid pairs, and valid pair counts.
+    The covariance matrix is the one of :f:func:`sl_pca` (S-EOFs),
+    computed with pairwise valid counts.
+
+    :Params:
+
+        - **ns**: Number of channels.
+    """
+    def __init__(self, ns):
+        self.ns = ns
+        self.nt = 0
+        self._xx = npy.zeros((ns, ns))
+        self._xv = npy.zeros((ns, ns))
+        self._vv = npy.zeros((ns, ns))
+
+    def update(self, pdata, mv=default_missing_value, zerofill=0):
+        """Add a chunk of packed data ``(ns,nt)``
+
+        :Params:
+
+            - **zerofill**, optional: If ``1``, missing values are
+              considered as valid zeros.
+        """
+        pdata = npy.asarray(pdata, dtype='d').reshape(self.ns, -1)
+        valid = get_valid(pdata, mv)
+        xx = npy.where(valid, pdata, 0.)
+        if zerofill==1:
+            valid[:] = True
+        vv = valid.astype('d')
+        self._xx += npy.dot(xx, xx.T)
+        self._xv += npy.dot(xx, vv.T)
+        self._vv += npy.dot(vv, vv.T)
+        self.nt += pdata.shape[1]
+
+    def get_count(self):
+        """Number of valid values of each channel"""
+        return self._vv.diagonal().copy()
+    count = property(fget=get_count, doc=get_count.__doc__)
+
+    def get_mean(self):
+        """Mean of each channel"""
+        return self._xv.diagonal()/npy.clip(self._vv.diagonal(), 1, None)
+    mean = property(fget=get_mean, doc=get_mean.__doc__)
+
+    def get_cov(self):
+        """Covariance matrix of channels"""
+        mm = self.mean
+        cov = self._xx - mm*self._xv - mm[:, None]*self._xv.T + \
+            npy.outer(mm, mm)*self._vv
+        return npy.where(self._vv>0, cov/npy.clip(self._vv, 1, None), 0.)
+    cov = property(fget=get_cov, doc=get_cov.__doc__)
+
+    def center(self, pdata, mv=default_missing_value):
+        """Remove the mean from packed data ``(ns,...)``"""
+        mm = self.mean.reshape((self.ns, )+(1, )*(pdata.ndim-1))
+        return npy.asfortranarray(npy.where(get_valid(pdata, mv), pdata-mm, mv))
+
+    def eigen(self, nkeep, mv=default_missing_value):
+        """Leading EOFs and eigenvalues of the covariance matrix
+
+        :Returns: ``eof, ev, ev_sum`` like :func:`rsvd_pca`.
+        """
+        cov = self.cov
+        ev_sum = cov.trace()
+        ev, eof = npy.linalg.eigh(cov)
+        del cov
+        nkeep = min(nkeep, self.ns)
+        ev = npy.clip(ev[::-1][:nkeep], 0., None)
+        eof = eof[:, ::-1][:, :nkeep]
+
+        # First valid channel of an EOF is >= 0
+        cvalid = self.count>0
+        eof[:, eof[cvalid.argmax()]<0] *= -1
+        eof[~cvalid] = mv
+
+        return npy.asfortranarray(eof), ev, ev_sum
+
+
+def block_eigsh(matvec, n, nkeep, blocksize=None, nsteps=4, maxiter=100,
+        tol=1e-8, v0=None, seed=None):
+    """Leading eigen pairs of a symmetric operator with a restarted block Lanczos
+
+    At each iteration, a block Krylov basis of ``nsteps`` blocks is built
+    from the current block of vectors with full re-orthogonalisation,
+    and the block is updated with the Rayleigh-Ritz vectors of the
+    operator on this basis.
+
+    :Params:
+
+        - **matvec**: Function that applies the operator to
+          a ``(n,nb)`` array.
+        - **n**: Size of the operator.
+        - **nkeep**: Number of leading eigen pairs.
+        - **blocksize**, optional: Size of the block of vectors
+          (defaults to ``max(2*nkeep, nkeep+8)``).
+        - **nsteps**, optional: Number of blocks of the Krylov basis.
+        - **maxiter**, optional: Maximal number of restarts.
+        - **tol**, optional: Relative tolerance on the residual norms,
+          with respect to the first eigen value.
+        - **v0**, optional: Initial vectors ``(n,nv)``, typically eigen
+          vectors of a previous analysis. They are completed with random
+          vectors.
+        - **seed**, optional: See :func:`get_random_state`.
+
+    :Returns: ``ev, eigvec`` sorted by decreasing eigen values.
+    """
+    nkeep = min(nkeep, n)
+    if blocksize is None:
+        blocksize = max(2*nkeep, nkeep+8)
+    nb = min(max(blocksize, nkeep), n)
+
+    # Small problem: dense matrix
+    if nb*nsteps >= n:
+        ev, eigvec = npy.linalg.eigh(matvec(npy.identity(n)))
+        return ev[::-1][:nkeep], eigvec[:, ::-1][:, :nkeep]
+
+    # Initial block
+    vv = get_random_state(seed).standard_normal((n, nb))
+    if v0 is not None:
+        v0 = npy.asarray(v0, dtype='d').reshape(n, -1)[:, :nb]
+        vv[:, :v0.shape[1]] = v0
+    vv = npy.linalg.qr(vv)[0]
+    av = matvec(vv)
+
+    for it in xrange(maxiter):
+
+        # Block Krylov basis
+        basis = [vv]
+        abasis = [av]
+        for istep in xrange(nsteps-1):
+            ww = abasis[-1]
+            wnorm = npy.sqrt((ww**2).sum())
+            for qq in basis:
+                ww = ww - npy.dot(qq, npy.dot(qq.T, ww))
+            if npy.sqrt((ww**2).sum()) < 1e-10*wnorm: # Invariant subspace
+                break
+            # Second pass after normalisation, since columns that are
+            # nearly in the basis (rank deficient operator) are amplified
+            for irep in xrange(2):
+                ww = npy.linalg.qr(ww)[0]
+                if irep:
+                    break
+                for qq in basis:
+                    ww = ww - npy.dot(qq, npy.dot(qq.T, ww))
+            basis.append(ww)
+            abasis.append(matvec(ww))
+        kk = npy.hstack(basis)
+        akk = npy.hstack(abasis)
+        del basis, abasis
+
+        # Rayleigh-Ritz
+        hh = npy.dot(kk.T, akk)
+        ev, ss = npy.linalg.eigh(0.5*(hh+hh.T))
+        ev = ev[::-1][:nb]
+        ss = ss[:, ::-1][:, :nb]
+        vv = npy.dot(kk, ss)
+        av = npy.dot(akk, ss)
+        del kk, akk
+
+        # Convergence
+        res = npy.sqrt(((av[:, :nkeep]-vv[:, :nkeep]*ev[:nkeep])**2).sum(axis=0))
+        if (res <= tol*max(abs(ev[0]), npy.finfo('d').tiny)).all():
+            break
+    else:
+        warn('block_eigsh: no convergence after %i iterations (max residual: %g)'
+            %(maxiter, res.max()))
+
+    return ev[:nkeep], vv[:, :nkeep]
+
+
+def lanczos_pca(pdata, nkeep, mv=default_missing_value, v0=None, zerofill=0,
+        **kwargs):
+    """PCA of packed data with an iterative eigen solver
+
+    The leading eigen pairs of the covariance matrix of channels
+    are computed with :func:`block_eigsh`, which is efficient when
+    good initial vectors are known, like the EOFs of a previous
+    analysis of slightly different data.
+    Without gaps, the covariance matrix is applied as ``X.(X^T.V)/nt``
+    and never formed. With gaps, it is the pairwise covariance
+    matrix of :f:func:`sl_pca` (S-EOFs).
+
+    :Params:
+
+        - **pdata**: Packed data ``(ns,nt)``.
+        - **nkeep**: Number of modes.
+        - **v0**, optional: Initial EOFs ``(ns,nv)``, where missing values
+          are considered as zeros.
+        - **zerofill**, optional: See :func:`iter_anomalies`.
+        - Other keywords are passed to :func:`block_eigsh`.
+
+    :Returns: ``eof, ev, ev_sum`` like :func:`rsvd_pca`.
+    """
+    ns, nt = pdata.shape
+    sl, anom, valid = iter_anomalies(pdata, mv, zerofill=zerofill).next()
+    counts = valid.sum(axis=1)
+    cvalid = counts>0
+    ev_sum = ((anom**2).sum(axis=1)[cvalid]/counts[cvalid]).sum()
+
+    # Covariance operator
+    if valid.all():
+        matvec = lambda vv: npy.dot(anom, npy.dot(anom.T, vv))/nt
+    else:
+        vmask = valid.astype('d')
+        cov = npy.dot(anom, anom.T)/npy.clip(npy.dot(vmask, vmask.T), 1, None)
+        del vmask
+        matvec = lambda vv: npy.dot(cov, vv)
+
+    # Initial vectors
+    if v0 is not None:
+        v0 = npy.asarray(v0, dtype='d').reshape(ns, -1)
+        v0 = npy.where(get_valid(v0, mv), v0, 0.)
+        if not v0.any():
+            v0 = None
+
+    # Eigen pairs
+    nkeep = min(nkeep, cvalid.sum(), nt)
+    ev, eof = block_eigsh(matvec, ns, nkeep, v0=v0, **kwargs)
+    ev = npy.clip(ev, 0., None)
+
+    # First valid channel of an EOF is >= 0
+    eof[:, eof[cvalid.argmax()]<0] *= -1
+    eof[~cvalid] = mv
+
+    return npy.asfortranarray(eof), ev, ev_sum
+
+
+def _get_nfft_(n):
+    """Power of 2 FFT size greater or equal to ``n``"""
+    return 2**int(npy.ceil(npy.log2(n)))
+
+
+def _get_lags_(nfft, nwindow):
+    """Indices of lags from ``-nwindow+1`` to ``nwindow-1`` in a circular
+    correlation of size ``nfft``"""
+    return npy.concatenate((npy.arange(nfft-nwindow+1, nfft),
+        npy.arange(nwindow)))
+
+
+def lagged_covariances(pdata, nwindow, mv=default_missing_value):
+    """Lagged cross-covariances of packed data computed with FFTs
+
+    Covariances are normalised by the number of valid pairs of points
+    at each lag, like in :f:func:`sl_stcov`.
+
+    :Params:
+
+        - **pdata**: Packed data ``(nchan,nt)``.
+        - **nwindow**: MSSA window size.
+
+    :Returns: A ``(nchan,nchan,2*nwindow-1)`` array ``cc`` where
+        ``cc[i,j,nwindow-1+d]`` is the covariance between channel ``i``
+        at time ``t`` and channel ``j`` at time ``t+d``.
+    """
+    nchan, nt = pdata.shape
+    sl, anom, valid = iter_anomalies(pdata, mv).next()
+    nfft = _get_nfft_(nt+nwindow-1)
+    lags = _get_lags_(nfft, nwindow)
+    fanom = npy.fft.rfft(anom, nfft, axis=1)
+    fvalid = npy.fft.rfft(valid.astype('d'), nfft, axis=1)
+    del anom, valid
+    cc = npy.zeros((nchan, nchan, 2*nwindow-1))
+    for ic in xrange(nchan):
+        cov = npy.fft.irfft(fanom[ic].conj()*fanom, nfft, axis=1)[:, lags]
+        nn = npy.round(npy.fft.irfft(fvalid[ic].conj()*fvalid, nfft,
+            axis=1)[:, lags])
+        cc[ic] = npy.where(nn>0, cov/npy.clip(nn, 1, nt), 0.)
+    return cc
+
+
+def steof_lag_products(steof, nwindow):
+    """Lagged cross-products of ST-EOFs
+
+    :Params:
+
+        - **steof**: ST-EOFs ``(nchan*nwindow,nmode)``.
+        - **nwindow**: Window size.
+
+    :Returns: A ``(nmode,nchan,nchan,2*nwindow-1)`` array ``qq`` where
+        ``qq[m,i,j,nwindow-1+d]`` is the sum over ``w`` of the
+        products of mode ``m`` at channel ``i`` and lag ``w`` with
+        mode ``m`` at channel ``j`` and lag ``w+d``.
+        Hence, for a covariance matrix ``cov`` of MSSA and its lagged
+        covariances ``cc`` (:func:`lagged_covariances`), the product
+        ``steof[:,m].T.cov.steof[:,m]`` is ``(cc*qq[m]).sum()``.
+    """
+    nmode = steof.shape[1]
+    nchan = steof.shape[0]/nwindow
+    nfft = _get_nfft_(2*nwindow-1)
+    lags = _get_lags_(nfft, nwindow)
+    fsteof = npy.fft.rfft(steof.T.reshape(nmode, nchan, nwindow), nfft, axis=2)
+    qq = npy.zeros((nmode, nchan, nchan, 2*nwindow-1))
+    for im in xrange(nmode):
+        qq[im] = npy.fft.irfft(fsteof[im, :, None].conj()*fsteof[im, None],
+            nfft, axis=2)[..., lags]
+    return qq
+
+
+def mssa_mcev(surrogates, steof, nwindow, qq=None, batchsize=None):
+    """Fake MSSA eigenvalues of gap-free surrogate data
+
+    The diagonal of ``steof.T.cov.steof``, where ``cov`` is
+    the MSSA covariance matrix of each surrogate, is computed
+    from the lagged covariances of surrogates and the lagged
+    products of ST-EOFs (:func:`steof_lag_products`), so that no
+    covariance matrix is formed. Surrogates are processed by batches
+    with FFTs.
+
+    :Params:
+
+        - **surrogates**: Array ``(nsurr,nchan,nt)``.
+        - **steof**: ST-EOFs ``(nchan*nwindow,nmode)``.
+        - **nwindow**: Window size.
+        - **qq**, optional: Precomputed lagged products of ST-EOFs.
+        - **batchsize**, optional: Number of surrogates processed at once,
+          which defaults to a value that limits temporary arrays
+          to about 64 MB.
+
+    :Returns: A ``(nsurr,nmode)`` array.
+    """
+    nsurr, nchan, nt = surrogates.shape
+    if qq is None:
+        qq = steof_lag_products(steof, nwindow)
+    nfft = _get_nfft_(nt+nwindow-1)
+    lags = _get_lags_(nfft, nwindow)
+    nn = (nt-npy.abs(npy.arange(1-nwindow, nwindow))).astype('d')
+    qq = qq/nn # Normalisation of covariances
+    if batchsize is None:
+        batchsize = max(1, 2**23/(nchan**2*nfft))
+    mcev = npy.zeros((nsurr, qq.shape[0]))
+    for i0 in xrange(0, nsurr, batchsize):
+        sl = slice(i0, min(i0+batchsize, nsurr))
+        anom = surrogates[sl]-surrogates[sl].mean(axis=2)[..., None]
+        fanom = npy.fft.rfft(anom, nfft, axis=2)
+        del anom
+        cc = npy.fft.irfft(fanom[:, :, None].conj()*fanom[:, None], nfft,
+            axis=3)[..., lags]
+        del fanom
+        mcev[sl] = npy.tensordot(cc, qq, axes=([1, 2, 3], [1, 2, 3]))
+        del cc
+    return mcev
+
+
+def toeplitz_expand(cc):
+    """Expand lagged covariances to a block-Toeplitz covariance matrix
+
+    :Params:
+
+        - **cc**: Lagged covariances as returned by
+          :func:`lagged_covariances`.
+
+    :Returns: A ``(nchan*nwindow,nchan*nwindow)`` array.
+    """
+    nchan = cc.shape[0]
+    nwindow = (cc.shape[2]+1)/2
+    iw = npy.arange(nwindow)
+    lags = nwindow-1+iw[None, :]-iw[:, None]
+    cov = cc[:, :, lags].transpose(0, 2, 1, 3)
+    return npy.asfortranarray(cov.reshape((nchan*nwindow, )*2))
+
+
+def stcov(pdata, nwindow, mv=default_missing_value, method='auto'):
+    """Block-Toeplitz covariance matrix of MSSA
+
+    :Params:
+
+        - **pdata**: Packed data ``(nchan,nt)``.
+        - **nwindow**: Window size.
+        - **method**, optional: Computation method:
+
+            - ``"auto"``: ``"fft"`` when ``nwindow`` is at least
+              :data:`stcov_fft_min_window`, else ``"gemm"``. Both cost
+              the same number of channel pairs, so only the window
+              matters.
+            - ``"loop"``: One dot product per element
+              (:f:func:`sl_stcov` with ``method=1``).
+            - ``"gemm"``: One GEMM per lag
+              (:f:func:`sl_stcov` with ``method=2``).
+            - ``"fft"``: Lagged covariances computed with FFTs
+              (:func:`lagged_covariances`) and expanded
+              with :func:`toeplitz_expand`.
+
+    :Returns: A fortran ordered ``(nchan*nwindow,nchan*nwindow)`` array.
+    """
+    if method=='auto':
+        method = 'fft' if nwindow>=stcov_fft_min_window else 'gemm'
+    if method=='fft':
+        return toeplitz_expand(lagged_covariances(pdata, nwindow, mv))
+    if method not in stcov_methods:
+        raise SpanlibError('Invalid stcov method: %s. Please choose one of: %s'
+            %(method, ', '.join(['auto', 'fft']+sorted(stcov_methods))))
+    import _core
+    return _core.stcov(npy.asfortranarray(pdata, dtype='d'), nwindow, mv,
+        method=stcov_methods[method])
+
+
+
+class STCovOperator(object):
+    """Matrix-free block-Toeplitz covariance matrix of MSSA
+
+    The lagged covariances are stored in the spectral domain, and
+    the operator is applied with FFT convolutions, so that memory scales
+    as ``nchan**2*nwindow`` instead of ``(nchan*nwindow)**2``.
+    The dense equivalent is the matrix computed by :f:func:`sl_stcov`.
+
+    :Params:
+
+        - **pdata**: Packed data ``(nchan,nt)``.
+        - **nwindow**: MSSA window size.
+    """
+    def __init__(self, pdata, nwindow, mv=default_missing_value):
+        self.nchan = pdata.shape[0]
+        self.nwindow = nwindow
+        self.shape = (self.nchan*nwindow, )*2
+        cc = lagged_covariances(pdata, nwindow, mv)
+        self.trace = nwindow*npy.trace(cc[:, :, nwindow-1])
+
+        # Circulant embedding of the kernel cov[i,j](w1-w2)
+        self._nfft = 2**int(npy.ceil(npy.log2(2*nwindow-1)))
+        kernel = npy.zeros((self.nchan, self.nchan, self._nfft))
+        kernel[:, :, :nwindow] = cc[:, :, nwindow-1::-1]
+        if nwindow>1:
+            kernel[:, :, 1-nwindow:] = cc[:, :, :nwindow-1:-1]
+        del cc
+        self._fkernel = npy.fft.rfft(kernel, axis=2)
+
+    def matvec(self, vv):
+        """Apply the operator to a ``(nchan*nwindow,nv)`` array"""
+        vv = npy.asarray(vv).reshape(self.nchan, self.nwindow, -1)
+        fvv = npy.fft.rfft(vv, self._nfft, axis=1)
+        fvv = npy.einsum('ijf,jfk->ifk', self._fkernel, fvv)
+        return npy.fft.irfft(fvv, self._nfft, axis=1)[:, :self.nwindow].reshape(
+            self.shape[0], -1)
+
+
+def lanczos_mssa(pdata, nwindow, nkeep, mv=default_missing_value, v0=None,
+        **kwargs):
+    """Matrix-free MSSA of packed data
+
+    The leading eigen pairs of the block-Toeplitz covariance matrix
+    are computed with :func:`block_eigsh` applied to a
+    :class:`STCovOperator`, so that this matrix is never formed.
+
+    :Params:
+
+        - **pdata**: Packed data ``(nchan,nt)``.
+        - **nwindow**: Window size.
+        - **nkeep**: Number of modes.
+        - **v0**, optional: Initial ST-EOFs.
+        - Other keywords are passed to :func:`block_eigsh`.
+
+    :Returns: ``steof, ev, ev_sum`` where ``steof`` has the same layout
+        as ST-EOFs computed by :f:func:`sl_mssa`.
+    """
+    op = STCovOperator(pdata, nwindow, mv)
+    ev, steof = block_eigsh(op.matvec, op.shape[0], nkeep, v0=v0, **kwargs)
+
+    # First point of an EOF is >= 0
+    steof[:, steof[0]<0] *= -1
+
+    return npy.asfortranarray(steof), ev, op.trace
+
+
+def trajectory_view(anom, nwindow):
+    """Zero-copy view of the MSSA trajectory matrix
+
+    :Params:
+
+        - **anom**: C-contiguous array ``(nchan,nt)``.
+        - **nwindow**: Window size.
+
+    :Returns: A read-only ``(nchan,nwindow,nt-nwindow+1)`` view ``traj``
+        where ``traj[i,j,t]`` is ``anom[i,t+j]``.
+    """
+    nchan, nt = anom.shape
+    traj = npy.lib.stride_tricks.as_strided(anom,
+        shape=(nchan, nwindow, nt-nwindow+1),
+        strides=(anom.strides[0], anom.strides[1], anom.strides[1]))
+    traj.flags.writeable = False
+    return traj
+
+
+def trajectory_mssa(pdata, nwindow, nkeep, mv=default_missing_value,
+        oversampling=10, niter=4, zerofill=0, seed=None):
+    """MSSA from a randomized truncated SVD of the trajectory matrix
+
+    The trajectory matrix is never copied: its products are
+    computed lag by lag on the strided view given by
+    :func:`trajectory_view`. ST-EOFs and ST-PCs are respectively
+    the left and scaled right singular vectors.
+
+    :Params:
+
+        - **pdata**: Packed data ``(nchan,nt)``.
+        - **nwindow**: Window size.
+        - **nkeep**: Number of modes.
+        - **oversampling**, optional: Number of extra random vectors.
+        - **niter**, optional: Number of power iterations.
+        - **zerofill**, optional: See :func:`iter_anomalies`.
+        - **seed**, optional: See :func:`get_random_state`.
+
+    :Returns: ``steof, stpc, ev, ev_sum``.
+
+    .. note:: Eigenvalues are those of the trajectory covariance matrix,
+        which slightly differs from the block-Toeplitz estimate
+        of :f:func:`sl_mssa`, and missing values are considered as
+        zero anomalies. PCs are thus only equal to projections
+        computed by :f:func:`sl_mssa_getec` for gap-free data.
+    """
+    nchan, nt = pdata.shape
+    nk = nt-nwindow+1
+    nsteof = nchan*nwindow
+    rng = get_random_state(seed)
+    sl, anom, valid = iter_anomalies(pdata, mv, zerofill=zerofill).next()
+    del valid
+    traj = trajectory_view(anom, nwindow)
+
+    def xdot(vv): # X.V
+        out = npy.empty((nchan, nwindow, vv.shape[1]))
+        for iw in xrange(nwindow):
+            out[:, iw] = npy.dot(traj[:, iw], vv)
+        return out.reshape(nsteof, -1)
+
+    def xtdot(uu): # X^T.U
+        uu = uu.reshape(nchan, nwindow, -1)
+        out = npy.zeros((nk, uu.shape[2]))
+        for iw in xrange(nwindow):
+            out += npy.dot(traj[:, iw].T, uu[:, iw])
+        return out
+
+    # Range finder with power iterations
+    nkeep = min(nkeep, nsteof, nk)
+    nrand = min(nkeep+oversampling, nsteof, nk)
+    qq = npy.linalg.qr(xdot(rng.standard_normal((nk, nrand))))[0]
+    for i in xrange(niter):
+        zz = npy.linalg.qr(xtdot(qq))[0]
+        qq = npy.linalg.qr(xdot(zz))[0]
+
+    # SVD of the projection B = Q^T.X
+    ub, ss, vt = npy.linalg.svd(xtdot(qq).T, full_matrices=False)
+    steof = npy.dot(qq, ub[:, :nkeep])
+    stpc = vt[:nkeep].T*ss[:nkeep]
+    ev = ss[:nkeep]**2/nk
+
+    # Total variance: each time step appears in up to nwindow lags
+    it = npy.arange(nt)
+    nlags = npy.minimum(it, nwindow-1)-npy.maximum(0, it-nk+1)+1
+    ev_sum = ((anom**2).sum(axis=0)*nlags).sum()/nk
+
+    # First point of an EOF is >= 0
+    neg = steof[0]<0
+    steof[:, neg] *= -1
+    stpc[:, neg] *= -1
+
+    return npy.asfortranarray(steof), npy.asfortranarray(stpc), ev, ev_sum
+
+
+def _iter_space_chunks_(data, mv, chunksize, zerofill):
+    """Iterate over anomalies of spatial chunks of a ``(nt,ns)`` array"""
+    ns = data.shape[1]
+    for i0 in xrange(0, ns, chunksize):
+        sl = slice(i0, min(i0+chunksize, ns))
+        block = npy.array(data[:, sl], dtype='d').T
+        block[npy.isnan(block)] = mv
+        anom, valid = iter_anomalies(block, mv, zerofill=zerofill).next()[1:]
+        yield sl, anom, valid
+
+
+def ooc_pca(data, nkeep, mv=default_missing_value, chunksize=1000, out=None,
+        zerofill=0):
+    """Out-of-core PCA with T-EOFs of a time-first array
+
+    It is intended for memory-mapped or file-backed arrays with far
+    more channels than time steps, which are read by spatial chunks.
+    The ``(nt,nt)`` covariance matrix of time steps and its valid pair
+    counts are accumulated chunk by chunk, and EOFs are back-projected
+    chunk by chunk into ``out``, like T-EOFs of :f:func:`sl_pca`.
+    Peak memory is thus about ``2*nt**2+3*chunksize*nt`` values.
+
+    :Params:
+
+        - **data**: Array-like ``(nt,...)`` such as a :class:`numpy.memmap`,
+          where missing values are NaNs or equal to ``mv``.
+          It is not scaled.
+        - **nkeep**: Number of modes.
+        - **chunksize**, optional: Number of channels read at once.
+        - **out**, optional: Writable ``(ns,nkeep)`` array-like,
+          like a :class:`numpy.memmap`, where EOFs are stored.
+        - **zerofill**, optional: See :func:`iter_anomalies`.
+
+    :Returns: ``eof, pc, ev, ev_sum`` where ``eof`` is ``out`` when given.
+    """
+    nt = data.shape[0]
+    data = data.reshape(nt, -1)
+    ns = data.shape[1]
+    nkeep = min(nkeep, nt)
+    chunks = lambda: _iter_space_chunks_(data, mv, chunksize, zerofill)
+
+    # Covariances of time steps
+    gram = npy.zeros((nt, nt))
+    counts = npy.zeros((nt, nt))
+    tss = npy.zeros(nt)
+    ev_sum = 0.
+    for sl, anom, valid in chunks():
+        gram += npy.dot(anom.T, anom)
+        counts += npy.dot(valid.T.astype('d'), valid)
+        tss += (anom**2).sum(axis=0)
+        count = valid.sum(axis=1)
+        ev_sum += ((anom**2).sum(axis=1)[count>0]/count[count>0]).sum()
+    tcount = counts.diagonal().copy()
+    tvalid = tcount>0
+    gram = npy.where(counts>0, gram/npy.clip(counts, 1, None), 0.)
+    del counts
+
+    # Diagonalisation
+    ev, teof = npy.linalg.eigh(gram)
+    del gram
+    ev = npy.clip(ev[::-1][:nkeep], 0., None)
+    teof = teof[:, ::-1][:, :nkeep]
+    ev *= ev_sum/(tss[tvalid]/tcount[tvalid]).sum()
+
+    # Back-projection of time EOFs onto data, mode after mode
+    if out is None:
+        out = npy.empty((ns, nkeep))
+    norm = npy.zeros(nkeep)
+    sign = None
+    for sl, anom, valid in chunks():
+        eof = npy.zeros((anom.shape[0], nkeep))
+        for im in xrange(nkeep):
+            wsum = npy.dot(valid, teof[:, im]**2)
+            eof[:, im] = npy.dot(anom, teof[:, im])/npy.where(wsum>0, wsum, 1.)
+            anom -= npy.where(valid, npy.outer(eof[:, im], teof[:, im]), 0.)
+        cvalid = valid.any(axis=1)
+        norm += (eof[cvalid]**2).sum(axis=0)
+        if sign is None and cvalid.any(): # First valid channel is >= 0
+            sign = npy.where(eof[cvalid.argmax()]<0, -1., 1.)
+        eof[~cvalid] = mv
+        out[sl] = eof
+    norm = npy.sqrt(norm)
+    if sign is None:
+        sign = npy.ones(nkeep)
+    factor = sign/npy.where(norm>0, norm, 1.)
+    for i0 in xrange(0, ns, chunksize):
+        sl = slice(i0, min(i0+chunksize, ns))
+        eof = npy.asarray(out[sl])
+        out[sl] = npy.where(get_valid(eof, mv), eof*factor, mv)
+
+    # PCs are scaled time EOFs
+    pc = npy.where(tvalid[:, None], teof*norm*sign, mv)
+
+    return out, npy.asfortranarray(pc), ev, ev_sum
+
+
+def truncation_rss(pdata, eof, pc, mv=default_missing_value):
+    """Residual sums of squares of truncated PCA reconstructions
+
+    Modes are added one by one to the reconstruction, so the cost
+    is that of a single reconstruction of all modes.
+
+    :Params:
+
+        - **pdata**: Packed data ``(ns,nt)``.
+        - **eof**: EOFs ``(ns,nmode)``.
+        - **pc**: PCs ``(nt,nmode)``.
+
+    :Returns: ``rss, nvalid`` where ``rss`` is an array of residual sums
+        of squares of valid anomalies for ``1..nmode`` modes
+        and ``nvalid`` is the number of valid points.
+    """
+    sl, res, valid = iter_anomalies(pdata, mv).next()
+    eof = npy.where(get_valid(eof, mv), eof, 0.)
+    pc = npy.where(get_valid(pc, mv), pc, 0.)
+    rss = npy.zeros(eof.shape[1])
+    for im in xrange(eof.shape[1]):
+        res -= npy.outer(eof[:, im], pc[:, im])
+        rss[im] = (res[valid]**2).sum()
+    return rss, valid.sum()
+
+
+def gcv_score(rss, nrow, ncol, nvalid=None):
+    """Generalized cross-validation (GCV) score of truncations of a PCA
+
+    It approximates the leave-one-out reconstruction error of data
+    from the residual sum of squares and the number of degrees of freedom
+    of a truncation to ``k`` modes, as in Josse and Husson (2012,
+    Selecting the number of components in principal component analysis
+    using cross-validation approximations, Comput. Stat. Data Anal.)::
+
+        GCV(k) = N rss(k) / (N - p - n k - p k + k**2 + k)**2
+
+    where ``N=n p`` without missing values.
+    It needs no leave-out reconstructions.
+
+    :Params:
+
+        - **rss**: Residual sums of squares of ``k=1..nmode`` modes
+          (see :func:`truncation_rss`).
+        - **nrow**, **ncol**: Number of channels ``p`` and of
+          time steps ``n`` of the decomposed matrix.
+        - **nvalid**, optional: Number of valid values ``N``.
+
+    :Returns: An array of scores for ``k=1..nmode`` modes,
+        set to ``inf`` when there are not enough degrees of freedom.
+    """
+    rss = npy.clip(npy.asarray(rss, 'd'), 0., None)
+    k = npy.arange(1., rss.size+1)
+    p, n = float(nrow), float(ncol)
+    if nvalid is None:
+        nvalid = n*p
+    den = nvalid-p-n*k-p*k+k**2+k
+    return npy.where(den>0, nvalid*rss/npy.where(den>0, den, 1.)**2, npy.inf)
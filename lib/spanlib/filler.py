@@ -21,9 +21,22 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 #################################################################################
 
+import os
+import sys
+import time
+import zlib
+import cPickle
 import numpy as npy
-from .util import Logger, broadcast, SpanlibIter, dict_filter, SpanlibError
+from multiprocessing import Pool, cpu_count
+try:
+    import resource
+except ImportError: # not unix
+    resource = None
+from .util import (Logger, broadcast, SpanlibIter, dict_filter, SpanlibError,
+    set_blas_threads)
 from .analyzer import Analyzer, default_missing_value
+from .engines import (get_random_state, get_valid, iter_anomalies,
+    truncation_rss, gcv_score)
 from .data import has_cdat_support, cdms2_isVariable
 import _core
 #import pylab as P
@@ -60,7 +73,7 @@ class Filler(Logger):
             self.warning("No gap to fill")
 
         # Keep original data safe
-        self._set_field_(span.stacked_data, 'orig')
+        self._set_field_(span.stacked_data, 'orig', std=True)
 
         # Start filling?
         if run: self.fill(**kwargs)
@@ -82,7 +95,9 @@ class Filler(Logger):
 
     def fill(self, nitermax=20, errchmax=-0.01, fillmode='masked', testmode='crossvalid',
         mssa=True, full=True, cvregen=False, nreanapca=3, nreanamssa=2, errchmaxreana=-1,
-        remode=False, **kwargs):
+        remode=False, warmstart=False, nfold=None, nproc=1, cvonly=False,
+        increc=True, ecaccel=None, checkpoint=None, resume=False, deadline=None,
+        callback=None, gcv=False, **kwargs):
         """Run the filler with a convergence loop
 
         Results are accessible in the following attributes:
@@ -95,6 +110,14 @@ class Filler(Logger):
 
             Data filled with :attr:`filtered`
 
+        .. attribute:: stage
+
+            Last stage reached by the loop, as a :class:`dict` with keys
+            ``anamode`` (2: cross-validation, 1: self-validation, 0: normal),
+            ``analysis`` ("pca" or "mssa"), ``reanalysis``, ``nmodes``,
+            ``iteration`` (of the EC convergence loop), ``error``
+            (current error in %), ``elapsed`` (seconds) and ``timedout``.
+
         :Parameters:
 
             - **fillmode**: "zeros" or "masked"
@@ -103,6 +126,60 @@ class Filler(Logger):
             - **npca**: Number of PCA modes (see :class:`Analyzer`)
             - **nmssa**: Number of MSSA modes (see :class:`Analyzer`)
             - **cvfield_level**: Percent of data used for cross-validation.
+            - **warmstart**: Compute EOFs with an iterative eigen solver
+              starting from EOFs of the previous analysis, when available
+              (see :meth:`Analyzer.pca`). It is faster on reanalyses,
+              but results are approximations of those of the default
+              exact solvers.
+            - **nfold**: Number of folds of a k-fold cross-validation.
+              Cross-validation is performed independently on ``nfold``
+              sets of disjoint cross-validation points, and errors
+              are averaged over folds to choose the number of modes.
+            - **nproc**: Number of processes sharing the folds
+              (all CPUs if ``None`` or lower than 1).
+            - **cvonly**: Only perform the cross-validation pass.
+            - **increc**: When testing an increasing number of modes,
+              add the reconstruction of the new mode to that of previous
+              modes at the first step of the convergence loop,
+              instead of reconstructing all modes again.
+            - **ecaccel**: Acceleration of the convergence loop of
+              expansion coefficients, applied to values that fill gaps:
+
+                - ``None``: Plain fixed-point iteration.
+                - ``"anderson"``: Anderson mixing of the last
+                  ``ecaccel_depth`` (default 3) steps.
+                - ``"relax"``: Over-relaxation with a factor
+                  ``ecaccel_omega`` (default 1.5).
+
+              When the error increases after an accelerated step,
+              the step is discarded and the iteration restarts with a plain step.
+            - **checkpoint**: Directory where the state of the loop is saved
+              after each mode trial, reanalysis and analysis type, at most
+              every ``checkpoint_interval`` seconds (default 0)
+              except for analysis types.
+              If it is a :class:`dict`, states are stored in it by stage
+              instead of being saved to disk.
+            - **resume**: Restart from the last state saved in the ``checkpoint``
+              directory, without computing again the previous stages.
+            - **deadline**: Maximal duration of the loop in seconds.
+              When it is reached, the loop stops and the results are those
+              of the best number of modes found so far, and :attr:`stage`
+              tells where the loop stopped.
+              The deadline is checked after each step of the EC convergence
+              loop and before each new analysis.
+            - **callback**: Function called after each step of the
+              EC convergence loop with :attr:`stage` as single argument.
+            - **gcv**: Use the generalized cross-validation score computed
+              from eigenvalues (see :func:`~spanlib.engines.gcv_score`)
+              to select the numbers of modes tried by cross-validation,
+              instead of trying all of them:
+
+                - ``False``: Try all numbers of modes.
+                - ``True``: Only try the lowest number of modes whose
+                  score is within ``gcv_tol`` (default 20%) of the best score,
+                  which replaces the search.
+                - An integer ``n``: Only try ``n`` consecutive numbers of
+                  modes around it, which confirms it by true cross-validation.
             - Other parameters are passed to :class:`Analyzer`
 
         :Returns:
@@ -115,8 +192,26 @@ class Filler(Logger):
         # Parameters
         self._kwfill.update(nitermax=nitermax, errchmax=errchmax, fillmode=fillmode,
             testmode=testmode, mssa=mssa, full=full, cvregen=cvregen,
-            nreanapca=nreanapca, nreanamssa=nreanamssa, **kwargs)
+            nreanapca=nreanapca, nreanamssa=nreanamssa, warmstart=warmstart,
+            nfold=nfold, nproc=nproc, increc=increc, ecaccel=ecaccel, gcv=gcv, **kwargs)
         kwgencv = dict_filter(kwargs, 'cvfield_')
+        kwecaccel = dict_filter(kwargs, 'ecaccel_')
+        kwgcv = dict_filter(kwargs, 'gcv_')
+        self._checkpoint = checkpoint
+        self._checkpoint_interval = dict_filter(kwargs, 'checkpoint_').get('interval', 0)
+        self._checkpoint_time = time.time()
+        self._start_time = time.time()
+        self._deadline = None if deadline is None else self._start_time+deadline
+        self._callback = callback
+        self._timedout = False
+        self.stage = None
+        self._fit_error = self._update_pcs = None
+        if gcv is not False and nfold and nfold>1:
+            raise FillerError('GCV selection of modes is not available '
+                'with a k-fold cross-validation')
+        if ecaccel is not None and ecaccel not in ('anderson', 'relax'):
+            raise FillerError('Invalid EC acceleration: %s. Please choose one of: '
+                'anderson, relax'%ecaccel)
         span = self.span
         if fillmode==0:
             fillmode = "none"
@@ -146,16 +241,62 @@ class Filler(Logger):
             anamodes = [2, 0]
         else:
             anamodes = [1]
+        if cvonly:
+            anamodes = anamodes[:1]
 
         # Loop on analysis modes
         self._nmodes = {}
         self._errors = {}
+        self._nreana = nreana
+        imode = err = last_reana_err = last_mode_err = None
+
+        # Random draws of the filler, saved in checkpoints
+        self._rng = npy.random.RandomState(npy.random.randint(0, 2**31-1))
+
+        # Resume from checkpoint
+        self._checkpoint_sig = self._get_signature_(fillmode=fillmode,
+            testmode=testmode, mssa=mssa, full=full, nreana=nreana.copy(),
+            nfold=nfold, nitermax=nitermax, errchmax=errchmax, gcv=gcv,
+            increc=increc, ecaccel=ecaccel, cvfield=kwgencv)
+        # - stage: (analysis mode, analysis type, reanalysis, mode trial)
+        stage = None
+        if resume and checkpoint is not None:
+            loop = self._load_checkpoint_()
+            if loop is not None:
+                stage = loop['stage']
+                imode, err = loop['imode'], loop['err']
+                last_reana_err = loop['last_reana_err']
+                last_mode_err = loop['last_mode_err']
+                nreana = self._nreana
+                analyzes = self._analyzes
+        resumed = lambda *st: stage is not None and st<=stage
+        inf = npy.inf
+
+        if anamodes[0]==2 and nfold and nfold>1: # k-fold cross-validation
+            if not resumed(0, inf, inf, inf):
+                self._run_cvfolds_(nfold, nproc, errchmax, kwgencv.get('seed'))
+                nreana.update(dict([(ana, len(nmodes)) for ana, nmodes
+                    in self._nmodes.items()]))
+                self._save_checkpoint_((0, inf, inf, inf), force=True, imode=imode,
+                    err=err, last_reana_err=last_reana_err, last_mode_err=last_mode_err)
+            anamodes = anamodes[1:]
         for anamode in anamodes:
+            if self._check_deadline_():
+                break
             self.debug('Analysis mode: '+['NORMAL', 'SELF-VALIDATION', 'CROSS-VALIDATION'][anamode])
+            iam = int(anamode==0)
 
             # Loop on analysis types (PCA, MSSA)
-            self._errors[anamode] = {}
+            self._errors.setdefault(anamode, {})
             for self._ana in analyzes:
+                ja = int(self._ana=='mssa')
+                if resumed(iam, ja, inf, inf):
+                    continue
+                if ja and self._check_deadline_(): # keep PCA only
+                    self._ana = analyzes[0]
+                    self._analyzes = analyzes[:ja]
+                    break
+                resuming = stage is not None and stage[:2]==(iam, ja)
                 self.debug(' Running '+self._ana.upper())
 
                 # Update the number of pre-PCA modes for MSSA
@@ -174,27 +315,40 @@ class Filler(Logger):
                         analyzes.remove('mssa')
                     self._nomssaneeded = True
                     self._nmodes.setdefault(self._ana, [[self.span.nmssa]])
+                    self._save_checkpoint_((iam, ja, inf, inf), force=True,
+                        imode=imode, err=err, last_reana_err=last_reana_err,
+                        last_mode_err=last_mode_err)
                     break
 
                 # - data to fill
                 if anamode==2: # cross-validation
-                    self._gen_cvfield_(**kwgencv)
+                    if not resuming:
+                        self._gen_cvfield_(**kwgencv)
                     self._link_field_('cvfield', 'current')
                 else: # normal, self-validation
                     self._link_field_('ref', 'current')
 
                 # Initialize raw data
-                self._set_raw_(self._currentm.data)
+                if not resuming:
+                    self._set_raw_(self._current_data)
 
                 # Reanalyses loop
-                self._errors[anamode][self._ana] = []
-                last_reana_err = None
+                self._best_reana = None
+                if not resuming:
+                    self._errors[anamode][self._ana] = []
+                    last_reana_err = None
                 for ira in xrange(nreana[self._ana]):
+                    if resumed(iam, ja, ira, inf):
+                        continue
+                    inreana = resumed(iam, ja, ira, -1) # some modes already tried
+                    if ira and not inreana and self._check_deadline_():
+                        break
 
                     self.debug('  Analysis (%i/%i)'%(ira+1, nreana[self._ana]))
 
                     # Run analysis to get EOFs
-                    self._get_func_()(force=True)
+                    if not inreana:
+                        self._get_func_()(force=True, warmstart=warmstart)
 
                     # CV loop on EC estimation (not for PCA with T-EOF)?
                     ecloop = self._ana!= 'pca' or not self.span.useteof
@@ -206,21 +360,28 @@ class Filler(Logger):
                     trymodes = anamode!=0
                     if len(amodes)<ira+1:
                         if remode or ira==0:
-                            amodes.append(range(getattr(self.span, 'n'+self._ana))) # test all
+                            amodes.append(self._get_trymodes_(gcv, **kwgcv)) # test all or best GCV
                         else:
                             trymodes = False
                             amodes.append(amodes[0]) # same as for first analysis
 
                     # Loop on the number of modes
-                    last_mode_err = None
+                    if not inreana:
+                        last_mode_err = None
+                        self._errors[anamode][self._ana].append([])
                     self._last_pcs_mode = {}
-                    self._errors[anamode][self._ana].append([])
+                    self._reccum = None
                     for im, imode in enumerate(amodes[ira]):
+                        if resumed(iam, ja, ira, im):
+                            continue
                         verb = '   Reconstructing' if not trymodes else '   Trying'
                         self.debug(verb+' with %i mode%s'%(imode+1, 's'*(imode>0)))
 
                         # Inits
-                        self._recm = default_missing_value
+                        self._rec = default_missing_value
+                        self._recfill = None
+                        self._ecaccel_hist = []
+                        self._ecaccel_active = False
                         if hasattr(self, '_necmiss'): del self._necmiss
                         if hasattr(self, '_necmiss_old'): del self._necmiss_old
                         last_iter_err = None
@@ -239,12 +400,23 @@ class Filler(Logger):
                             if anamode==1 and istep>0:
                                 self._last_pcs_iter[self._ana] = \
                                     getattr(self.span, '_%s_raw_pc'%self._ana)
-                            self._rec_(imode)
+                            if ecaccel and ecloop and istep>0:
+                                self._accelerate_(ecaccel, **kwecaccel)
+                            rec_last = self._rec
+                            if self._ecaccel_active: # for a rejection
+                                pcs_last = getattr(self.span,
+                                    '_%s_raw_pc'%self._ana).copy()
+                            self._rec_(imode, istep, increc)
 
                             # Current error
                             err = self._get_error_(anamode)
                             self._errors[anamode][self._ana][-1][-1].append(err)
 
+                            # Progress and deadline
+                            self._set_stage_(anamode, ira, imode, istep, err)
+                            if self._check_deadline_():
+                                break
+
                             # Check MSSA full filling
                             if self._ana=='mssa' and full:
                                 nem, nemch = self._get_necmiss_()
@@ -260,6 +432,16 @@ class Filler(Logger):
                                 if istep>0 and last_iter_err is not None:
                                     errch = err - last_iter_err
                                     self.debug('    Error change: %g%%'%errch)
+                                    if errch>0 and self._ecaccel_active:
+                                        self.debug('    Error change > 0 after accelerated '
+                                            'step -> back to plain step')
+                                        self._errors[anamode][self._ana][-1][-1].pop()
+                                        setattr(self.span, '_%s_raw_pc'%self._ana,
+                                            pcs_last)
+                                        self._rec = rec_last
+                                        self._recfill_last = default_missing_value
+                                        err = last_iter_err
+                                        continue
                                     if errch>=errchmax:
                                         if errch>0:
                                             self.debug('  Error change > 0: unstable mode -> step skipped')
@@ -281,6 +463,14 @@ class Filler(Logger):
                         else:
                             self.debug('  Reached max number of iterations for EC convergence loop')
 
+                        # Deadline: keep the best number of modes
+                        if self._timedout:
+                            if anamode!=0:
+                                if im and err>last_mode_err:
+                                    imode = amodes[ira][im-1]
+                                amodes[ira] = [imode]
+                            break
+
                         # Check mode truncature error
                         if anamode!=0 and im:
                             if skiplast:
@@ -288,9 +478,9 @@ class Filler(Logger):
                             else:
                                 errch = err-last_mode_err
                                 self.debug('   Error change between %i and %i modes: %g'%
-                                    (imode, imode+1, errch))
+                                    (amodes[ira][im-1]+1, imode+1, errch))
                             if errch>errchmax:
-                                imode -= 1
+                                imode = amodes[ira][im-1]
                                 self.debug('   Best number of %s modes: %i'%(self._ana.upper(), imode+1))
                                 if anamode==1:
                                     setattr(self.span, '_%s_raw_pc'%self._ana,
@@ -300,16 +490,26 @@ class Filler(Logger):
                                         self._errors[anamode][self._ana][-1][-1] *= -1
                                 break
                         last_mode_err = err
+                        self._save_checkpoint_((iam, ja, ira, im), imode=imode,
+                            err=err, last_reana_err=last_reana_err,
+                            last_mode_err=last_mode_err)
                     else:
                         if trymodes:
                             self.debug('   Reached max number of %s modes (%i)'%(self._ana.upper(), imode+1))
+                    if self._timedout:
+                        if self._best_reana and self._best_reana[0]<err:
+                            err, imode = self._best_reana[:2]
+                            self._restore_reana_(self._best_reana[2])
+                            del amodes[ira:]
+                            self.debug('   Recovered results of the last analysis')
+                        break
 
                     # -> NMODES
 
                     # Refill for next reana
                     if ira<nreana[self._ana]-1:
                         self.debug('  Filling for next reanalysis')
-                        self._set_raw_(self._currentm.filled(self._recm.data))
+                        self._set_raw_(self._fill_gaps_())
 
                     # Store optimal number of modes info for normal analysis after cross-validation
                     if anamode==2:
@@ -325,11 +525,19 @@ class Filler(Logger):
                             break
 
                     last_reana_err = err
+                    if self._deadline is not None:
+                        self._best_reana = err, imode, self._backup_reana_()
+                    self._save_checkpoint_((iam, ja, ira, inf), imode=imode,
+                        err=err, last_reana_err=last_reana_err,
+                        last_mode_err=last_mode_err)
 
                 else:
                     self.debug('  Reached max number of reanalyzes for %s (%i)'%(self._ana.upper(), ira+1))
 
                 # -> REANA
+                if self._timedout:
+                    self._analyzes = analyzes[:ja+1]
+                    break
 
                 # Store number of reanalyzes for normal analysis after cross-validation
                 if anamode==2:
@@ -339,13 +547,282 @@ class Filler(Logger):
                 # Store PCA pcs for MSSA
                 if self._ana=='pca' and 'mssa' in analyzes:
                     self.span.prepca = imode+1
-                    self._set_field_(self.span._pca_raw_pc[:, :imode+1].T, 'pcs', mean=True, std=False)
+                    self._set_field_(self.span._pca_raw_pc[:, :imode+1].T, 'pcs', mean=True, std=True)
+
+                self._save_checkpoint_((iam, ja, inf, inf), force=True, imode=imode,
+                    err=err, last_reana_err=last_reana_err, last_mode_err=last_mode_err)
 
             # -> PCA/MSSA
 
         # -> NORM/SELF/CV
 
 
+    def _get_trymodes_(self, gcv=False, tol=0.2):
+        """Get the list of numbers of modes (minus one) to try for the current analysis
+
+        :Params:
+
+            - **gcv**, optional: ``False`` to try all modes, ``True`` or
+              an integer ``n`` to try only the number of modes selected with
+              :func:`~spanlib.engines.gcv_score` or ``n`` numbers of modes
+              around it. The selected number of modes is the lowest one
+              whose score is within ``tol`` (relative) of the minimal score.
+        """
+        nmode = getattr(self.span, 'n'+self._ana)
+        if gcv is False or gcv is None:
+            return range(nmode)
+        span = self.span
+        if self._ana=='pca':
+            pdata = span.stacked_data
+            nrow, ncol = pdata.shape
+            rss, nvalid = truncation_rss(pdata, span._pca_raw_eof[:, :nmode],
+                span._pca_raw_pc[:, :nmode])
+        else: # residuals of the trajectory matrix from PC norms
+            nrow = span.prepca*span.window
+            ncol = span._mssa_raw_pc.shape[0]
+            sl, anom, valid = iter_anomalies(span._pca_raw_pc.T[:span.prepca]).next()
+            pc = span._mssa_raw_pc[:, :nmode]
+            pc = npy.where(get_valid(pc), pc, 0.)
+            rss = span.window*(anom**2).sum()-(pc**2).sum(axis=0).cumsum()
+            nvalid = None
+        scores = gcv_score(rss, nrow, ncol, nvalid)
+        best = int(npy.nonzero(scores<=scores.min()*(1+tol))[0][0])
+        ntry = 1 if gcv is True else max(1, int(gcv))
+        im0 = min(max(best-(ntry-1)/2, 0), max(nmode-ntry, 0))
+        trymodes = range(im0, min(im0+ntry, nmode))
+        self.debug('   GCV scores: %s -> trying %s modes'%(
+            ', '.join(['%.3g'%sc for sc in scores]), ', '.join([str(im+1) for im in trymodes])))
+        return trymodes
+
+    def _set_stage_(self, anamode, ira, imode, istep, err):
+        """Update :attr:`stage` and call the progress callback"""
+        self.stage = dict(anamode=anamode, analysis=self._ana, reanalysis=ira,
+            nmodes=imode+1, iteration=istep, error=err,
+            elapsed=time.time()-self._start_time, timedout=False)
+        if self._callback is not None:
+            self._callback(self.stage.copy())
+
+    def _backup_reana_(self):
+        """Get the raw results of the current analysis"""
+        return dict([(att, getattr(self.span, att)) for att in self._checkpoint_span_atts
+            if att.startswith('_'+self._ana) and hasattr(self.span, att)])
+
+    def _restore_reana_(self, backup):
+        """Restore the raw results of an analysis saved by :meth:`_backup_reana_`"""
+        for att, val in backup.items():
+            setattr(self.span, att, val)
+        for vtype in 'pc', 'eof':
+            self.span._cleanattr_('_%s_fmt_%s'%(self._ana, vtype))
+
+    def _check_deadline_(self):
+        """Check if the deadline is reached once at least one reconstruction
+        is available, and update :attr:`stage` if so"""
+        if self._timedout:
+            return True
+        if self._deadline is None or self.stage is None or time.time()<self._deadline:
+            return False
+        self._timedout = self.stage['timedout'] = True
+        self.warning('Deadline reached -> stopping at stage: %(analysis)s, '
+            'analysis mode %(anamode)i, reanalysis %(reanalysis)i, %(nmodes)i modes, '
+            'iteration %(iteration)i'%self.stage)
+        return True
+
+    _checkpoint_atts = ['_ana', '_analyzes', '_nomssaneeded', '_nmodes', '_nreana',
+        '_errors', '_cvfold_errors', '_rec', '_rec_complete', '_cvfieldm',
+        '_cvfield_data', '_cvfield_gaps', '_cvfield_valid', '_cvfield_mean',
+        '_cvfield_kept', '_cvfield_index', '_cvfield_ana', '_pcsm', '_pcs_data',
+        '_pcs_gaps', '_pcs_valid', '_pcs_std', '_pcs_mean']
+    _checkpoint_span_atts = ['stacked_data', '_npca', '_nmssa', '_prepca', '_window',
+        '_useteof', '_pca_raw_eof', '_pca_raw_pc', '_pca_raw_ev', '_pca_ev_sum',
+        '_pca_raw_pc_mean', '_mssa_raw_eof', '_mssa_raw_pc', '_mssa_raw_ev',
+        '_mssa_ev_sum']
+    _checkpoint_file = 'filler.pkl'
+
+    def _save_checkpoint_(self, stage, force=False, **loop):
+        """Save the state of the filling loop in the checkpoint directory
+
+        :Params:
+
+            - **stage**: Last completed stage as a tuple
+              ``(analysis mode, analysis type, reanalysis, mode trial)``.
+            - **force**, optional: Save even if the last checkpoint is more
+              recent than ``checkpoint_interval``.
+            - Other keywords are local variables of the loop.
+        """
+        if self._checkpoint is None:
+            return
+        if not force and time.time()-self._checkpoint_time<self._checkpoint_interval:
+            return
+        loop['stage'] = stage
+        state = dict(loop=loop,
+            filler=dict([(att, getattr(self, att)) for att in self._checkpoint_atts
+                if hasattr(self, att)]),
+            span=dict([(att, getattr(self.span, att)) for att in self._checkpoint_span_atts
+                if hasattr(self.span, att)]),
+            signature=self._checkpoint_sig, random=self._rng.get_state())
+        if isinstance(self._checkpoint, dict): # in memory
+            self._checkpoint[stage] = cPickle.loads(cPickle.dumps(state,
+                cPickle.HIGHEST_PROTOCOL))
+            self._checkpoint_time = time.time()
+            return
+        if not os.path.exists(self._checkpoint):
+            os.makedirs(self._checkpoint)
+        path = os.path.join(self._checkpoint, self._checkpoint_file)
+        f = open(path+'.tmp', 'wb')
+        try:
+            cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(path+'.tmp', path) # atomic
+        self._checkpoint_time = time.time()
+        self.debug('Saved checkpoint at stage %s'%(stage, ))
+
+    def _get_signature_(self, **params):
+        """Get the signature of the input data and of the parameters
+        that a checkpoint must match to be resumed"""
+        span = self.span
+        sig = dict(shape=self._orig_data.shape, crc=zlib.crc32(self._orig_data),
+            npca=span.npca, useteof=span.useteof, nmssa=span.nmssa,
+            window=span.window)
+        for key, val in params.items():
+            if isinstance(val, dict):
+                val = dict([(k, zlib.crc32(npy.ascontiguousarray(v))
+                    if isinstance(v, npy.ndarray) else v) for k, v in val.items()])
+            sig[key] = val
+        return sig
+
+    def _check_signature_(self, sig, stage):
+        """Raise a :class:`FillerError` if the signature of a checkpoint
+        does not match the current data and parameters
+
+        MSSA parameters are not checked when MSSA was not started at the
+        checkpoint ``stage``, so that MSSA can be resumed from PCA.
+        """
+        inf = npy.inf
+        ignore = ('nmssa', 'window') if stage<=(0, 0, inf, inf) else ()
+        current = self._checkpoint_sig
+        diffs = [key for key in sorted(set(sig).union(current))
+            if key not in ignore and sig.get(key)!=current.get(key)]
+        if diffs:
+            raise FillerError('Checkpoint does not match the current data '
+                'and parameters (%s): cannot resume'%', '.join(diffs))
+
+    def _load_checkpoint_(self):
+        """Restore the state saved by :meth:`_save_checkpoint_`
+
+        :Returns: The local variables of the loop, or ``None``
+            if there is no checkpoint.
+        """
+        if isinstance(self._checkpoint, dict): # in memory
+            if not self._checkpoint:
+                self.warning('No checkpoint to resume from')
+                return
+            state = cPickle.loads(cPickle.dumps(self._checkpoint[max(self._checkpoint)],
+                cPickle.HIGHEST_PROTOCOL))
+        else:
+            path = os.path.join(self._checkpoint, self._checkpoint_file)
+            if not os.path.exists(path):
+                self.warning('No checkpoint to resume from in: '+self._checkpoint)
+                return
+            f = open(path, 'rb')
+            try:
+                state = cPickle.load(f)
+            finally:
+                f.close()
+        self._check_signature_(state.get('signature', {}), state['loop']['stage'])
+        for att, val in state['filler'].items():
+            setattr(self, att, val)
+        for att, val in state['span'].items():
+            setattr(self.span, att, val)
+        for vtype in 'pc', 'eof':
+            for ana in 'pca', 'mssa':
+                self.span._cleanattr_('_%s_fmt_%s'%(ana, vtype))
+        self._rng.set_state(state['random'])
+        self.debug('Resuming from checkpoint at stage %s'%(state['loop']['stage'], ))
+        return state['loop']
+
+    def _run_cvfolds_(self, nfold, nproc, errchmax, seed=None):
+        """Run a k-fold cross-validation pass and store the number of modes
+        in :attr:`_nmodes`
+
+        Folds are run by :func:`_fill_cvfold_`, possibly in a pool of
+        processes that inherits the input data.
+        For each reanalysis, the error of each number of modes is averaged
+        over folds, and the number of modes is chosen with the same
+        criterion as for a single fold.
+        Errors of folds are stored in :attr:`_cvfold_errors`.
+        """
+        # Tasks
+        if seed is None:
+            seed = self._rng.randint(0, 2**31-1)
+        kwinit = self._kwargs.copy()
+        kwinit.pop('run', None)
+        tasks = []
+        for ifold in xrange(nfold):
+            kwfill = self._kwfill.copy()
+            kwfill.update(testmode='crossvalid', cvonly=True, nfold=None,
+                cvfield_nfold=nfold, cvfield_ifold=ifold, cvfield_seed=seed)
+            if self._deadline is not None:
+                kwfill['deadline'] = max(self._deadline-time.time(), 0)
+            tasks.append((kwinit, kwfill))
+
+        # Run folds
+        if not nproc or nproc<1:
+            nproc = cpu_count()
+        nproc = min(nproc, nfold)
+        if nproc==1:
+            _init_cvfold_(self._data, self.logger)
+            results = map(_fill_cvfold_, tasks)
+        else:
+            self.debug('Running %i cross-validation folds with %i processes'
+                %(nfold, nproc))
+            pool = Pool(nproc, _init_cvfold_, (self._data, self.logger))
+            try:
+                results = pool.map(_fill_cvfold_, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        self._cvfold_errors = [res[0] for res in results]
+
+        # Combine errors
+        self._nmodes = {}
+        for ana in 'pca', 'mssa':
+            folds = [res for res in results if ana in res[1]]
+            if not folds:
+                continue
+            if not [res for res in folds if ana in res[0]]: # Not analyzed
+                self._nmodes[ana] = folds[0][1][ana]
+                continue
+            nreana = int(round(npy.mean([res[2][ana] for res in folds])))
+            nmodes = self._nmodes[ana] = []
+            for ira in xrange(max(1, nreana)):
+
+                # Last error of each tested number of modes
+                curves = []
+                fmodes = []
+                for errors, fnmodes, fnreana in folds:
+                    if ira<len(fnmodes[ana]):
+                        fmodes.append(fnmodes[ana][ira][0])
+                    if ana in errors and ira<len(errors[ana]):
+                        curves.append([abs(err[-1]) if len(err) else npy.nan
+                            for err in errors[ana][ira]])
+
+                # Best number of modes
+                nm = min([len(curve) for curve in curves]) if curves else 0
+                if nm>1:
+                    meanerr = npy.ma.masked_invalid([curve[:nm]
+                        for curve in curves]).mean(axis=0).filled(npy.nan)
+                    imode = 0
+                    while imode<nm-1 and meanerr[imode+1]-meanerr[imode]<=errchmax:
+                        imode += 1
+                    self.debug('  Best number of %s modes from %i folds: %i'
+                        %(ana.upper(), len(curves), imode+1))
+                elif nmodes:
+                    imode = nmodes[0][0]
+                else:
+                    imode = int(npy.median(fmodes))
+                nmodes.append([imode])
+
     def get_filtered(self, mssa=None, unmap=True,  geterr=False, **kwargs):
         """Get a filtered version of the original dataset
 
@@ -367,7 +844,9 @@ class Filler(Logger):
         else:
             ana = 'mssa'
             if 'mssa' not in self._analyzes:
-                if self._nomssaneeded: # MSSA not needed to fill but we run it
+                if self._timedout: # deadline reached before MSSA
+                    ana = 'pca'
+                elif self._nomssaneeded: # MSSA not needed to fill but we run it
                     self.span.mssa()
                 else: # Refill with MSSA
                     kw = self._kwfill.copy()
@@ -518,15 +997,152 @@ class Filler(Logger):
 
     filled = property(fget=get_filled, doc='Data filled with filtered data where missing')
 
+    def update(self, data, errdriftmax=5., refit=True, nitermax=None, errchmax=None):
+        """Fill new time steps appended to the data with the results of the last fit
+
+        EOFs, ST-EOFs and numbers of modes are kept frozen: only expansion
+        coefficients of the new time steps are estimated with a
+        convergence loop, first with PCA, then with MSSA if it was needed
+        by the last fit. The MSSA convergence loop is performed on the
+        new PCA PCs preceded by the ``window-1`` last PCs,
+        which is the time window affected by the new time steps.
+        The whole record is kept for the next full fit.
+
+        :Params:
+
+            - **data**: New time steps in the same form as initialization data,
+              except for the time length.
+            - **errdriftmax**, optional: Maximal increase (%) of the PCA
+              reconstruction error of new time steps with respect to
+              that of the last fit.
+              When it is exceeded, the filler is fitted again on the whole record
+              if ``refit`` is True, else :attr:`needs_refit` is set to True.
+            - **nitermax**, **errchmax**, optional: Parameters of the
+              convergence loop, which default to those of :meth:`fill`.
+
+        :Returns: New time steps filled with the filtered data.
+        """
+        # Last fit
+        if not self._analyzes:
+            self.fill(**self._kwfill)
+        span = self.span
+        if nitermax is None:
+            nitermax = self._kwfill.get('nitermax', 20)
+        if errchmax is None:
+            errchmax = self._kwfill.get('errchmax', -0.01)
+
+        # Append to the record
+        news = span.remap(data)
+        self._data = span.unmap([npy.ma.concatenate([old, new])
+            for old, new in zip(span.remap(self._data), news)])
+        datam = npy.ma.masked_values(span.restack(news, scale=True),
+            default_missing_value, copy=False)
+        nt = datam.shape[1]
+
+        # PCA
+        npcamode = self._nmodes['pca'][-1][0]+1
+        if getattr(self, '_fit_error', None) is None:
+            rec = span.pca_rec(modes=-npcamode, raw=True)+self._orig_mean
+            self._fit_error = self._get_update_error_(self._origm, rec)
+        self.debug('Updating PCA with %i new time steps'%nt)
+        rec, ec, err = self._update_ec_('pca', datam, self._orig_mean, npcamode,
+            nitermax, errchmax)
+        self.update_error = err
+        filtered = rec
+
+        # MSSA
+        if 'mssa' in self._analyzes:
+            self.debug('Updating MSSA on the affected window')
+            npre = span.prepca
+            if getattr(self, '_update_pcs', None) is None:
+                self._update_pcs = span._pca_raw_pc[1-span.window:, :npre].T
+            pcsm = npy.ma.masked_values(npy.hstack((self._update_pcs, ec[:, :npre].T)),
+                default_missing_value, copy=False)
+            nmssamode = self._nmodes['mssa'][-1][0]+1
+            mrec, mec, merr = self._update_ec_('mssa', pcsm, self._pcs_mean,
+                nmssamode, nitermax, errchmax)
+            self._update_pcs = npy.ma.where(npy.ma.getmaskarray(pcsm), mrec,
+                pcsm)[:, nt:].filled(default_missing_value)
+            mfiltered = span.mssa_rec(modes=-nmssamode, xpc=mec, xraw=True, raw=2,
+                unmap=False)
+            filtered = npy.ma.where(npy.ma.getmaskarray(filtered),
+                mfiltered[:, -nt:], filtered)
+
+        # Filled data
+        filtered = span.unstack(npy.ma.filled(filtered, default_missing_value),
+            firstaxes=[span.get_time(nt=nt)])
+        self.update_filtered = span.unmap(filtered)
+        self.update_filled = span.unmap([npy.ma.where(npy.ma.getmaskarray(new), filt, new)
+            for new, filt in zip(news, filtered)])
+
+        # Error drift
+        self.needs_refit = err-self._fit_error>errdriftmax
+        if self.needs_refit:
+            self.warning('Error drift of new time steps: %.1f%% -> %.1f%%'%(
+                self._fit_error, err))
+            if refit:
+                self.debug('Fitting again the whole record')
+                self.analyze(data=self._data, **self._kwargs)
+                self._set_field_(self.span.stacked_data, 'orig', std=True)
+                self.fill(**self._kwfill)
+                self.update_filled = self.span.unmap([filled[-nt:]
+                    for filled in self.span.remap(self.filled)])
+        return self.update_filled
+
+    def _update_ec_(self, ana, datam, mean, nmode, nitermax, errchmax):
+        """Convergence loop of expansion coefficients with frozen EOFs for :meth:`update`
+
+        :Returns: ``rec, ec, err`` where ``rec`` is the masked reconstruction
+            (with ``mean``), ``ec`` are raw expansion coefficients and
+            ``err`` is the reconstruction error of valid data.
+        """
+        ecfunc = getattr(self.span, ana+'_ec')
+        recfunc = getattr(self.span, ana+'_rec')
+        mask = npy.ma.getmaskarray(datam)
+        rec = ec = err = None
+        for istep in xrange(nitermax):
+            recfill = default_missing_value if rec is None else \
+                npy.ma.filled(rec, default_missing_value)
+            lastrec, lastec, lasterr = rec, ec, err
+            ec = ecfunc(xdata=npy.where(mask, recfill, datam.data), xraw=True, raw=True)
+            rec = recfunc(modes=-nmode, xpc=ec, xraw=True, raw=1, rescale=False)+mean
+            err = self._get_update_error_(datam, rec)
+            self.debug('  EC convergence step: %i, error: %.1f%%'%(istep, err))
+            if istep and err-lasterr>=errchmax:
+                if err>lasterr: # unstable
+                    rec, ec, err = lastrec, lastec, lasterr
+                break
+        return rec, ec, err
+
+    @staticmethod
+    def _get_update_error_(datam, rec):
+        """Reconstruction error of valid data (%)"""
+        diffm = datam-rec
+        return 100*diffm.compressed().std()/datam.compressed().std()
+
 
     def _set_field_(self, field, name, mean=True, std=False):
-        """Put a field in self._<name>*"""
-        fieldm = npy.ma.masked_values(field, default_missing_value, copy=False)
+        """Put a field in self._<name>*
+
+        Besides the masked field in ``_<name>m``, the filling loop uses
+        the plain field ``_<name>_data`` and the flat indices of its gaps
+        ``_<name>_gaps`` and of its valid points ``_<name>_valid``.
+        The mean ``_<name>_mean`` is a plain array too, set to zero
+        on channels without valid points.
+        """
+        data = npy.ascontiguousarray(npy.ma.filled(field, default_missing_value))
+        fieldm = npy.ma.masked_values(data, default_missing_value, copy=False)
         setattr(self, '_%sm'%name, fieldm)
+        mask = npy.ma.getmaskarray(fieldm).ravel()
+        valid = npy.flatnonzero(~mask)
+        setattr(self, '_%s_data'%name, data)
+        setattr(self, '_%s_gaps'%name, npy.flatnonzero(mask))
+        setattr(self, '_%s_valid'%name, valid)
         if std:
-            setattr(self, '_%s_std'%name, fieldm.std())
+            setattr(self, '_%s_std'%name, data.take(valid).std())
         if mean:
-            setattr(self, '_%s_mean'%name, fieldm.mean(axis=1).reshape(-1, 1))
+            setattr(self, '_%s_mean'%name,
+                npy.ma.filled(fieldm.mean(axis=1), 0.).reshape(-1, 1))
 
     def _link_field_(self, name, to='current'):
         """
@@ -536,7 +1152,7 @@ class Filler(Logger):
         # Put it in self._current*
         if self._ana=='mssa':
             pass
-        for att in 'm', '_mask', '_std', '_mean':
+        for att in 'm', '_data', '_gaps', '_valid', '_std', '_mean':
             if hasattr(self, '_%s'%name+att):
                 setattr(self, '_'+to+att, getattr(self, '_'+name+att))
 
@@ -559,24 +1175,63 @@ class Filler(Logger):
 
     def _get_error_(self, anamode):
         """Get current reconstruction error"""
-        diffm = self._refm-self._recm
-        fieldm = self._refm
-        if anamode==2:
-            diffm = npy.ma.masked_where(self._cvfield_kept, diffm, copy=False)
-            fieldm = npy.ma.masked_where(self._cvfield_kept, fieldm, copy=True)
-        err = 100*diffm.compressed().std()/fieldm.compressed().std()
+        if anamode==2: # Cross-validation points only
+            field = self._ref_data.take(self._cvfield_index)
+            rec = self._rec.take(self._cvfield_index)
+            std = field.std()
+        else:
+            field = self._ref_data.take(self._ref_valid)
+            rec = self._rec.take(self._ref_valid)
+            std = self._ref_std
+        diff = field-rec
+        if not self._rec_complete:
+            diff = diff[rec!=default_missing_value]
+        if not diff.size:
+            raise FillerError('No reconstructed point to compute the error. Stop.')
+        err = 100*diff.std()/std
         if npy.isnan(err):
             raise FillerError('Error is NaN. Stop.')
 
         return err
 
 
-    def _rec_(self, imode):
+    def _rec_(self, imode, istep=0, increc=False):
         """Get PCA or MSSA recontruction
 
         For PCA, output is same as raw input.
         For MSSA, output is same as PCA PCs input
+
+        At the first step of the convergence loop, expansion coefficients
+        only depend on the current data, and not on the number of modes.
+        The reconstruction of modes ``0..imode`` is then stored in
+        :attr:`_reccum` with these coefficients, so that with ``increc``,
+        only mode ``imode+1`` is reconstructed at the next call.
+
+        The reconstruction is stored in :attr:`_rec` as a plain array
+        with missing values where it is masked.
         """
+        pcname = '_%s_raw_pc'%self._ana
+        recfunc = self._get_func_('rec')
+
+        # Values that fill gaps
+        if self._recfill is not None:
+            recfill = self._recfill
+        elif npy.ndim(self._rec):
+            recfill = self._rec.take(self._current_gaps)
+        else:
+            recfill = self._rec
+        self._recfill_last = recfill
+        self._recfill = None
+
+        # Cumulated reconstruction
+        if (increc and istep==0 and self._reccum is not None and
+                self._reccum_imode==imode-1):
+            setattr(self.span, pcname, self._reccum_pc.copy())
+            self._reccum = self._reccum + recfunc(modes=imode, raw=1,
+                rescale=False, unmap=False)
+            self._reccum_imode = imode
+            self._set_rec_(self._reccum)
+            return
 
         # Expansion coefficients
         # - classic estimation
@@ -584,8 +1239,7 @@ class Filler(Logger):
         if self._ana=='mssa' or not self.span.useteof:
 
             # Fill masked point with reconstructed data
-            rec = self._recm.data if hasattr(self._recm, 'data') else self._recm
-            data =  self._currentm.filled(rec)
+            data = self._fill_gaps_(recfill)
 
             if self._ana=='mssa': # MSSA rec
 
@@ -601,10 +1255,79 @@ class Filler(Logger):
 
 
         # Reconstruction (masked)
-        recfunc = self._get_func_('rec')
-        self._recm = recfunc(modes=-imode, raw=1, rescale=False, unmap=False)
+        recm = recfunc(modes=-imode, raw=1, rescale=False, unmap=False)
+        if increc and istep==0:
+            self._reccum = recm.copy()
+            self._reccum_imode = imode
+            self._reccum_pc = getattr(self.span, pcname).copy()
+        self._set_rec_(recm)
+
+    def _set_rec_(self, recm):
+        """Store a masked reconstruction in :attr:`_rec` as a plain array
+        with the current mean added and missing values where masked"""
+        mask = npy.ma.getmask(recm)
+        rec = npy.ma.getdata(recm)
         if hasattr(self, '_current_mean'):
-            self._recm += self._current_mean
+            rec = rec+self._current_mean
+        elif mask is not npy.ma.nomask:
+            rec = rec.copy()
+        self._rec_complete = mask is npy.ma.nomask or not mask.any()
+        if not self._rec_complete:
+            rec[mask] = default_missing_value
+        self._rec = rec
+
+    def _fill_gaps_(self, values=None):
+        """Get a copy of the current field with gaps filled with ``values``
+        or, by default, with the current reconstruction"""
+        data = self._current_data.copy()
+        if values is None:
+            values = self._rec.take(self._current_gaps)
+        npy.put(data, self._current_gaps, values)
+        return data
+
+    def _accelerate_(self, method, depth=3, omega=1.5):
+        """Set values that fill gaps at the next step of the convergence
+        loop of expansion coefficients in :attr:`_recfill`
+
+        The plain iteration fills gaps with the last reconstruction
+        :attr:`_rec`. With ``method="relax"``, the last filling values are
+        moved ``omega`` times the distance to the last reconstruction.
+        With ``method="anderson"``, filling values are the combination of
+        the last ``depth+1`` reconstructions that minimizes the
+        linearized residual (type II Anderson mixing).
+
+        Acceleration is not applied when reconstructions are masked at gaps.
+        """
+        self._ecaccel_active = False
+        xx = self._recfill_last
+        gaps = self._current_gaps
+        if npy.ndim(xx)==0 or not gaps.size:
+            self._ecaccel_hist = []
+            return
+        gg = self._rec.take(gaps)
+        if (gg==default_missing_value).any() or (xx==default_missing_value).any():
+            self._ecaccel_hist = []
+            return
+
+        # Residual
+        ff = gg-xx
+
+        # New values
+        if method=='relax':
+            xx = xx+omega*ff
+        else:
+            hist = self._ecaccel_hist
+            hist.append((gg, ff))
+            if len(hist)>depth+1:
+                del hist[0]
+            if len(hist)<2:
+                return
+            dg = npy.array([hist[i+1][0]-hist[i][0] for i in xrange(len(hist)-1)]).T
+            df = npy.array([hist[i+1][1]-hist[i][1] for i in xrange(len(hist)-1)]).T
+            gamma = npy.linalg.lstsq(df, ff, rcond=-1)[0]
+            xx = gg-npy.dot(dg, gamma)
+        self._recfill = xx
+        self._ecaccel_active = True
 
     def _get_func_(self, suf=None):
         """Get a PCA or MSSA related generic function (method)"""
@@ -617,17 +1340,16 @@ class Filler(Logger):
         """Get the number of missing values of current expansion coefficents"""
         if not hasattr(self,  '_ana'): return None, None
         if hasattr(self, '_necmiss'): self._necmiss_old = self._necmiss
-        pc0 = npy.ma.masked_values(getattr(self.span, '_%s_raw_pc'%self._ana)[:, 0],
-            default_missing_value)
-        self._necmiss =  pc0.size-npy.ma.count(pc0)
-        del pc0
+        pc0 = getattr(self.span, '_%s_raw_pc'%self._ana)[:, 0]
+        self._necmiss = int(npy.isclose(pc0, default_missing_value).sum())
         if not hasattr(self, '_necmiss_old'):
             necmissch = None
         else:
             necmissch = self._necmiss-self._necmiss_old
         return self._necmiss, necmissch
 
-    def _gen_cvfield_(self, mask=None, level=1.0, regen=False, ntries=50, ncvmin=5):
+    def _gen_cvfield_(self, mask=None, level=1.0, regen=False, ncvmin=5,
+            nfold=None, ifold=0, seed=None):
         """Generate false missing values
 
         Field used for analysis is stored using `set_field('cvfield')`.
@@ -639,105 +1361,589 @@ class Filler(Logger):
               analysis. These rejected values are used to cross-validation.
               If not set, it is randomly generated.
             - **level**, optional: Approximate percentile of cross validation points.
-            - **mincv**, optional: Minimal number of cross-validation points.
+            - **ncvmin**, optional: Minimal number of cross-validation points.
+            - **nfold**, optional: Number of disjoint masks generated at once,
+              among which the ``ifold`` th one is used.
+            - **seed**, optional: Seed of the random generator, which
+              must be the same for all folds.
+
+        Masks always preserve minimal availability along both axes
+        (see :func:`gen_cv_mask`).
         """
         if not regen and hasattr(self, '_cvfield') and self._cvfield_ana==self._ana:
             return
 
         # Generate the mask
         if mask is None:
-
-            # Data mask
-            data = self._refm
-            ns, nt = self._refm.shape
-            transp = self._ana=='pca'
-
-            # Generate new mask
-            if ntries>=0:
-                dmask = npy.ma.getmaskarray(data)
-                da0 = dmask.all(axis=0)
-                da1 = dmask.all(axis=1)
-#                del dmask
-            for reduc in npy.arange(1, 0, -0.1):
-                for itry in xrange(max(1, ntries)):
-
-                    # Last chance!
-                    if itry==ntries-1 and reduc==0.1:
-                        ncvmin = 1
-
-                    # Get new mask
-                    mask = gen_cv_mask(data, level*reduc, merged=True, nmin=ncvmin)
-
-                    # Check consistency
-                    if ntries<0 or (
-                            (ns==1 or npy.ma.allclose(mask.all(axis=0), da0)) and
-                            (nt==1 or npy.ma.allclose(mask.all(axis=1), da1))):
-                        break
-                else:
-                    msg = 'Mask does not preserve minimal availability along both axes. '
-                    if reduc!=0.1:
-                        self.warning(msg+
-                            'Trying with  %i%% of initial level of cross validation points'%(reduc*100))
-                    else:
-                        self.warning(msg+'Skipping.')
-                    continue
-                break
+            masks = gen_cv_mask(self._refm, level, merged=True, nmin=ncvmin,
+                nfold=nfold or 1, seed=self._rng if seed is None else seed)
+            mask = masks[ifold]
             self.debug('Generated cross-validation mask with max(%i%%,%i) of valid points'
-                % (level*reduc, ncvmin))
+                % (level, ncvmin))
 
         # Apply mask
-        cvfield = npy.where(mask, default_missing_value, self._refm)
+        cvfield = npy.where(mask, default_missing_value, self._ref_data)
         self._set_field_(cvfield, 'cvfield', mean=True, std=False)
         self._cvfield_kept = ~mask
+        self._cvfield_index = self._ref_valid[npy.ravel(mask).take(self._ref_valid)]
         self._cvfield_ana = self._ana
 
 
-def gen_cv_mask(data, level, merged=True, nmin=10):
+class TiledFiller(Logger):
+    """Fill missing values of a large field by spatial tiles
+
+    The spatial domain is split into tiles that overlap their neighbours
+    by ``2*overlap`` points, and each tile is filled independently with
+    a :class:`Filler`, possibly in a pool of processes.
+    Filtered tiles are then blended in their overlaps with weights that
+    linearly decrease towards the edges of tiles.
+    Since analyses are local, the cost and memory of a PCA are
+    driven by the tile size instead of the full number of channels.
+
+    :Params:
+
+        - **data**: Array whose first axis is time, and other axes are spatial.
+        - **tilesize**: Size of the core of tiles, along each spatial axis
+          (an int is used for all axes).
+        - **overlap**, optional: Number of points that extend the core
+          of tiles on each side, along each spatial axis.
+        - **nproc**, optional: Number of processes
+          (all CPUs if ``None`` or lower than 1).
+        - **seed**, optional: Seed used to draw the seeds of the
+          cross-validation masks of tiles (see :meth:`Filler._gen_cvfield_`),
+          which makes results independent of ``nproc``.
+        - Other keywords are passed to :class:`Filler`.
+
+    :Example:
+
+        >>> F = TiledFiller(data, tilesize=100, overlap=10, nproc=8, npca=10)
+        >>> filled = F.filled
+
+    The initialization automatically call the :meth:`fill` method.
+    """
+
+    def __init__(self, data, tilesize, overlap=0, nproc=1, seed=None, run=True,
+            logger=None, loglevel=None, **kwargs):
+
+        # Logger
+        Logger.__init__(self, logger=logger, loglevel=loglevel, **dict_filter(kwargs, 'log_'))
+        self._kwargs = kwargs
+        if cdms2_isVariable(data):
+            data = data.asma()
+        self._data = npy.ma.asarray(data)
+        if self._data.ndim<2:
+            raise FillerError('Data must have at least one spatial axis')
+        nsdim = self._data.ndim-1
+        self.tilesize = broadcast(tilesize, nsdim)
+        self.overlap = broadcast(overlap, nsdim)
+        self.nproc = nproc
+        self.seed = seed
+
+        # Start filling?
+        if run: self.fill()
+
+    def get_tiles(self):
+        """Get the list of ``(slices, weights)`` of tiles
+
+        ``slices`` are spatial slices of tiles including overlaps,
+        and ``weights`` are blending weights that have the shape of tiles.
+        """
+        tiles = [((), 1.)]
+        for n, size, ovl in zip(self._data.shape[1:], self.tilesize, self.overlap):
+            tiles1d = []
+            for i0 in xrange(0, n, size):
+                imin = max(0, i0-ovl)
+                imax = min(n, i0+size+ovl)
+                ww = npy.ones(imax-imin)
+                if ovl:
+                    ramp = (npy.arange(2*ovl)+0.5)/(2*ovl)
+                    if imin>0:
+                        nr = min(2*ovl, imax-imin)
+                        ww[:nr] = ramp[:nr]
+                    if imax<n:
+                        nr = min(2*ovl, imax-imin)
+                        ww[-nr:] = npy.minimum(ww[-nr:], ramp[::-1][-nr:])
+                tiles1d.append((slice(imin, imax), ww))
+            tiles = [(sl+(sl1d, ), npy.multiply.outer(ww, ww1d))
+                for sl, ww in tiles for sl1d, ww1d in tiles1d]
+        return tiles
+    tiles = property(fget=get_tiles, doc=get_tiles.__doc__)
+
+    def fill(self):
+        """Fill all tiles and blend them
+
+        Results are accessible in the :attr:`filtered`
+        and :attr:`filled` attributes.
+        """
+        # Tasks
+        tiles = self.get_tiles()
+        seeds = get_random_state(self.seed).randint(0, 2**31-1, size=len(tiles))
+        tasks = [(sl, seed) for (sl, ww), seed in zip(tiles, seeds)]
+
+        # Fill tiles
+        nproc = self.nproc
+        if not nproc or nproc<1:
+            nproc = cpu_count()
+        nproc = min(nproc, len(tasks))
+        if nproc==1:
+            _init_tile_(self._data, self._kwargs, self.logger)
+            results = map(_fill_tile_, tasks)
+        else:
+            self.debug('Filling %i tiles with %i processes'%(len(tasks), nproc))
+            pool = Pool(nproc, _init_tile_, (self._data, self._kwargs, self.logger))
+            try:
+                results = pool.map(_fill_tile_, tasks)
+            finally:
+                pool.close()
+                pool.join()
+
+        # Blend tiles
+        wsum = npy.zeros(self._data.shape)
+        fsum = npy.zeros(self._data.shape)
+        for (sl, ww), filtered in zip(tiles, results):
+            if filtered is None:
+                continue
+            sl = (slice(None), )+sl
+            ww = npy.where(npy.ma.getmaskarray(filtered), 0., ww)
+            fsum[sl] += ww*filtered.filled(0.)
+            wsum[sl] += ww
+        self.filtered = npy.ma.masked_where(wsum==0, fsum/npy.where(wsum==0, 1, wsum))
+        self.filled = npy.ma.where(npy.ma.getmaskarray(self._data), self.filtered,
+            self._data)
+
+
+def fill_sweep(data, npca=15, nmssa=15, window=None, nproc=1, seed=None,
+        logger=None, loglevel=None, **kwargs):
+    """Evaluate a grid of parameters of :class:`Filler` with cross-validation
+
+    Each parameter may be a single value or a list of values, and all
+    combinations are evaluated with the cross-validation pass of
+    :meth:`Filler.fill`, using the same cross-validation mask.
+    Combinations are shared by a pool of processes, which inherits the
+    input data and packs it once per process.
+    The PCA stage is performed once per number of PCA modes, with the
+    first MSSA parameters, and the other MSSA parameters are then
+    evaluated in parallel from the saved PCA stage.
+
+    :Params:
+
+        - **data**: Data in the same form as for :class:`Filler`.
+        - **npca**, **nmssa**, **window**, optional: Parameters of
+          :class:`Filler`.
+        - **nproc**, optional: Number of processes (all CPUs if ``None``
+          or lower than 1).
+        - **seed**, optional: Seed of the cross-validation mask.
+        - Other keywords are passed to :class:`Filler`.
+
+    :Returns: ``table, best`` where ``table`` is a list of :class:`dict`, one
+        per combination, with keys ``npca``, ``nmssa``, ``window``,
+        ``pca_error``, ``pca_nmodes``, ``mssa_error`` and ``mssa_nmodes``
+        (``None`` when MSSA is not needed) and ``error``, and ``best``
+        is the item of ``table`` with the lowest ``error``.
+
+    :Example:
+
+    >>> table, best = fill_sweep(data, npca=[5, 10], window=[12, 24], nproc=4)
+    >>> F = Filler(data, npca=best['npca'], window=best['window'])
+    """
+    # Tasks
+    logger = Logger('FILL_SWEEP', logger=logger, loglevel=loglevel,
+        **dict_filter(kwargs, 'log_'))
+    if seed is None:
+        seed = npy.random.randint(0, 2**31-1)
+    kwargs['cvfield_seed'] = seed
+    if not isinstance(npca, (list, tuple)): npca = [npca]
+    if not isinstance(nmssa, (list, tuple)): nmssa = [nmssa]
+    if not isinstance(window, (list, tuple)): window = [window]
+    msparams = [(nm, win) for nm in nmssa for win in window]
+
+    # Pool
+    if not nproc or nproc<1:
+        nproc = cpu_count()
+    nproc = min(nproc, len(npca)*len(msparams))
+    pool = None
+    if nproc==1:
+        _init_sweep_(data, kwargs, logger.logger)
+        pmap = map
+    else:
+        logger.debug('Sweeping %i combinations with %i processes'%(
+            len(npca)*len(msparams), nproc))
+        pool = Pool(nproc, _init_sweep_, (data, kwargs, logger.logger))
+        pmap = lambda func, tasks: pool.map(func, tasks, chunksize=1)
+    try:
+
+        # PCA stages with the first MSSA parameters
+        firsts = pmap(_fill_sweep_, [(npc, )+msparams[0]+(None, ) for npc in npca])
+
+        # Other MSSA parameters from PCA stages
+        tasks = [(npc, nm, win, state) for npc, (row, state) in zip(npca, firsts)
+            for nm, win in msparams[1:]]
+        others = pmap(_fill_sweep_, tasks) if tasks else []
+
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # Best
+    nother = len(msparams)-1
+    table = []
+    for i, (row, state) in enumerate(firsts):
+        table.append(row)
+        table.extend([row for row, state in others[i*nother:(i+1)*nother]])
+    best = min(table, key=lambda row: row['error'])
+    logger.debug('Best parameters: npca=%(npca)i, nmssa=%(nmssa)i, window=%(window)i '
+        '(error: %(error).2f%%)'%best)
+    return table, best
+
+
+def fill_batch(datas, varkwargs=None, nproc=1, blas_threads=1, output='filled',
+        logger=None, loglevel=None, **kwargs):
+    """Fill a list of independent variables with :class:`Filler` in parallel
+
+    Each variable is filled by a fresh process of a pool, which inherits
+    the input data, and variables are submitted by decreasing size
+    to balance the load.
+    Since BLAS libraries are usually multithreaded, the number
+    of threads of each process is limited to prevent oversubscription
+    (see :func:`~spanlib.util.set_blas_threads`).
+
+    :Params:
+
+        - **datas**: List of data in the same form as for :class:`Filler`.
+        - **varkwargs**, optional: List of :class:`dict` of keywords
+          of :class:`Filler` specific to each variable.
+        - **nproc**, optional: Number of processes (all CPUs if ``None``
+          or lower than 1).
+        - **blas_threads**, optional: Maximal number of BLAS threads per
+          process of the pool (no limit if ``None``).
+        - **output**, optional: Name of the attribute of :class:`Filler`
+          that is returned for each variable, like ``"filled"``
+          or ``"filtered"``, or a list of names.
+        - Other keywords are passed to :class:`Filler` for all variables.
+
+    :Returns: ``results, report`` where ``results`` is the list of the
+        ``output`` of variables, in the order of ``datas``, and ``report``
+        is a list of :class:`dict`, one per variable, with keys ``time``
+        (wall time in seconds), ``cputime`` (CPU time of the process
+        in seconds, BLAS threads included), ``memory`` (peak resident memory
+        in MB of the process, which also accounts for previous variables
+        when ``nproc`` is 1), ``pid`` and ``error`` (the error message
+        if the filling failed, in which case the result is ``None``).
+
+    :Example:
+
+    >>> results, report = fill_batch([sst, chl], [dict(npca=10), dict(npca=5)],
+    ...     nproc=2, nmssa=8)
+    >>> sst_filled, chl_filled = results
+    """
+    # Tasks
+    logger = Logger('FILL_BATCH', logger=logger, loglevel=loglevel,
+        **dict_filter(kwargs, 'log_'))
+    if varkwargs is None:
+        varkwargs = [{}]*len(datas)
+    elif len(varkwargs)!=len(datas):
+        raise FillerError('varkwargs must have the same length as datas')
+    kwargs = [dict(kwargs, **kw) for kw in varkwargs]
+    tasks = sorted(xrange(len(datas)), key=lambda i: -npy.size(datas[i]))
+
+    # Fill
+    if not nproc or nproc<1:
+        nproc = cpu_count()
+    nproc = min(nproc, len(tasks))
+    if nproc<=1:
+        _init_batch_(datas, kwargs, output, None, logger.logger)
+        results = map(_fill_batch_, tasks)
+    else:
+        logger.debug('Filling %i variables with %i processes'%(len(tasks), nproc))
+        pool = Pool(nproc, _init_batch_, (datas, kwargs, output, blas_threads,
+            logger.logger), maxtasksperchild=1)
+        try:
+            results = pool.map(_fill_batch_, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    # Report
+    outputs = [None]*len(datas)
+    report = [None]*len(datas)
+    for i, (result, rep) in zip(tasks, results):
+        outputs[i] = result
+        report[i] = rep
+        if rep['error'] is None:
+            logger.debug('Variable %i: %.1f s, %.1f s CPU, %s MB'%(i, rep['time'],
+                rep['cputime'], 'unknown' if rep['memory'] is None else
+                '%.0f'%rep['memory']))
+        else:
+            logger.error('Variable %i: %s'%(i, rep['error']))
+    return outputs, report
+
+
+def _init_cvfold_(data, logger):
+    """Initialize the input data of cross-validation folds"""
+    global _cvfold_data_, _cvfold_logger_
+    _cvfold_data_ = data
+    _cvfold_logger_ = logger
+
+def _fill_cvfold_(task):
+    """Cross-validation pass of one fold for :meth:`Filler.fill`
+
+    :Params:
+
+        - **task**: ``(kwinit, kwfill)`` where ``kwinit`` are keywords
+          of :class:`Filler` initialization and ``kwfill`` those of
+          :meth:`Filler.fill`.
+
+    :Returns: ``errors, nmodes, nreana`` of the cross-validation pass.
+    """
+    kwinit, kwfill = task
+    F = Filler(_cvfold_data_, run=False, logger=_cvfold_logger_, **kwinit)
+    F.fill(**kwfill)
+    return F._errors[2], F._nmodes, F._nreana
+
+
+def _init_tile_(data, kwargs, logger):
+    """Initialize the input data of tiles"""
+    global _tile_data_, _tile_kwargs_, _tile_logger_
+    _tile_data_ = data
+    _tile_kwargs_ = kwargs
+    _tile_logger_ = logger
+
+def _fill_tile_(task):
+    """Fill one tile for :class:`TiledFiller`
+
+    :Params:
+
+        - **task**: ``(slices, seed)`` where ``slices`` are the spatial
+          slices of the tile and ``seed`` the default seed of its
+          cross-validation mask.
+
+    :Returns: The filtered tile, or ``None`` if it has no valid data.
+    """
+    slices, seed = task
+    tile = _tile_data_[(slice(None), )+slices]
+    if not npy.ma.count(tile):
+        return
+    kwargs = _tile_kwargs_.copy()
+    kwargs.setdefault('cvfield_seed', seed)
+    F = Filler(tile.reshape(tile.shape[0], -1), logger=_tile_logger_, **kwargs)
+    return F.filtered.reshape(tile.shape)
+
+
+def _init_sweep_(data, kwargs, logger):
+    """Initialize the :class:`Filler` of parameter sweeps, which packs
+    the input data once per process"""
+    global _sweep_filler_, _sweep_kwargs_
+    kwargs = kwargs.copy()
+    kwargs.update(cvonly=True, checkpoint_interval=npy.inf)
+    for key in 'run', 'npca', 'nmssa', 'window', 'checkpoint', 'resume':
+        kwargs.pop(key, None)
+    _sweep_filler_ = Filler(data, run=False, logger=logger, **kwargs)
+    _sweep_kwargs_ = kwargs
+
+def _fill_sweep_(task):
+    """Cross-validation pass of one combination of parameters for :func:`fill_sweep`
+
+    :Params:
+
+        - **task**: ``(npca, nmssa, window, state)`` where ``state`` is
+          the saved PCA stage of a previous pass with the same ``npca``,
+          or ``None`` to perform a full pass.
+
+    :Returns: ``row, state`` where ``row`` is a :class:`dict` of results
+        and ``state`` is the saved PCA stage after a full pass,
+        or ``None``.
+    """
+    npca, nmssa, window, state = task
+    F = _sweep_filler_
+    kw = dict(_sweep_kwargs_, npca=npca, nmssa=nmssa, window=window)
+    pcastage = (0, 0, npy.inf, npy.inf)
+    if state is None: # full pass with the PCA stage kept in memory
+        states = {}
+        F.fill(checkpoint=states, **kw)
+        state = states.get(pcastage)
+        if state is not None:
+            for att in '_nmssa', '_window':
+                state['span'].pop(att, None)
+    else: # MSSA stage only
+        F.fill(checkpoint={pcastage:state}, resume=True, **kw)
+        state = None
+    pcaerr = _get_cverror_(F, 'pca')
+    row = dict(npca=npca, nmssa=F.span.nmssa, window=F.span.window,
+        pca_error=pcaerr, pca_nmodes=F._nmodes['pca'][-1][0]+1,
+        mssa_error=None, mssa_nmodes=None)
+    if 'mssa' in F._analyzes and 'mssa' in F._errors[2]:
+        row.update(mssa_error=_get_cverror_(F, 'mssa'),
+            mssa_nmodes=F._nmodes['mssa'][-1][0]+1)
+    row['error'] = pcaerr if row['mssa_error'] is None else row['mssa_error']
+    return row, state
+
+def _init_batch_(datas, kwargs, output, blas_threads, logger):
+    """Initialize the input data of batches and limit BLAS threads"""
+    global _batch_datas_, _batch_kwargs_, _batch_output_, _batch_logger_
+    _batch_datas_ = datas
+    _batch_kwargs_ = kwargs
+    _batch_output_ = output
+    _batch_logger_ = logger
+    if blas_threads:
+        set_blas_threads(blas_threads)
+
+def _fill_batch_(task):
+    """Fill one variable for :func:`fill_batch`
+
+    :Params:
+
+        - **task**: Index of the variable.
+
+    :Returns: ``result, report`` where ``result`` is the output of the
+        :class:`Filler` or ``None`` if an error occured.
+    """
+    t0 = time.time()
+    c0 = sum(os.times()[:2])
+    result = error = None
+    try:
+        F = Filler(_batch_datas_[task], logger=_batch_logger_, **_batch_kwargs_[task])
+        if isinstance(_batch_output_, basestring):
+            result = getattr(F, _batch_output_)
+        else:
+            result = tuple([getattr(F, att) for att in _batch_output_])
+        del F
+    except Exception, e:
+        error = '%s: %s'%(e.__class__.__name__, e)
+    memory = None
+    if resource is not None:
+        memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+        if sys.platform=='darwin': # bytes
+            memory /= 1024.
+    return result, dict(time=time.time()-t0, cputime=sum(os.times()[:2])-c0,
+        memory=memory, pid=os.getpid(), error=error)
+
+def _get_cverror_(F, ana):
+    """Cross-validation error of the best number of modes of a :class:`Filler`"""
+    errors = F._errors[2][ana][-1]
+    imode = F._nmodes[ana][-1][0]
+    if imode<len(errors) and len(errors[imode]):
+        return abs(errors[imode][-1])
+    return min([abs(err[-1]) for err in errors if len(err)])
+
+
+def _group_argmax_(keys, groups):
+    """Get the index of the first maximum of ``keys`` along their last axis
+    within each group of consecutive equal values of ``groups``"""
+    n = groups.size
+    starts = npy.flatnonzero(npy.concatenate(([True], groups[1:]!=groups[:-1])))
+    gmax = npy.maximum.reduceat(keys, starts, axis=-1)
+    sizes = npy.diff(npy.append(starts, n))
+    pos = npy.where(keys==npy.repeat(gmax, sizes, axis=-1), npy.arange(n), n)
+    return npy.minimum.reduceat(pos, starts, axis=-1)
+
+
+def gen_cv_mask(data, level, merged=True, nmin=10, nfold=None, seed=None,
+        nmask=None):
     """Generate a cross validation mask with density depending on time availability
 
+    Cross-validation points are drawn among valid points with a
+    probability that increases with the energy of their channel.
+    The mask is built so that at least one valid point is kept
+    in each channel and each record that have valid points: the valid
+    point with the lowest probability of each channel and record is
+    protected, and cross-validation points are the points with
+    the highest probabilities among the others, found with a
+    linear time partial sort (:func:`numpy.argpartition`).
+    Records are not protected when none of them has more than one
+    valid point, like with a single channel, and the same holds
+    for channels.
+
     :Params:
 
-        - **dmask**: Channel/record (2D) data mask: True if masked.
+        - **data**: Channel/record (2D) masked data.
         - **level**: Percent of cross-validation points in valid data.
         - **merged**, optional: Merge data mask and cv mask? Some of the data points
           chosen of cross-validation becomes masked.
+        - **nmin**, optional: Minimal number of cross-validation points.
+        - **nfold**, optional: Generate this number of masks whose
+          cross-validation points are disjoint.
+        - **seed**, optional: See :func:`~spanlib.engines.get_random_state`.
+        - **nmask**, optional: Generate this number of independent masks
+          (or lists of ``nfold`` masks) at once.
 
     :Return: Depends on ``merge``:
 
         - True: ``mask``: False at cross-validation points only.
         - False: ``dmask``: Data mask with cross-validation points marked as False.
+
+        A list of ``nfold`` masks is returned when ``nfold`` is set,
+        and a list of ``nmask`` such results when ``nmask`` is set.
     """
     # Data mask
     dmask = npy.ma.getmaskarray(data)
     good = ~dmask
+    ns, nt = dmask.shape
+    ii, jj = npy.nonzero(good)
+    ngood = ii.size
+    nm = nmask or 1
+
+    # Weights of channels
+    weights = npy.ma.filled((npy.ma.asarray(data)**2).sum(axis=1), 0.).astype('d')
+    if weights.max()>0:
+        weights /= weights.max()
+
+    # Random keys: lowest keys are chosen first
+    rng = get_random_state(seed)
+    keys = rng.uniform(0, 1, size=(nm, ngood))
+    problim = weights[ii]
+    keys = npy.where(problim>0, keys/npy.where(problim>0, problim, 1.), 1.)
+
+    # Protect the highest key of each channel and record
+    im = npy.arange(nm)[:, None]
+    if ngood:
+        protect = npy.zeros((nm, ngood), '?')
+        if good.sum(axis=1).max()>1: # channels (ii is sorted)
+            protect[im, _group_argmax_(keys, ii)] = True
+        if good.sum(axis=0).max()>1: # records
+            order = npy.argsort(jj, kind='mergesort')
+            protect[im, order[_group_argmax_(keys[:, order], jj[order])]] = True
+        keys[protect] = npy.inf
+        nfree = (~protect).sum(axis=1).min()
+        del protect
+    else:
+        nfree = 0
 
-    # Weights
-    weights = npy.resize((data**2).sum(axis=1), data.shape[::-1]).T
-    weights /= weights.max()
-
-    # Max probability
-    problim = weights[good]
-    ngood = problim.shape[0]
-    probbad = problim==0.
-    problim[probbad] = 1.
-    prand = npy.random.uniform(0, 1, size=ngood)/problim
-    prand[probbad] = 1
-    psort = npy.argsort(prand)
+    # Number of points
+    if nfree<(nfold or 1):
+        raise FillerError('Not enough valid points to generate a '
+            'cross-validation mask: %i available for %i fold(s)'%(nfree, nfold or 1))
     ncv = max(nmin, int(ngood*0.01*level))
-    ccv = npy.zeros(problim.shape, '?')
-    ccv[psort[:ncv]] = True
-    cv = npy.zeros(dmask.shape, '?')
-    cv[good] = ccv #; del good
-
-    # Merge
-    if merged:
-        mask = dmask.copy()
-        mask[cv] = True
+    if nfold:
+        ncv = max(1, min(ncv, nfree//nfold))
+    ncv = min(ncv, nfree)
+    nsel = ncv*(nfold or 1)
+
+    # Lowest keys sorted
+    if 0<nsel<ngood:
+        isel = npy.argpartition(keys, nsel-1, axis=1)[:, :nsel]
     else:
-        mask = ~cv
-
-    return mask
+        isel = npy.repeat(npy.arange(nsel)[None], nm, axis=0)
+    isel = isel[im, npy.argsort(keys[im, isel], axis=1, kind='mergesort')]
+
+    allmasks = []
+    for im in xrange(nm):
+        masks = []
+        for ifold in xrange(nfold or 1):
+            idx = isel[im, ifold*ncv:(ifold+1)*ncv]
+            cv = npy.zeros(dmask.shape, '?')
+            cv[ii[idx], jj[idx]] = True
+
+            # Merge
+            if merged:
+                mask = dmask.copy()
+                mask[cv] = True
+            else:
+                mask = ~cv
+            masks.append(mask)
+        allmasks.append(masks if nfold else masks[0])
 
+    return allmasks if nmask else allmasks[0]
 
 
 if __name__=='__main__':
@@ -23,6 +23,7 @@
 import logging
 import logging.handlers
 import os
+import ctypes
 import numpy as N
 import re
 
@@ -259,3 +260,46 @@ def dict_filter(kwargs, prefix, pop=True):
     
 
 
+blas_threads_envvars = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+blas_threads_funcs = ['openblas_set_num_threads', 'MKL_Set_Num_Threads']
+
+def set_blas_threads(nthreads):
+    """Limit the number of threads used by BLAS libraries in the current process
+
+    Environment variables are set for libraries that are loaded
+    afterwards, and libraries that are already loaded (like those of
+    numpy and of the fortran core) are changed at runtime
+    when they are found in ``/proc/self/maps``.
+
+    :Returns: The list of paths of the libraries changed at runtime.
+
+    :Example:
+
+        >>> set_blas_threads(1)
+        ['/usr/lib/x86_64-linux-gnu/openblas-pthread/libopenblasp-r0.3.21.so']
+    """
+    nthreads = int(nthreads)
+    for var in blas_threads_envvars:
+        os.environ[var] = str(nthreads)
+    if not os.path.exists('/proc/self/maps'):
+        return []
+    f = open('/proc/self/maps')
+    try:
+        paths = set([line.split()[-1] for line in f if '.so' in line])
+    finally:
+        f.close()
+    libs = []
+    for path in sorted(paths):
+        if not re.search('blas|mkl', os.path.basename(path), re.I):
+            continue
+        try:
+            lib = ctypes.CDLL(path)
+        except OSError:
+            continue
+        for func in blas_threads_funcs:
+            if hasattr(lib, func):
+                getattr(lib, func)(ctypes.c_int(nthreads))
+                libs.append(path)
+                break
+    return libs
@@ -37,6 +37,33 @@ def setup_data2(nx=30, ny=20, **kwargs):
     data1 = setup_data1(nx=nx*ny, **kwargs)
     return data1.reshape((-1, ny, nx))
 
+def setup_data3(nt=400, nx=60, periods=(50, 23, 11, 7, 5), noise=0.05, seed=1):
+    """Generate space-time data from sinusoidal PCs of decreasing amplitude
+    and random EOFs, plus white noise
+
+    :Params:
+
+        - **periods**, optional: Periods of PCs, whose amplitudes decrease
+          linearly from 3 to 1.
+        - **noise**, optional: Standard deviation of the noise.
+        - **seed**, optional: Seed of EOFs and noise.
+    """
+    rs = npy.random.RandomState(seed)
+    t = npy.arange(nt*1.)
+    pcs = npy.array([npy.sin(2*npy.pi*t/per) for per in periods])
+    pcs *= npy.linspace(3, 1, len(periods))[:, None]
+    return npy.ma.dot(pcs.T, rs.randn(len(periods), nx)) + noise*rs.randn(nt, nx)
+
+def setup_holes1(nt=50, nx=120, xyfact=0, **kwargs):
+    """Same as :func:`setup_data1` with a copy that has a rectangular gap
+
+    :Returns: ``ref, withholes``
+    """
+    ref = setup_data1(nt=nt, nx=nx, xyfact=xyfact, **kwargs)
+    withholes = ref.copy()
+    withholes[nt/2:nt/2+10, nx/2-10:nx/2] = npy.ma.masked
+    return ref, withholes
+
 def setup_data0(nt = 300):
     """Get a 1D signal suitable for SSA tests"""
     t = npy.arange(nt*1.)
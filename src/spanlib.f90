@@ -40,7 +40,7 @@ contains
 !     & minecvalid=minecvalid, zerofill=zerofill, errmsg=errmsg)
 
 subroutine sl_pca(var, nkeep, xeof, pc, ev, ev_sum, mv, useteof, &
-    notpc, minecvalid, zerofill, errmsg)
+    notpc, minecvalid, zerofill, solver, evtarget, nkept, errmsg)
     ! **Principal Component Analysis**
     !
     ! :Description:
@@ -65,9 +65,15 @@ subroutine sl_pca(var, nkeep, xeof, pc, ev, ev_sum, mv, useteof, &
     !    - *ev_sum*: Sum of all egein values (even thoses not returned)
     !    - *useteof*: To force the use of T or S EOFs [0 = T, 1 = S, -1 = default]
     !    - *mv**: Missing value
+    !    - *solver*: Eigen solver (see :f:func:`sl_syev`) [0 = auto,
+    !      1 = dsyev, 2 = dsyevr, 3 = dsyevx, 4 = dsyevd]
+    !    - *evtarget*: Stop at the first mode for which the cumulated
+    !      explained variance reaches this percentage [default: 0 = off]
+    !    - *nkept*: Number of modes effectively computed (lower than
+    !      *nkeep* when *evtarget* is reached)
     !
     ! :Dependencies:
-    !    :func:`dgemm` (BLAS) :func:`dsyrk` (BLAS) :func:`dsyev` (LAPACK)
+    !    :func:`dgemm` (BLAS) :func:`dsyrk` (BLAS) :f:func:`sl_syev`
 
 
     ! Declarations
@@ -86,7 +92,9 @@ subroutine sl_pca(var, nkeep, xeof, pc, ev, ev_sum, mv, useteof, &
     integer,  intent(in),  optional :: useteof, & ! Use Spatial or Temporal EOFs  [0 = T, 1 = S, -1 = default]?
                                     notpc
     real(8), intent(out), optional :: ev_sum ! Sum of eigen values (total variance)
-    integer, intent(in), optional :: zerofill, minecvalid
+    integer, intent(in), optional :: zerofill, minecvalid, solver
+    real(8), intent(in), optional :: evtarget ! Explained variance target (%)
+    integer, intent(out), optional :: nkept ! Number of modes effectively computed
     character(len=120), intent(out), optional :: errmsg ! Logging message (len=120)
 
     ! Internal
@@ -94,12 +102,13 @@ subroutine sl_pca(var, nkeep, xeof, pc, ev, ev_sum, mv, useteof, &
     integer               :: ns, nt, odim, cdim
     real(8), allocatable :: cov(:,:), subcov(:,:), nn(:,:)
     real(8), allocatable :: zeof(:,:), zvar(:,:), zmean(:)
-    real(8), allocatable :: zev(:), work(:), ztmp(:,:)
+    real(8), allocatable :: zev(:), zeigvec(:,:), ztmp(:,:)
     integer(4), allocatable :: valid(:,:)
-    integer :: zuseteof, znkeepmax, i, la_info, lwork, im, nc, no, &
-        & nsv, ntv, it, ic, io
+    integer :: zuseteof, znkeepmax, i, la_info, im, nc, no, &
+        & nsv, ntv, it, ic, io, zsolver, znkept
     integer(4), allocatable :: iselects(:), iselectt(:)
     character(len=120) :: msg
+    character(len=20) :: la_fname
     character(len=1) :: trflag
     real(8) :: zmv, zdmv, zevsumt, zevsums, w0, znorm
     logical :: zusetpc
@@ -111,8 +120,13 @@ subroutine sl_pca(var, nkeep, xeof, pc, ev, ev_sum, mv, useteof, &
     ! -----
     ns = size(var,1)
     nt = size(var,2)
+    if(present(nkept))nkept = 0
+
+    ! Eigen solver (the max number of modes only applies to the full solver)
+    zsolver = 0
+    if(present(solver))zsolver = solver
     znkeepmax = 100
-    if(nkeep>znkeepmax)then
+    if(zsolver==1 .and. nkeep>znkeepmax)then
         if(present(errmsg))then
             write(msg,*)'You want to keep a number of PCs '//&
                 & 'greater than ',znkeepmax
@@ -184,7 +198,6 @@ subroutine sl_pca(var, nkeep, xeof, pc, ev, ev_sum, mv, useteof, &
         endif
     endif
     zusetpc = present(pc) .and. zuseteof==1 .and. (.not. present(notpc) .or. notpc==0)
-    znkeepmax=100
     if(zuseteof==1)then
         nc = ntv
         no = nsv
@@ -215,7 +228,7 @@ subroutine sl_pca(var, nkeep, xeof, pc, ev, ev_sum, mv, useteof, &
         return
     end if
 100     format('You want to keep a number of PCs greater than the number of valid', &
-        & A, X, I2)
+        & A, X, I0)
 
     ! Working var array
     allocate(zvar(nsv, ntv))
@@ -260,36 +273,41 @@ subroutine sl_pca(var, nkeep, xeof, pc, ev, ev_sum, mv, useteof, &
     endif
     if(.not.present(pc))deallocate(valid)
 
-    ! Diagonalization (cov: input=cov, output=eof)
-    ! --------------------------------------------
-    allocate(zev(nc))
-    allocate(work(1))
-    call dsyev('V', 'U', nc, cov, nc, zev, work, -1, la_info)
+    ! Diagonalization (leading modes only, cov is destroyed)
+    ! -----------------------------------------------------
+    allocate(zev(nkeep), zeigvec(nc,nkeep))
+    call sl_syev(cov, nkeep, zev, zeigvec, solver=zsolver, &
+        & la_info=la_info, la_fname=la_fname)
+    deallocate(cov)
     if(la_info/=0)then
         if(present(errmsg))&
             & errmsg = sl_errmsg(ierr_error, 'pca', &
-            &   la_info=la_info, la_fname='DSYEV (init phase)')
+            &   la_info=la_info, la_fname=la_fname)
         return
     endif
-    lwork = int(work(1))
-    deallocate(work)
-    allocate(work(lwork))
-    call dsyev('V', 'U', nc, cov, nc, zev, work, lwork, la_info)
-    if(la_info/=0)then
-        if(present(errmsg))&
-            & errmsg = sl_errmsg(ierr_error, 'pca', &
-            &   la_info=la_info, la_fname='DSYEV')
-            write(*,*)errmsg
-        return
-    endif
-    deallocate(work)
 
     ! Eigenvalues
     ! -----------
 !     if(zuseteof==1) zev = zev * dble(ntv) / dble(nsv)
     zev = merge(0d0, zev, zev<0)
     if(zuseteof==1)zev = zev * zevsums / zevsumt
-    if(present(ev))ev = zev(nc:nc-nkeep+1:-1)
+
+    ! Explained variance target
+    znkept = nkeep
+    if(present(evtarget))then
+        if(evtarget>0d0 .and. zevsums>0d0)then
+            w0 = 0d0
+            do im = 1, nkeep
+                w0 = w0 + zev(im)
+                if(1d2*w0/zevsums>=evtarget)then
+                    znkept = im
+                    exit
+                endif
+            enddo
+        endif
+    endif
+    if(present(nkept))nkept = znkept
+    if(present(ev))ev(1:znkept) = zev(1:znkept)
 
     ! EOFs
     ! ----
@@ -301,10 +319,10 @@ subroutine sl_pca(var, nkeep, xeof, pc, ev, ev_sum, mv, useteof, &
         if(zuseteof==1)then ! T-EOF
 
             ! PC->EOF: ZVAR*PC=EOF
-            allocate(subcov(nc,nkeep))
-            subcov = cov(:,nc:nc-nkeep+1:-1)
-            deallocate(cov)
-            allocate(ztmp(no,nkeep))
+            allocate(subcov(nc,znkept))
+            subcov = zeigvec(:,1:znkept)
+            deallocate(zeigvec)
+            allocate(ztmp(no,znkept))
             call sl_pca_getec( &
                 & transpose(merge(zvar, zmv, valid(iselects,iselectt)==1)), &
                 & subcov, ztmp, mv=zmv, demean=0, minvalid=1)
@@ -314,7 +332,7 @@ subroutine sl_pca(var, nkeep, xeof, pc, ev, ev_sum, mv, useteof, &
 
 
             ! Normalize EOFs
-            do im = 1, nkeep
+            do im = 1, znkept
                 znorm = sqrt(sum(zeof(iselects,im)**2, mask=abs(zeof(iselects,im)-zmv)>abs(mvtol*zmv)))
                 where(abs(zeof(iselects,im)-zmv)>abs(mvtol*zmv)) &
                     & zeof(iselects,im) = zeof(iselects,im) / znorm
@@ -330,7 +348,8 @@ subroutine sl_pca(var, nkeep, xeof, pc, ev, ev_sum, mv, useteof, &
                 else
                     pc = zmv
                 endif
-                pc(iselectt,:) = subcov
+                pc(iselectt,1:znkept) = subcov
+                if(znkept<nkeep)pc(:,znkept+1:) = zmv
 
                 deallocate(subcov)
             endif
@@ -338,27 +357,28 @@ subroutine sl_pca(var, nkeep, xeof, pc, ev, ev_sum, mv, useteof, &
 
         else ! S-EOF (classic case)
 
-            zeof(iselects,:) = cov(:,nc:nc-nkeep+1:-1)
+            zeof(iselects,1:znkept) = zeigvec(:,1:znkept)
+            deallocate(zeigvec)
 
         end if
 
     else
-        deallocate(cov)
+        deallocate(zeigvec)
     endif
 
+    ! Sum of all eigenvalues (useful for percentils)
+    ! ----------------------------------------------
+    if(present(ev_sum)) ev_sum = zevsums
+    if(.not.allocated(zeof))return
+
     ! First valid channel of an EOF is >= 0
-    do im = 1, nkeep
+    do im = 1, znkept
         if(zeof(iselects(1), im)<0)then
             zeof(iselects, im) = -zeof(iselects, im)
             if(zusetpc)pc(iselectt, im) = -pc(iselectt, im)
         endif
     enddo
 
-
-    ! Sum of all eigenvalues (useful for percentils)
-    ! ----------------------------------------------
-    if(present(ev_sum)) ev_sum = zevsums
-
     ! Final eof
     ! ---------
     if(present(xeof)) xeof = zeof
@@ -367,7 +387,8 @@ subroutine sl_pca(var, nkeep, xeof, pc, ev, ev_sum, mv, useteof, &
     ! ===============
     if(present(pc) .and. .not.zusetpc)then
 
-        call sl_pca_getec(var, zeof, pc, mv=zmv, minvalid=minecvalid, &
+        call sl_pca_getec(var, zeof(:,1:znkept), pc(:,1:znkept), mv=zmv, &
+            & minvalid=minecvalid, &
             & zerofill=merge(1,0,present(zerofill).and.zerofill==2), demean=1)
 
     end if
@@ -380,7 +401,7 @@ end subroutine sl_pca
 !############################################################
 
 
-subroutine sl_pca_getec(var, xeof, ec, mv, minvalid, zerofill, demean)
+subroutine sl_pca_getec(var, xeof, ec, mv, minvalid, zerofill, demean, method)
     ! **Compute PCA expansion coefficients**
     !
     ! :Description:
@@ -397,6 +418,23 @@ subroutine sl_pca_getec(var, xeof, ec, mv, minvalid, zerofill, demean)
     !    - *xeof (ns, nkeep)*: EOFs
     !    - *ec (nt, nmode)*: Expansion coefficients
     !
+    ! :Optional arguments:
+    !
+    !    - *method*: Computation method for gappy fields:
+    !
+    !       - ``0``: Automatic choice (``2`` unless there are more
+    !         than 40 modes and most time steps have their own
+    !         validity pattern).
+    !       - ``1``: Modes are projected and removed one after the
+    !         other, time step by time step.
+    !       - ``2``: Time steps are grouped by validity pattern,
+    !         and each group is projected with one GEMM then
+    !         solved with the lower triangle of the Gram matrix of
+    !         EOFs restricted to valid channels, which is equivalent.
+    !         It is also used for other values.
+    !
+    ! :Dependencies:
+    !    [sd]gemm and [sd]trsm (BLAS)
 
     implicit none
 
@@ -408,14 +446,15 @@ subroutine sl_pca_getec(var, xeof, ec, mv, minvalid, zerofill, demean)
     real(8), intent(in)           :: var(:,:), xeof(:,:)
     real(8), intent(out)          :: ec(size(var,2),size(xeof,2))
     real(8), intent(in), optional :: mv
-    integer, intent(in), optional :: minvalid, zerofill, demean
+    integer, intent(in), optional :: minvalid, zerofill, demean, method
 
     ! Internal
     ! --------
-    real(8), allocatable :: zvar(:,:), norm(:), zeof(:,:), zmean(:), zvart(:)
+    real(8), allocatable :: zvar(:,:), norm(:), zeof(:,:), zmean(:), zvart(:), &
+        & geof(:,:), gvar(:,:), gec(:,:), gram(:,:)
     real(8) :: zmv, zdmv
-    integer :: ns, nt, nkeep, im, it, nc, ic
-    integer, allocatable :: valid(:,:)
+    integer :: ns, nt, nkeep, im, it, nc, ic, ig, ngroup, nv, nm, zmethod
+    integer, allocatable :: valid(:,:), group(:), order(:), gstart(:), ivalid(:)
     integer :: zminvalid, zoptimize, zdemean
     logical :: zf
     logical, allocatable :: cvalid(:)
@@ -487,6 +526,7 @@ subroutine sl_pca_getec(var, xeof, ec, mv, minvalid, zerofill, demean)
     ! Compute EC
     ! ----------
 
+    zmethod = 0
     if(.not. any(valid(iselect,:)==0))then ! Classic case
 
         ! Base
@@ -501,6 +541,44 @@ subroutine sl_pca_getec(var, xeof, ec, mv, minvalid, zerofill, demean)
 
     else ! For gappy fields
 
+        ! Groups of time steps with the same valid channels
+        if(present(method))zmethod = method
+        if(zmethod/=1)then
+            allocate(group(nt), order(nt), gstart(nt+1))
+            call sl_group_columns(valid(iselect,:), group, ngroup, order, gstart)
+            deallocate(group)
+            if(zmethod==0)zmethod = merge(2, 1, nkeep<=40 .or. 2*ngroup<=nt)
+            if(zmethod/=1)zmethod = 2 ! Invalid methods
+            if(zmethod==1)deallocate(order, gstart)
+        endif
+
+    endif
+
+    if(zmethod==2)then ! One GEMM per validity pattern
+
+        ec = zmv
+        allocate(gram(nkeep,nkeep))
+        do ig = 1, ngroup
+            it = order(gstart(ig))
+            nv = sum(valid(iselect,it))
+            if(nv<zminvalid)cycle
+            nm = gstart(ig+1)-gstart(ig)
+            allocate(ivalid(nv), geof(nv,nkeep), gvar(nv,nm), gec(nkeep,nm))
+            ivalid = pack((/(ic,ic=1,nc)/), valid(iselect,it)==1)
+            geof = zeof(ivalid,:)
+            gvar = zvar(ivalid, order(gstart(ig):gstart(ig+1)-1))
+            call dgemm('T', 'N', nkeep, nm, nv, 1d0, geof, nv, gvar, nv, &
+                & 0d0, gec, nkeep)
+            call dgemm('T', 'N', nkeep, nkeep, nv, 1d0, geof, nv, geof, nv, &
+                & 0d0, gram, nkeep)
+            call dtrsm('L', 'L', 'N', 'N', nkeep, nm, 1d0, gram, nkeep, gec, nkeep)
+            ec(order(gstart(ig):gstart(ig+1)-1), :) = transpose(gec)
+            deallocate(ivalid, geof, gvar, gec)
+        end do
+        deallocate(gram, order, gstart)
+
+    else if(zmethod==1)then ! One time step at a time
+
         allocate(zvart(nc))
         ec = zmv
         do it=1,nt
@@ -829,10 +907,20 @@ end subroutine sl_mssa
 !############################################################
 !############################################################
 
-subroutine sl_stcov(var, cov, mv)
+subroutine sl_stcov(var, cov, mv, method)
 ! Compute the Block-Toeplitz covariance matrix for MSSA analysis
 !
 ! .. note:: ``var`` does not need to be centered
+!
+! :Optional arguments:
+!
+!    - *method*: Computation method:
+!
+!       - ``0``: Automatic choice (currently ``2``).
+!       - ``1``: One dot product per element of the matrix.
+!       - ``2``: One GEMM per lag for the lagged covariances
+!         and the valid pair counts between all channels,
+!         which are then expanded to the block-Toeplitz matrix.
 
 
     implicit none
@@ -843,11 +931,12 @@ subroutine sl_stcov(var, cov, mv)
     real(8), intent(in)  :: var(:, :)
     real(8), intent(out) :: cov(:, :)
     real(8), intent(in), optional :: mv
+    integer, intent(in), optional :: method
 
-    real(8), allocatable :: zvar(:,:)
+    real(8), allocatable :: zvar(:,:), zvalid(:,:), lcov(:,:), lnn(:,:)
     integer, allocatable :: valid(:,:), nn(:,:)
-    integer ::  nchan, nt, nsteof, nwindow
-    integer :: iw, iw1, iw2, i1, i2, ic1, ic2
+    integer ::  nchan, nt, nsteof, nwindow, zmethod
+    integer :: iw, iw1, iw2, i1, i2, ic1, ic2, id
     real(8) :: zmv
 
     ! Sizes
@@ -856,6 +945,10 @@ subroutine sl_stcov(var, cov, mv)
     nt = size(var, 2)
     nsteof = size(cov, 1)
     nwindow = nsteof/nchan
+    zmethod = 2
+    if(present(method))then
+        if(method/=0) zmethod = method
+    endif
 
     ! Missing values
     ! --------------
@@ -871,52 +964,71 @@ subroutine sl_stcov(var, cov, mv)
     ! Anomaly
     ! -------
     zvar = zvar-spread(sum(zvar, dim=2)/sum(dble(valid), dim=2), ncopies=nt, dim=2)
+    zvar = merge(0d0, zvar, valid==0)
 
     ! Covariances
     ! -----------
-    allocate(nn(size(cov,1),size(cov,2)))
-
-    !$OMP PARALLEL &
-    !$OMP SHARED(zvar,cov,nchan,nwindow,valid,nn,nt) &
-    !$OMP PRIVATE(iw, iw1, iw2, i1, i2, ic1, ic2)
-    !$OMP DO
-    do ic1 = 1, nchan
-        do ic2 = 1, nchan
-            do iw2 = 1, nwindow
-                do iw1 = 1, iw2
-                    i1 = (ic1-1) * nwindow + iw1
-                    i2 = (ic2-1) * nwindow + iw2
-                    iw = iw2 - iw1 + 1
-                    cov(i1,i2) = &
-                        & dot_product(zvar(ic1, 1  : nt-iw+1),  &
-                        &             zvar(ic2, iw : nt     ))
-                    cov(i2,i1) = cov(i1,i2)
-                    nn(i1,i2) = dot_product(valid(ic1, 1  : nt-iw+1), &
-                                            valid(ic2, iw : nt     ))
-                    nn(i2,i1) = nn(i1,i2)
-                end do
+    if(zmethod==2)then
+
+        ! Lagged covariances and counts with GEMMs
+        allocate(zvalid(nchan,nt), lcov(nchan,nchan), lnn(nchan,nchan))
+        zvalid = dble(valid)
+        deallocate(valid)
+        do id = 0, nwindow-1
+
+            ! Lag id: lcov(ic1,ic2) = sum_t var(ic1,t)*var(ic2,t+id)
+            call dgemm('N', 'T', nchan, nchan, nt-id, 1d0, &
+                & zvar(:, 1:nt-id), nchan, zvar(:, 1+id:nt), nchan, &
+                & 0d0, lcov, nchan)
+            call dgemm('N', 'T', nchan, nchan, nt-id, 1d0, &
+                & zvalid(:, 1:nt-id), nchan, zvalid(:, 1+id:nt), nchan, &
+                & 0d0, lnn, nchan)
+            lcov = merge(lcov/lnn, 0d0, lnn>0.5d0)
+
+            ! Expansion to the block-Toeplitz matrix
+            do iw1 = 1, nwindow-id
+                iw2 = iw1 + id
+                cov(iw1:nsteof:nwindow, iw2:nsteof:nwindow) = lcov
+                cov(iw2:nsteof:nwindow, iw1:nsteof:nwindow) = transpose(lcov)
             end do
+
         end do
-    end do
-    !$OMP END DO
-    !$OMP END PARALLEL
-    deallocate(zvar,valid)
-    cov = merge(cov/dble(nn), 0d0, nn>0)
-    deallocate(nn)
+        deallocate(zvar, zvalid, lcov, lnn)
 
+    else
 
-!            do i2 = 1, nwindow
-!                do i1 = 1, iw2
-!                    iw = i2 - i1 + 1
-!                    cov(i1,i2) = &
-!                        & dot_product(zvar(1  : nt-iw+1),  &
-!                        &             zvar(iw : nt     ))!
-!                    cov(i2,i1) = cov(i1,i2)
-!                    nn(i1,i2) = dot_product(valid(1  : nt-iw+1), &
-!                                            valid(iw : nt     ))
-!                    nn(i2,i1) = nn(i1,i2)
-!                end do
-!            end do
+        ! One element at a time
+        allocate(nn(size(cov,1),size(cov,2)))
+
+        !$OMP PARALLEL &
+        !$OMP SHARED(zvar,cov,nchan,nwindow,valid,nn,nt) &
+        !$OMP PRIVATE(iw, iw1, iw2, i1, i2, ic1, ic2)
+        !$OMP DO
+        do ic1 = 1, nchan
+            do ic2 = 1, nchan
+                do iw2 = 1, nwindow
+                    do iw1 = 1, iw2
+                        i1 = (ic1-1) * nwindow + iw1
+                        i2 = (ic2-1) * nwindow + iw2
+                        iw = iw2 - iw1 + 1
+                        cov(i1,i2) = &
+                            & dot_product(zvar(ic1, 1  : nt-iw+1),  &
+                            &             zvar(ic2, iw : nt     ))
+                        cov(i2,i1) = cov(i1,i2)
+                        nn(i1,i2) = dot_product(valid(ic1, 1  : nt-iw+1), &
+                                                valid(ic2, iw : nt     ))
+                        nn(i2,i1) = nn(i1,i2)
+                    end do
+                end do
+            end do
+        end do
+        !$OMP END DO
+        !$OMP END PARALLEL
+        deallocate(zvar,valid)
+        cov = merge(cov/dble(nn), 0d0, nn>0)
+        deallocate(nn)
+
+    endif
 
 end subroutine sl_stcov
 
@@ -926,7 +1038,8 @@ end subroutine sl_stcov
 !############################################################
 
 
-subroutine sl_mssa_getec(var, steof, nwindow, stec, mv, minvalid, zerofill)
+subroutine sl_mssa_getec(var, steof, nwindow, stec, mv, minvalid, zerofill, &
+    & method)
 
     ! Computes MSSA expansion coefficients
     !
@@ -942,6 +1055,21 @@ subroutine sl_mssa_getec(var, steof, nwindow, stec, mv, minvalid, zerofill)
     !    - steof (nw*nc, nm): Space-window-mode EOFs
     !    - stec:  Time-mode array of expansion coefficients
     !
+    ! :Optional arguments:
+    !    - method: Computation method of the normalisation of gappy windows:
+    !
+    !       - 0: Automatic choice (2 when windows share a few validity
+    !         patterns, else 3).
+    !       - 1: One sum per time step and mode.
+    !       - 2: Time steps are grouped by validity pattern of their window,
+    !         and normalisations of all groups and modes are computed
+    !         with GEMMs on the validity of windows.
+    !       - 3: One GEMM per lag on the validity mask, matching
+    !         the projection.
+    !
+    !    Whatever the method, the projection is computed with one GEMM
+    !    per lag for all modes.
+    !
     ! :Dependencies:
     !    [sd]gemm(BLAS)
 
@@ -958,13 +1086,17 @@ subroutine sl_mssa_getec(var, steof, nwindow, stec, mv, minvalid, zerofill)
     integer,       intent(in)  :: nwindow
     real(8), intent(in), optional :: mv
     integer, intent(in), optional :: zerofill, & ! Fill var missing values with zeros?
-        & minvalid ! Minimal number of data available at one time step during projection
+        & minvalid, & ! Minimal number of data available at one time step during projection
+        & method
 
     ! Internal
     ! --------
-    integer :: nt, nkeep, im, iw, nchan, ntpc, it, zminvalid
-    real(8), allocatable :: wpc(:), substeof(:), subvar(:,:), norm(:,:), &
-        & zvalid(:,:)
+    integer :: nt, nkeep, im, iw, nchan, ntpc, it, zminvalid, zmethod, &
+        & ngroup, ncgroup, nblock, ib, nb, ig0
+    real(8), allocatable :: zvar(:,:), zsteof(:,:,:), norm(:,:), &
+        & zvalid(:,:), steof2(:,:), gnorm(:,:), wvalid(:,:), gcount(:), wcount(:)
+    integer, allocatable :: valid(:,:), cgroup(:), corder(:), cgstart(:), &
+        & wkeys(:,:), wgroup(:), worder(:), wgstart(:)
     real(8) :: zmv
 
     ! Computations
@@ -972,7 +1104,6 @@ subroutine sl_mssa_getec(var, steof, nwindow, stec, mv, minvalid, zerofill)
 
     ! Initialisations
     ! ---------------
-    stec = 0d0
     nchan = size(var,1)
     nt = size(var,2)
     nkeep = size(steof,2)
@@ -982,8 +1113,7 @@ subroutine sl_mssa_getec(var, steof, nwindow, stec, mv, minvalid, zerofill)
     else
         zmv = default_missing_value
     endif
-    allocate(wpc(ntpc), substeof(nchan), subvar(nchan, ntpc), norm(ntpc, nkeep))
-    allocate(zvalid(nchan, nwindow))
+    allocate(norm(ntpc, nkeep))
     norm = 0d0
     if(present(minvalid).and.minvalid/=0)then
         zminvalid = minvalid
@@ -993,32 +1123,120 @@ subroutine sl_mssa_getec(var, steof, nwindow, stec, mv, minvalid, zerofill)
     zminvalid = max(zminvalid, -100)
     if(zminvalid<0)zminvalid = -nchan*nwindow*zminvalid/100
     zminvalid = max(1, zminvalid)
+    zmethod = 0
+    if(present(method))zmethod = method
+
+    ! Data with zeros at missing values and ST-EOFs ordered as (nchan,nwindow,nkeep)
+    allocate(valid(nchan,nt), zvar(nchan,nt), zsteof(nchan,nwindow,nkeep))
+    valid = merge(0, 1, abs((var-zmv)/zmv)<=mvtol)
+    zvar = merge(var, 0d0, valid==1)
+    zsteof = reshape(steof, (/nchan, nwindow, nkeep/), order=(/2, 1, 3/))
 
-    ! Main stuff
+    ! Projection
     ! ----------
-    do im = 1, nkeep
-        do iw = 1, nwindow
-            subvar = merge(0d0, var(:,iw:iw+ntpc-1), &
-                & abs((var(:,iw:iw+ntpc-1)-zmv)/zmv)<=mvtol)
-            substeof = steof(iw:iw+(nchan-1)*nwindow:nwindow, im)
-            call dgemm('T', 'N', nt-nwindow+1, 1, nchan, 1d0,&
-                & subvar, nchan, substeof, nchan, 0d0, wpc, ntpc)
-            stec(:, im)  =  stec(:, im) + wpc
+    ! One GEMM per lag for all modes:
+    ! stec(it,im) += sum_ic zvar(ic,it+iw-1)*steof(ic,iw,im)
+    stec = 0d0
+    do iw = 1, nwindow
+        call dgemm('T', 'N', ntpc, nkeep, nchan, 1d0, zvar(1,iw), nchan, &
+            & zsteof(1,iw,1), nchan*nwindow, 1d0, stec, ntpc)
+    end do
+    deallocate(zvar)
+
+    ! Normalisation
+    ! -------------
+
+    ! Groups of windows with the same sequence of valid channels
+    if(zmethod==0 .or. zmethod==2)then
+        allocate(cgroup(nt), corder(nt), cgstart(nt+1))
+        call sl_group_columns(valid, cgroup, ncgroup, corder, cgstart)
+        deallocate(corder, cgstart)
+        allocate(wkeys(nwindow,ntpc), wgroup(ntpc), worder(ntpc), wgstart(ntpc+1))
+        do it = 1, ntpc
+            wkeys(:,it) = cgroup(it:it+nwindow-1)
         end do
-        do it=1, ntpc
-            zvalid = merge(0d0, 1d0, abs((var(:, it:it+nwindow-1)-zmv)/zmv)<=mvtol)
-            if(sum(zvalid)>=zminvalid)then
-                if(present(zerofill).and.zerofill/=0)then
-                    norm(it, im) = 1d0
-                else
-                    norm(it, im) = sum(transpose(reshape(steof(:,im)**2, &
-                        &(/nwindow, nchan/))) * zvalid)
+        deallocate(cgroup)
+        call sl_group_columns(wkeys, wgroup, ngroup, worder, wgstart)
+        deallocate(wkeys)
+        if(zmethod==0)zmethod = merge(2, 3, 4*ngroup<=ntpc)
+        if(zmethod==3)deallocate(wgroup, worder, wgstart)
+    endif
+
+    select case(zmethod)
+
+    case(1) ! One sum per time step and mode
+
+        allocate(zvalid(nchan, nwindow))
+        do im = 1, nkeep
+            do it=1, ntpc
+                zvalid = dble(valid(:, it:it+nwindow-1))
+                if(sum(zvalid)>=zminvalid)then
+                    if(present(zerofill).and.zerofill/=0)then
+                        norm(it, im) = 1d0
+                    else
+                        norm(it, im) = sum(transpose(reshape(steof(:,im)**2, &
+                            &(/nwindow, nchan/))) * zvalid)
+                    endif
                 endif
-            endif
+            end do
         end do
-        !stec(:, im) = stec(:, im) / sum(steof(:,im)**2)
-    end do
-    deallocate(subvar, substeof, zvalid, wpc)
+        deallocate(zvalid)
+
+    case(2) ! By validity pattern of windows
+
+        ! Squared ST-EOFs weighted by the validity of windows, by blocks of groups
+        allocate(steof2(nchan*nwindow,nkeep), gnorm(ngroup,nkeep), gcount(ngroup))
+        steof2 = steof**2
+        nblock = max(1, min(ngroup, 2**22/(nchan*nwindow)))
+        allocate(wvalid(nchan*nwindow,nblock))
+        do ig0 = 1, ngroup, nblock
+            nb = min(nblock, ngroup-ig0+1)
+            do ib = 1, nb
+                it = worder(wgstart(ig0+ib-1))
+                do iw = 1, nwindow
+                    wvalid(iw:nchan*nwindow:nwindow, ib) = dble(valid(:,it+iw-1))
+                end do
+                gcount(ig0+ib-1) = sum(wvalid(:,ib))
+            end do
+            call dgemm('T', 'N', nb, nkeep, nchan*nwindow, 1d0, &
+                & wvalid, nchan*nwindow, steof2, nchan*nwindow, &
+                & 0d0, gnorm(ig0,1), ngroup)
+        end do
+        deallocate(worder, wgstart, steof2, wvalid)
+
+        ! Normalisation of time steps
+        if(present(zerofill).and.zerofill/=0) gnorm = 1d0
+        do it = 1, ntpc
+            if(gcount(wgroup(it))>=zminvalid) norm(it,:) = gnorm(wgroup(it),:)
+        end do
+        deallocate(wgroup, gnorm, gcount)
+
+    case default ! One GEMM per lag on the validity mask
+
+        ! Squared ST-EOFs weighted by the validity
+        allocate(zvalid(nchan,nt))
+        zvalid = dble(valid)
+        zsteof = zsteof**2
+        do iw = 1, nwindow
+            call dgemm('T', 'N', ntpc, nkeep, nchan, 1d0, zvalid(1,iw), nchan, &
+                & zsteof(1,iw,1), nchan*nwindow, 1d0, norm, ntpc)
+        end do
+        if(present(zerofill).and.zerofill/=0) norm = 1d0
+
+        ! Number of valid data in windows
+        allocate(wcount(ntpc))
+        wcount = 0d0
+        do iw = 1, nwindow
+            wcount = wcount + sum(zvalid(:,iw:iw+ntpc-1), dim=1)
+        end do
+        do it = 1, ntpc
+            if(wcount(it)<zminvalid) norm(it,:) = 0d0
+        end do
+        deallocate(zvalid, wcount)
+
+    end select
+    deallocate(valid, zsteof)
+
     stec = merge(stec/norm, zmv, norm/=0d0)
 
 end subroutine sl_mssa_getec
@@ -1676,6 +1894,305 @@ end subroutine sl_svd_model_run
 ! ############################################################
 ! ############################################################
 
+subroutine sl_syev(cov, nkeep, ev, eigvec, solver, la_info, la_fname)
+    ! Leading eigen pairs of a symmetric matrix
+    !
+    ! :Description:
+    !
+    !    Compute the *nkeep* largest eigenvalues of a symmetric matrix
+    !    and the associated eigenvectors, sorted by decreasing order.
+    !    Subset drivers only compute the requested modes, which is
+    !    much faster than a full diagonalisation when *nkeep* is small
+    !    compared to the size of the matrix.
+    !
+    ! :Necessary arguments:
+    !
+    !    - *cov (n,n)*: Symmetric matrix (upper part used, destroyed on output)
+    !    - *nkeep*: Number of leading modes
+    !    - *ev (nkeep)*: Eigenvalues in decreasing order
+    !    - *eigvec (n,nkeep)*: Eigenvectors
+    !
+    ! :Optional arguments:
+    !
+    !    - *solver*: LAPACK driver [0 = auto, 1 = dsyev, 2 = dsyevr,
+    !      3 = dsyevx, 4 = dsyevd]. The auto mode uses dsyevr when
+    !      *nkeep* < n, else dsyevd.
+    !    - *la_info*: LAPACK error id
+    !    - *la_fname*: Name of the LAPACK routine
+    !
+    ! :Dependencies:
+    !    :func:`dsyev` :func:`dsyevr` :func:`dsyevx` :func:`dsyevd` (LAPACK)
+
+    implicit none
+
+    ! Declarations
+    ! ============
+
+    ! External
+    ! --------
+    real(8), intent(inout) :: cov(:,:)
+    integer, intent(in) :: nkeep
+    real(8), intent(out) :: ev(nkeep), eigvec(size(cov,1),nkeep)
+    integer, intent(in), optional :: solver
+    integer, intent(out), optional :: la_info
+    character(len=*), intent(out), optional :: la_fname
+
+    ! Internal
+    ! --------
+    integer :: n, zsolver, info, lwork, liwork, m
+    real(8), allocatable :: zev(:), work(:)
+    integer, allocatable :: iwork(:), isuppz(:), ifail(:)
+    real(8) :: abstol
+    character(len=20) :: fname
+    real(8), external :: dlamch
+
+    ! Setup
+    ! =====
+    n = size(cov,1)
+    zsolver = 0
+    if(present(solver))zsolver = solver
+    if(zsolver<=0 .or. zsolver>4)then
+        if(nkeep<n)then
+            zsolver = 2
+        else
+            zsolver = 4
+        endif
+    endif
+    allocate(zev(n))
+
+    ! Diagonalisation
+    ! ===============
+    select case(zsolver)
+
+    case(2) ! Relatively robust representations, subset
+
+        fname = 'DSYEVR'
+        allocate(isuppz(2*nkeep), work(1), iwork(1))
+        abstol = 0d0
+        call dsyevr('V', 'I', 'U', n, cov, n, 0d0, 0d0, n-nkeep+1, n, &
+            & abstol, m, zev, eigvec, n, isuppz, work, -1, iwork, -1, info)
+        if(info==0)then
+            lwork = int(work(1))
+            liwork = iwork(1)
+            deallocate(work, iwork)
+            allocate(work(lwork), iwork(liwork))
+            call dsyevr('V', 'I', 'U', n, cov, n, 0d0, 0d0, n-nkeep+1, n, &
+                & abstol, m, zev, eigvec, n, isuppz, work, lwork, iwork, &
+                & liwork, info)
+        else
+            fname = trim(fname)//' (init phase)'
+        endif
+        deallocate(work, iwork, isuppz)
+        ev = zev(nkeep:1:-1)
+        eigvec = eigvec(:, nkeep:1:-1)
+
+    case(3) ! Bisection and inverse iterations, subset
+
+        fname = 'DSYEVX'
+        allocate(iwork(5*n), ifail(n), work(1))
+        abstol = 2d0*dlamch('S')
+        call dsyevx('V', 'I', 'U', n, cov, n, 0d0, 0d0, n-nkeep+1, n, &
+            & abstol, m, zev, eigvec, n, work, -1, iwork, ifail, info)
+        if(info==0)then
+            lwork = int(work(1))
+            deallocate(work)
+            allocate(work(lwork))
+            call dsyevx('V', 'I', 'U', n, cov, n, 0d0, 0d0, n-nkeep+1, n, &
+                & abstol, m, zev, eigvec, n, work, lwork, iwork, ifail, info)
+        else
+            fname = trim(fname)//' (init phase)'
+        endif
+        deallocate(work, iwork, ifail)
+        ev = zev(nkeep:1:-1)
+        eigvec = eigvec(:, nkeep:1:-1)
+
+    case(4) ! Divide and conquer, full spectrum
+
+        fname = 'DSYEVD'
+        allocate(work(1), iwork(1))
+        call dsyevd('V', 'U', n, cov, n, zev, work, -1, iwork, -1, info)
+        if(info==0)then
+            lwork = int(work(1))
+            liwork = iwork(1)
+            deallocate(work, iwork)
+            allocate(work(lwork), iwork(liwork))
+            call dsyevd('V', 'U', n, cov, n, zev, work, lwork, iwork, &
+                & liwork, info)
+        else
+            fname = trim(fname)//' (init phase)'
+        endif
+        deallocate(work, iwork)
+        ev = zev(n:n-nkeep+1:-1)
+        eigvec = cov(:, n:n-nkeep+1:-1)
+
+    case default ! Standard driver, full spectrum
+
+        fname = 'DSYEV'
+        allocate(work(1))
+        call dsyev('V', 'U', n, cov, n, zev, work, -1, info)
+        if(info==0)then
+            lwork = int(work(1))
+            deallocate(work)
+            allocate(work(lwork))
+            call dsyev('V', 'U', n, cov, n, zev, work, lwork, info)
+        else
+            fname = trim(fname)//' (init phase)'
+        endif
+        deallocate(work)
+        ev = zev(n:n-nkeep+1:-1)
+        eigvec = cov(:, n:n-nkeep+1:-1)
+
+    end select
+    deallocate(zev)
+
+    if(present(la_info))la_info = info
+    if(present(la_fname))la_fname = fname
+
+end subroutine sl_syev
+
+
+subroutine sl_group_columns(keys, group, ngroup, order, gstart)
+    ! Group identical columns of an integer array
+    !
+    ! :Description:
+    !
+    !    Columns are sorted according to a random linear hash, and
+    !    columns sharing the same hash are compared element by element,
+    !    so that groups are exact.
+    !
+    ! :Necessary arguments:
+    !
+    !    - *keys (m,n)*: Integer array
+    !    - *group (n)*: Group id of each column, from 1 to *ngroup*
+    !    - *ngroup*: Number of groups
+    !    - *order (n)*: Column indices sorted by group
+    !    - *gstart (n+1)*: Columns of group *ig* are
+    !      ``order(gstart(ig):gstart(ig+1)-1)``
+
+    implicit none
+
+    ! External
+    integer, intent(in)  :: keys(:,:)
+    integer, intent(out) :: group(size(keys,2)), ngroup, order(size(keys,2)), &
+        & gstart(size(keys,2)+1)
+
+    ! Internal
+    real(8), allocatable :: weights(:), hash(:)
+    integer, allocatable :: isort(:), rep(:), gpos(:)
+    integer(8) :: seed
+    integer :: m, n, i, j, k, ig, ig0
+
+    m = size(keys,1)
+    n = size(keys,2)
+
+    ! Hash with weights from a Park-Miller generator
+    allocate(weights(m), hash(n), isort(n))
+    seed = 12345_8
+    do i = 1, m
+        seed = modulo(seed*16807_8, 2147483647_8)
+        weights(i) = 0.5d0 + dble(seed)/2147483647d0
+    end do
+    do j = 1, n
+        hash(j) = sum(dble(keys(:,j))*weights)
+    end do
+    deallocate(weights)
+    call sl_argsort(hash, isort)
+
+    ! Exact groups within runs of equal hashes
+    allocate(rep(n))
+    ngroup = 0
+    i = 1
+    do while(i<=n)
+        j = i
+        do while(j<n)
+            if(hash(isort(j+1))/=hash(isort(i)))exit
+            j = j+1
+        end do
+        ig0 = ngroup
+        do k = i, j
+            group(isort(k)) = 0
+            do ig = ig0+1, ngroup
+                if(all(keys(:,isort(k))==keys(:,rep(ig))))then
+                    group(isort(k)) = ig
+                    exit
+                endif
+            end do
+            if(group(isort(k))==0)then
+                ngroup = ngroup+1
+                rep(ngroup) = isort(k)
+                group(isort(k)) = ngroup
+            endif
+        end do
+        i = j+1
+    end do
+    deallocate(hash, isort, rep)
+
+    ! Columns sorted by group
+    gstart = 0
+    do j = 1, n
+        gstart(group(j)+1) = gstart(group(j)+1)+1
+    end do
+    gstart(1) = 1
+    do ig = 1, ngroup
+        gstart(ig+1) = gstart(ig+1)+gstart(ig)
+    end do
+    allocate(gpos(ngroup))
+    gpos = gstart(1:ngroup)
+    do j = 1, n
+        order(gpos(group(j))) = j
+        gpos(group(j)) = gpos(group(j))+1
+    end do
+    deallocate(gpos)
+
+end subroutine sl_group_columns
+
+
+subroutine sl_argsort(x, idx)
+    ! Indices that sort a real array in increasing order (heap sort)
+
+    implicit none
+
+    ! External
+    real(8), intent(in)  :: x(:)
+    integer, intent(out) :: idx(size(x))
+
+    ! Internal
+    integer :: n, i, tmp
+
+    n = size(x)
+    idx = (/(i, i=1,n)/)
+    do i = n/2, 1, -1
+        call sift(i, n)
+    end do
+    do i = n, 2, -1
+        tmp = idx(1)
+        idx(1) = idx(i)
+        idx(i) = tmp
+        call sift(1, i-1)
+    end do
+
+contains
+
+    subroutine sift(start, last)
+        integer, intent(in) :: start, last
+        integer :: root, child, tmp
+        root = start
+        do while(2*root<=last)
+            child = 2*root
+            if(child<last)then
+                if(x(idx(child+1))>x(idx(child)))child = child+1
+            endif
+            if(x(idx(root))>=x(idx(child)))return
+            tmp = idx(root)
+            idx(root) = idx(child)
+            idx(child) = tmp
+            root = child
+        end do
+    end subroutine sift
+
+end subroutine sl_argsort
+
+
 function sl_errmsg(ierr, fname, msg, la_info, la_fname)
     ! Generate an error message
 
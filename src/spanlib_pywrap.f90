@@ -22,7 +22,7 @@
 ! ================
 
 subroutine pca(var, ns, nt, nkeep, xeof, pc, ev, ev_sum, &
-    & mv, useteof, notpc, minecvalid, zerofill, errmsg)
+    & mv, useteof, notpc, minecvalid, zerofill, solver, evtarget, nkept, errmsg)
 
     use spanlib, only: sl_pca
 
@@ -39,18 +39,21 @@ subroutine pca(var, ns, nt, nkeep, xeof, pc, ev, ev_sum, &
     real(8),    intent(out) :: ev_sum
     integer, intent(in), optional  :: useteof, notpc
     character(len=120), intent(out), optional :: errmsg
-    integer, intent(in), optional :: zerofill, minecvalid
+    integer, intent(in), optional :: zerofill, minecvalid, solver
+    real(8),    intent(in), optional :: evtarget
+    integer, intent(out) :: nkept
 
     ! Call to original subroutine
     ! ---------------------------
     call sl_pca(var, nkeep, xeof=xeof, pc=pc, ev=ev, ev_sum=ev_sum,&
      & mv=mv, useteof=useteof, notpc=notpc, &
-     & minecvalid=minecvalid, zerofill=zerofill, errmsg=errmsg)
+     & minecvalid=minecvalid, zerofill=zerofill, solver=solver, &
+     & evtarget=evtarget, nkept=nkept, errmsg=errmsg)
 
 end subroutine pca
 
 subroutine pca_getec(var, xeof, ns, nt, nkept, ec, mv, &
-    & minvalid, zerofill, demean)
+    & minvalid, zerofill, demean, method)
 
     use spanlib, only: sl_pca_getec
 
@@ -61,12 +64,12 @@ subroutine pca_getec(var, xeof, ns, nt, nkept, ec, mv, &
     integer, intent(in)  :: ns,nt,nkept
     real(8),    intent(in)  :: var(ns,nt), xeof(ns,nkept), mv
     real(8),    intent(out) :: ec(nt,nkept)
-    integer, intent(in), optional :: zerofill, minvalid, demean
+    integer, intent(in), optional :: zerofill, minvalid, demean, method
 
     ! Call to original subroutine
     ! ---------------------------
     call sl_pca_getec(var, xeof, ec, mv=mv, &
-        & minvalid=minvalid, zerofill=zerofill, demean=demean)
+        & minvalid=minvalid, zerofill=zerofill, demean=demean, method=method)
 
 end subroutine pca_getec
 
@@ -194,7 +197,7 @@ subroutine mssa(var, nchan, nt, nwindow, nkeep, steof, &
 
 end subroutine mssa
 
-subroutine stcov(var, cov, nchan, nt, nwindow, mv)
+subroutine stcov(var, cov, nchan, nt, nwindow, mv, method)
 
     use spanlib, only: sl_stcov
 
@@ -205,16 +208,17 @@ subroutine stcov(var, cov, nchan, nt, nwindow, mv)
     integer, intent(in)  :: nchan, nt, nwindow
     real(8),    intent(in)  :: var(nchan,nt), mv
     real(8),    intent(out) :: cov(nchan*nwindow,nchan*nwindow)
+    integer, intent(in), optional :: method
 
     ! Call to original subroutine
     ! ---------------------------
-    call sl_stcov(var, cov, mv=mv)
+    call sl_stcov(var, cov, mv=mv, method=method)
 
 end subroutine stcov
 
 
 subroutine mssa_getec(var, steof, nchan, nt, nkept, nwindow, stec, &
-    & mv, minvalid, zerofill)
+    & mv, minvalid, zerofill, method)
 
     use spanlib, only: sl_mssa_getec
 
@@ -226,12 +230,12 @@ subroutine mssa_getec(var, steof, nchan, nt, nkept, nwindow, stec, &
     real(8),    intent(in) :: var(nchan,nt), &
      & steof(nchan*nwindow,nkept), mv
     real(8),    intent(out)  :: stec(nt-nwindow+1, nkept)
-    integer, intent(in), optional :: zerofill, minvalid
+    integer, intent(in), optional :: zerofill, minvalid, method
 
     ! Call to original subroutine
     ! ---------------------------
     call sl_mssa_getec(var, steof, nwindow, stec, mv=mv, &
-        & minvalid=minvalid, zerofill=zerofill)
+        & minvalid=minvalid, zerofill=zerofill, method=method)
 
 end subroutine mssa_getec
 
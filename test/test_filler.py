@@ -1,10 +1,12 @@
 import unittest
 import numpy as npy
-import os, sys
+import os, sys, tempfile, shutil
 sys.path.insert(0, '../lib')
 from spanlib.analyzer import Analyzer
-from spanlib.filler import Filler
-from spanlib_extra import setup_data1, setup_data2, gensin2d
+from spanlib.filler import (Filler, FillerError, TiledFiller, fill_sweep, fill_batch,
+    gen_cv_mask, _get_cverror_)
+from spanlib_extra import (setup_data1, setup_data2, setup_data3, setup_holes1,
+    gensin2d)
 
 
 class TSF(unittest.TestCase):
@@ -33,9 +35,7 @@ class TSF(unittest.TestCase):
     def test_fill_simple(self):
         """Test hole filling and forecast estimation with a single variable"""
         # Init
-        ref = setup_data1(nt=50, nx=120, xyfact=0)
-        withholes = ref.copy()
-        withholes[25:35, 50:60] = npy.ma.masked
+        ref, withholes = setup_holes1()
 
         # Fill
         F = Filler(withholes, loglevel='error', cvfield_level=10., npca=2)
@@ -55,6 +55,251 @@ class TSF(unittest.TestCase):
         npy.testing.assert_almost_equal(filtered.filled()[22:24,0],
             npy.array([-0.1510115, -0.421256]))
 
+    def test_fill_kfold(self):
+        """Test hole filling with a parallel k-fold cross-validation"""
+        ref, withholes = setup_holes1()
+        kw = dict(loglevel='error', cvfield_level=10., npca=3, nfold=3,
+            cvfield_seed=1)
+        F1 = Filler(withholes, nproc=1, **kw)
+        F3 = Filler(withholes, nproc=3, **kw)
+        self.assertEqual(len(F3._cvfold_errors), 3)
+        self.assertEqual(F1._nmodes, F3._nmodes)
+        npy.testing.assert_almost_equal(F1.filtered.filled(),
+            F3.filtered.filled())
+        self.assertTrue(abs(F3.filtered-ref)[25:35, 50:60].mean() < 0.05)
+
+    def test_fill_plain_rec(self):
+        """Test that reconstructions and errors of the EC loop are not masked"""
+        ref, withholes = setup_holes1()
+        withholes[10:13] = npy.ma.masked
+        kw = dict(loglevel='error', cvfield_level=10., npca=3, nmssa=3,
+            window=10, cvfield_seed=1)
+        F = Filler(withholes, run=False, **kw)
+        stages = []
+        F.fill(callback=lambda stage: stages.append((stage['analysis'],
+            type(F._rec), stage['error'])), **kw)
+        self.assertEqual(set([ana for ana, rectype, err in stages]),
+            set(['pca', 'mssa']))
+        for ana, rectype, err in stages:
+            self.assertTrue(rectype is npy.ndarray)
+            self.assertTrue(isinstance(err, float))
+
+    def test_fill_increc(self):
+        """Test the incremental reconstruction of modes"""
+        ref = setup_data3()
+        withholes = npy.ma.array(ref)
+        withholes[100:140, 10:30] = npy.ma.masked
+        filtered = []
+        for increc in True, False:
+            npy.random.seed(0)
+            F = Filler(withholes, loglevel='error', cvfield_level=5., npca=10,
+                mssa=False, nreanapca=1, increc=increc)
+            filtered.append(F.filtered.filled())
+            self.assertTrue(F._nmodes['pca'][0][0]>=3)
+        npy.testing.assert_almost_equal(filtered[0], filtered[1])
+
+    def test_fill_ecaccel(self):
+        """Test the acceleration of the EC convergence loop"""
+        ref = setup_data3(nt=600, nx=80, periods=(50, 31, 23, 17, 11, 7))
+        withholes = ref.copy()
+        withholes[100:300, 10:50] = npy.ma.masked
+        withholes[400:500, 30:70] = npy.ma.masked
+        nsteps = {}
+        for ecaccel in None, 'anderson':
+            npy.random.seed(0)
+            F = Filler(withholes, loglevel='error', cvfield_level=5., npca=10,
+                mssa=False, nreanapca=1, errchmax=-0.001, nitermax=50,
+                ecaccel=ecaccel)
+            nsteps[ecaccel] = sum([len(errs) for anamode in (0, 2)
+                for errs in F._errors[anamode]['pca'][0]])
+            self.assertTrue(abs(F.filtered-ref)[withholes.mask].std() < 0.2)
+        self.assertTrue(nsteps['anderson'] < 0.7*nsteps[None])
+
+    def test_fill_tiled(self):
+        """Test hole filling by overlapping tiles"""
+        rs = npy.random.RandomState(1)
+        t = npy.arange(200.)[:, None, None]
+        yy, xx = npy.mgrid[:20, :30]
+        ref = npy.ma.array(npy.sin(2*npy.pi*(t/50.+xx/30.))*npy.cos(yy/10.) +
+            0.5*npy.sin(2*npy.pi*t/23.+yy/7.) + 0.05*rs.randn(200, 20, 30))
+        withholes = ref.copy()
+        withholes[100:130, 5:12, 10:20] = npy.ma.masked
+        filled = []
+        for nproc in 1, 2:
+            F = TiledFiller(withholes, tilesize=(10, 15), overlap=3, nproc=nproc,
+                seed=0, loglevel='error', npca=8, mssa=False)
+            self.assertEqual(len(F.tiles), 4)
+            self.assertEqual(F.filled.shape, ref.shape)
+            self.assertFalse(npy.ma.getmaskarray(F.filled).any())
+            filled.append(F.filled)
+        npy.testing.assert_almost_equal(filled[0], filled[1])
+        npy.testing.assert_almost_equal(filled[0][~withholes.mask],
+            ref[~withholes.mask])
+        self.assertTrue(abs(filled[0]-ref)[withholes.mask].std() < 0.3)
+
+    def test_fill_checkpoint(self):
+        """Test the resume of an interrupted filling from a checkpoint"""
+        ref, withholes = setup_holes1()
+        kw = dict(loglevel='error', cvfield_level=10., npca=3, nmssa=3,
+            window=10, cvfield_seed=1)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            F = Filler(withholes, **kw)
+            save = Filler._save_checkpoint_
+            def interrupt(self, stage, **kwargs):
+                save(self, stage, **kwargs)
+                if stage==(0, 0, 1, 0): # second cross-validated pca
+                    raise KeyboardInterrupt
+            Filler._save_checkpoint_ = interrupt
+            try:
+                self.assertRaises(KeyboardInterrupt, Filler, withholes,
+                    checkpoint=tmpdir, **kw)
+            finally:
+                Filler._save_checkpoint_ = save
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, 'filler.pkl')))
+            other = withholes.copy()
+            other[0, 0] += 1
+            self.assertRaises(FillerError, Filler, other, checkpoint=tmpdir,
+                resume=True, **kw)
+            kwo = dict(kw, npca=4)
+            self.assertRaises(FillerError, Filler, withholes, checkpoint=tmpdir,
+                resume=True, **kwo)
+            npy.random.seed(3)
+            npy.random.randint(0, 2**31-1) # seed of the filler
+            rstate = npy.random.get_state()
+            npy.random.seed(3)
+            R = Filler(withholes, checkpoint=tmpdir, resume=True, **kw)
+            npy.testing.assert_equal(npy.random.get_state()[1], rstate[1])
+            self.assertEqual(R._nmodes, F._nmodes)
+            npy.testing.assert_almost_equal(R.filtered.filled(),
+                F.filtered.filled())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_fill_deadline(self):
+        """Test the time-budgeted filling and the progress callback"""
+        ref, withholes = setup_holes1()
+        kw = dict(loglevel='error', cvfield_level=10., npca=3, cvfield_seed=1)
+        stages = []
+        F = Filler(withholes, callback=stages.append, **kw)
+        self.assertEqual(len(stages), sum([len(errs) for anamode in (0, 2)
+            for reana in F._errors[anamode]['pca'] for errs in reana]))
+        self.assertEqual(stages[-1], F.stage)
+        self.assertFalse(F.stage['timedout'])
+        mask = npy.ma.getmaskarray(F.filled)
+        stages = []
+        F = Filler(withholes, deadline=0, callback=stages.append, **kw)
+        self.assertEqual(len(stages), 1)
+        self.assertTrue(F.stage['timedout'])
+        self.assertEqual((F.stage['anamode'], F.stage['analysis']), (2, 'pca'))
+        self.assertTrue((npy.ma.getmaskarray(F.filled)==mask).all())
+
+    def test_fill_update(self):
+        """Test the update of a filling with new time steps"""
+        ref = setup_data3(nt=650, nx=80, periods=(50, 31, 23, 17, 11, 7))
+        withholes = ref.copy()
+        withholes[100:300, 10:50] = npy.ma.masked
+        withholes[560:580, 20:40] = npy.ma.masked
+        withholes[620:640, 0:30] = npy.ma.masked
+        F = Filler(withholes[:550], loglevel='error', cvfield_level=5., npca=10,
+            cvfield_seed=0)
+        for it in 550, 600:
+            filled = F.update(withholes[it:it+50], refit=False)
+            self.assertEqual(filled.shape, (50, 80))
+            self.assertFalse(F.needs_refit)
+            self.assertTrue(abs(filled-ref[it:it+50])[withholes.mask[it:it+50]].std() < 0.1)
+        self.assertEqual(F._data.shape, (650, 80))
+        self.assertEqual(F.span.nt, 550)
+        F.update(npy.random.RandomState(1).randn(50, 80), refit=False)
+        self.assertTrue(F.needs_refit)
+
+    def test_fill_sweep(self):
+        """Test the parallel sweep of filling parameters"""
+        ref, withholes = setup_holes1()
+        tables = []
+        for nproc in 1, 2:
+            table, best = fill_sweep(withholes, npca=[1, 3], nmssa=4, window=[5, 10],
+                nproc=nproc, seed=1, loglevel='error', cvfield_level=10.)
+            self.assertEqual([(row['npca'], row['window']) for row in table],
+                [(1, 5), (1, 10), (3, 5), (3, 10)])
+            self.assertEqual(best['error'], min([row['error'] for row in table]))
+            tables.append([row['error'] for row in table])
+        npy.testing.assert_almost_equal(tables[0], tables[1])
+        self.assertEqual(best['npca'], 3)
+        table, best = fill_sweep(withholes, npca=3, nmssa=4, window=[5, 10],
+            nproc=2, seed=1, loglevel='error', cvfield_level=10.)
+        npy.testing.assert_almost_equal([row['error'] for row in table],
+            tables[0][2:])
+
+    def test_fill_sweep_reuse(self):
+        """Test that sweep combinations do not depend on the previous ones"""
+        ref, withholes = setup_holes1()
+        withholes[5:8] = npy.ma.masked # gaps in PCs too for MSSA
+        table, best = fill_sweep(withholes, npca=[3, 1], nmssa=4, window=[10, 5],
+            nproc=1, seed=1, loglevel='error', cvfield_level=10.)
+        for row in table:
+            F = Filler(withholes, npca=row['npca'], nmssa=4, window=row['window'],
+                cvonly=True, cvfield_seed=1, loglevel='error', cvfield_level=10.)
+            self.assertEqual(F.span.npca, row['npca'])
+            self.assertTrue('mssa' in F._analyzes)
+            self.assertEqual(F._nmodes['pca'][-1][0]+1, row['pca_nmodes'])
+            self.assertEqual(F._nmodes['mssa'][-1][0]+1, row['mssa_nmodes'])
+            npy.testing.assert_almost_equal(_get_cverror_(F, 'pca'),
+                row['pca_error'])
+            npy.testing.assert_almost_equal(_get_cverror_(F, 'mssa'),
+                row['mssa_error'])
+
+    def test_fill_gcv(self):
+        """Test the selection of the number of modes with GCV"""
+        ref = setup_data3()
+        withholes = ref.copy()
+        withholes[100:140, 10:30] = npy.ma.masked
+        ntrials = {}
+        for gcv in False, True, 3:
+            npy.random.seed(0)
+            F = Filler(withholes, loglevel='error', cvfield_level=5., npca=10,
+                mssa=False, gcv=gcv)
+            self.assertEqual(F._nmodes['pca'][0][0], 4)
+            ntrials[gcv] = len(F._errors[2]['pca'][0])
+        self.assertEqual(ntrials[True], 1)
+        self.assertEqual(ntrials[3], 3)
+        self.assertTrue(ntrials[False] > 3)
+
+    def test_fill_batch(self):
+        datas = [setup_data1(nt=60, nx=n) for n in (30, 50)]
+        for data in datas:
+            data[20:25, 5:10] = npy.ma.masked
+        results, report = fill_batch(datas, [dict(npca=4), dict(npca=6)],
+            nproc=2, nmssa=4, cvfield_seed=0, loglevel='error')
+        for data, npca, filled, rep in zip(datas, (4, 6), results, report):
+            F = Filler(data, npca=npca, nmssa=4, cvfield_seed=0, loglevel='error')
+            self.assertTrue(npy.ma.allclose(filled, F.filled))
+            self.assertTrue(rep['error'] is None)
+            self.assertTrue(rep['time']>0 and rep['memory']>0)
+
+    def test_gen_cv_mask(self):
+        rs = npy.random.RandomState(0)
+        data = npy.ma.masked_where(rs.rand(80, 120)<0.9, rs.randn(80, 120))
+        masks = gen_cv_mask(data, 10., nfold=2, nmask=3, seed=0)
+        self.assertEqual(len(masks), 3)
+        for folds in masks:
+            self.assertEqual(len(folds), 2)
+            for mask in folds:
+                for axis in 0, 1:
+                    self.assertTrue(((~mask).any(axis=axis)==
+                        (~data.mask).any(axis=axis)).all())
+                self.assertEqual((mask&~data.mask).sum(), 94)
+            self.assertFalse((folds[0]&folds[1]&~data.mask).any())
+        self.assertTrue((masks[0][0]!=masks[1][0]).any())
+
+    def test_gen_cv_mask_single_channel(self):
+        data = npy.ma.masked_where(npy.arange(500)%7==0,
+            npy.sin(npy.arange(500.)))[None]
+        mask = gen_cv_mask(data, 10., seed=0)
+        self.assertEqual((mask&~data.mask).sum(), int(data.count()*0.1))
+        self.assertTrue((~mask).any())
+        self.assertRaises(FillerError, gen_cv_mask, npy.ma.masked_all((1, 500)), 10.)
+
     def test_fill_double(self):
         """Test gap filling and forecast estimate with a pair of variables"""
         # Init
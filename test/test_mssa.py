@@ -2,7 +2,9 @@ import unittest
 import numpy as npy
 import os, sys
 sys.path.insert(0, '../lib')
-from spanlib.analyzer import Analyzer
+from spanlib.analyzer import Analyzer, RedNoise
+from spanlib.engines import stcov, get_anomalies, trajectory_view
+from spanlib import _core
 from spanlib_extra import setup_data2, setup_data1, setup_data0
 
 #import pylab as P
@@ -179,6 +181,110 @@ class TestSequenceFunctions(unittest.TestCase):
         xrec = span.mssa_rec(xeof=xeof, xpc=xpc)
         self.assertTrue(npy.allclose(rec, xrec))
 
+    def test_mssa_lanczos(self):
+        data = setup_data2(nx=3, ny=2)
+        span = Analyzer(data, nmssa=4)
+        ref_ev = span.mssa_ev()
+        self.assertEqual(span._mssasolver, 'syev') # opt-in lanczos
+        ref_eof = span.mssa_eof(raw=True).copy()
+        ref_pc = span.mssa_pc(raw=True).copy()
+        span.mssa(solver='lanczos', lanczos_seed=0, force=True)
+        self.assertTrue(npy.allclose(span.mssa_ev(), ref_ev))
+        self.assertTrue(npy.allclose(span.mssa_eof(raw=True), ref_eof, atol=1e-6))
+        self.assertTrue(npy.allclose(span.mssa_pc(raw=True), ref_pc, atol=1e-4))
+
+
+    def test_mssa_svd(self):
+        data = setup_data2(nx=3, ny=2)
+        span = Analyzer(data, nmssa=4)
+        span.mssa(solver='svd', rsvd_seed=0)
+        anom = npy.ascontiguousarray(get_anomalies(span.stacked_data))
+        traj = trajectory_view(anom, span.window).reshape(-1, 120-span.window+1)
+        ss = npy.linalg.svd(traj, compute_uv=False)
+        self.assertTrue(npy.allclose(span.mssa_ev(), ss[:4]**2/traj.shape[1]))
+        self.assertAlmostEqual(span.mssa_ev(sum=True), (ss**2).sum()/traj.shape[1])
+        self.assertTrue(npy.allclose(span.mssa_pc(raw=True),
+            span.mssa_ec(raw=True), atol=1e-6))
+
+    def test_stcov_methods(self):
+        data = setup_data2(nx=3, ny=2)
+        span = Analyzer(data)
+        pdata = span.stacked_data
+        pdata[1, 10:15] = 1e20
+        ref = stcov(pdata, 20, method='loop')
+        for method in 'gemm', 'fft', 'auto':
+            self.assertTrue(npy.allclose(stcov(pdata, 20, method=method), ref))
+
+
+    def test_mssa_ec_methods(self):
+        span = Analyzer(setup_data2(nx=3, ny=2), window=10, nmssa=4)
+        pdata = span.stacked_data.copy()
+        pdata[1, 10:15] = 1e20
+        pdata[2:4, 40:48] = 1e20
+        steof = npy.asfortranarray(span.mssa_eof(raw=True).reshape(-1, 4))
+        ref = _core.mssa_getec(npy.asfortranarray(pdata), steof, 10, mv=1e20,
+            method=1)
+        for method in 0, 2, 3:
+            ec = _core.mssa_getec(npy.asfortranarray(pdata), steof, 10, mv=1e20,
+                method=method)
+            self.assertTrue(npy.allclose(ec, ref))
+
+    def test_mssa_mctest_parallel(self):
+        data = setup_data1(nx=5, masked=False)
+        span = Analyzer(data)
+        ev, evmin, evmax = span.mssa_ev(nmssa=4, mctest=True, mcnens=20,
+            mcseed=1)
+        pev, pevmin, pevmax = span.mssa_ev(nmssa=4, mctest=True, mcnens=20,
+            mcseed=1, mcnproc=2, mcchunksize=3)
+        self.assertTrue(npy.allclose(evmin, pevmin))
+        self.assertTrue(npy.allclose(evmax, pevmax))
+        self.assertTrue((evmin<=evmax).all())
+
+    def test_mssa_mctest_lags(self):
+        data = setup_data1(nx=5, masked=False)
+        span = Analyzer(data)
+        ev, evmin, evmax = span.mssa_ev(nmssa=4, mctest=True, mcnens=20,
+            mcseed=1, mcmethod='cov')
+        lev, levmin, levmax = span.mssa_ev(nmssa=4, mctest=True, mcnens=20,
+            mcseed=1, mcmethod='lags')
+        self.assertTrue(npy.allclose(evmin, levmin))
+        self.assertTrue(npy.allclose(evmax, levmax))
+
+    def test_rednoise_sample(self):
+        data = setup_data1(nx=5, masked=False)
+        rn = RedNoise(data)
+        samples = rn.sample(4, seed=[1, 2, 3, 4], dtype='f')
+        self.assertEqual(samples.shape, (4, )+data.shape)
+        self.assertEqual(samples.dtype, npy.dtype('f'))
+        self.assertTrue(npy.allclose(samples[1], rn.sample(seed=2), atol=1e-5))
+        nsamples = [b.shape[0] for b in rn.iter_samples(10, batchsize=4)]
+        self.assertEqual(nsamples, [4, 4, 2])
+
+    def test_rednoise_ar1_filter(self):
+        data = setup_data1(nt=103, nx=5, masked=False)
+        rn = RedNoise(data)
+        samples = rn.sample(50, seed=1)
+
+        # Reference: explicit recursion over time on the same white noise
+        ref = npy.random.RandomState(1).standard_normal((50, )+data.shape)
+        ref /= ref.std(axis=1, ddof=1)[:, None]
+        ref *= rn.alpha
+        for it in xrange(1, data.shape[0]):
+            ref[:, it] += rn.gamma*ref[:, it-1]
+        ref -= ref.mean(axis=1)[:, None]
+        self.assertTrue(npy.allclose(samples, ref))
+
+        # Statistics of the AR(1) process
+        lag1 = (samples[:, 1:]*samples[:, :-1]).sum(axis=1) / \
+            (samples**2).sum(axis=1)
+        self.assertTrue(npy.allclose(lag1.mean(axis=0), rn.gamma, atol=0.1))
+        for nt in 1, 2, 17:
+            white = npy.random.RandomState(nt).randn(3, nt, 5)
+            red = white.copy()
+            for it in xrange(1, nt):
+                red[:, it] += rn.gamma*red[:, it-1]
+            self.assertTrue(npy.allclose(RedNoise._ar1_filter_(white, rn.gamma),
+                red))
 
 #    def test_mssa_mctest(self):
 #        data = setup_data1(nx=5, masked=False)
@@ -1,8 +1,10 @@
 import unittest
 import numpy as npy
-import os, sys
+import os, sys, tempfile, shutil
 sys.path.insert(0, '../lib')
 from spanlib.analyzer import Analyzer
+from spanlib.engines import ooc_pca
+from spanlib import _core
 from spanlib_extra import pca_numpy, setup_data1, setup_data2
 
 
@@ -97,6 +99,96 @@ class TSF(unittest.TestCase):
         xrec = A.pca_rec(xeof=xeof, xpc=xpc)
         self.assertTrue(npy.allclose(rec, xrec))
 
+    def test_pca_solvers(self):
+        A = Analyzer(setup_data1(nt=70, nx=150))
+        ref_ev = A.pca_ev(solver='syev')
+        ref_eof = A.pca_eof(raw=True)
+        for solver in 'syevr', 'syevx', 'syevd':
+            A.pca(solver=solver, force=True)
+            self.assertTrue(npy.allclose(A.pca_ev(), ref_ev))
+            self.assertTrue(npy.allclose(A.pca_eof(raw=True), ref_eof))
+
+    def test_pca_evtarget(self):
+        A = Analyzer(setup_data1(nt=70, nx=150), npca=40)
+        A.pca(evtarget=95.)
+        self.assertEqual(A.npca, 5)
+        self.assertEqual(A.pca_pc().shape, (5, 70))
+        self.assertTrue(A.pca_ev(relative=True, cumsum=True)[-1] >= 95.)
+        for evtarget, npca in (99.9, 40), (0, 40), (95., 5), (None, 40):
+            A.pca(evtarget=evtarget)
+            self.assertEqual(A.npca, npca)
+            self.assertEqual(A.pca_ev(raw=True).size, npca)
+        self.assertEqual(A._npca, 40)
+
+    def test_pca_randomized(self):
+        A = Analyzer(setup_data1(nt=70, nx=150))
+        ref_ev = A.pca_ev()
+        ref_pc = A.pca_pc().copy()
+        A.pca(solver='randomized', rsvd_seed=0, force=True)
+        self.assertTrue(npy.allclose(A.pca_ev()[:4], ref_ev[:4]))
+        self.assertTrue(npy.allclose(A.pca_pc()[:3], ref_pc[:3], atol=1e-4))
+        self.assertEqual(A.pca_rec().shape, (70, 150))
+
+    def test_pca_warmstart(self):
+        data = setup_data1(nt=150, nx=70)
+        A = Analyzer(data, npca=4)
+        ref_ev = A.pca_ev()
+        ref_eof = A.pca_eof(raw=True).copy()
+        A.stacked_data = A.stacked_data*1.01
+        A.pca(force=True, warmstart=True, lanczos_seed=0)
+        self.assertTrue(npy.allclose(A.pca_ev(), ref_ev*1.01**2))
+        self.assertTrue(npy.allclose(A.pca_eof(raw=True), ref_eof))
+
+    def test_pca_partial_fit(self):
+        data = setup_data1(nt=120, nx=50)
+        A = Analyzer(data, npca=4)
+        B = Analyzer(data[:30], npca=4)
+        for it in xrange(0, 120, 50):
+            B.partial_fit(data[it:it+50])
+        self.assertTrue(npy.allclose(B.pca_ev(), A.pca_ev()))
+        self.assertTrue(npy.allclose(B.pca_eof(raw=True), A.pca_eof(raw=True)))
+        pc = npy.vstack([B.pca_ec(xdata=data[it:it+50], raw=True)
+            for it in xrange(0, 120, 50)])
+        self.assertTrue(npy.allclose(pc, A.pca_pc(raw=True)))
+        B.pca(evtarget=50.)
+        self.assertTrue(B.npca < 4)
+        B.pca(evtarget=0)
+        self.assertEqual(B.npca, 4)
+        self.assertEqual(B.pca_ev(raw=True).size, 4)
+
+    def test_pca_ooc(self):
+        data = setup_data1(nt=40, nx=150)
+        A = Analyzer(data, npca=4, useteof=1, norms=False)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            mdata = npy.memmap(os.path.join(tmpdir, 'data'), dtype='d',
+                mode='w+', shape=data.shape)
+            mdata[:] = data.filled(npy.nan)
+            meof = npy.memmap(os.path.join(tmpdir, 'eof'), dtype='d',
+                mode='w+', shape=(150, 4))
+            eof, pc, ev, ev_sum = ooc_pca(mdata, 4, chunksize=32, out=meof)
+            self.assertTrue(eof is meof)
+            self.assertTrue(npy.allclose(ev, A.pca_ev()))
+            self.assertTrue(npy.allclose(eof[npy.arange(150)!=1],
+                A.pca_eof(raw=True)))
+            self.assertTrue(npy.allclose(pc, A.pca_pc(raw=True)))
+            del mdata, meof, eof
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_pca_ec_methods(self):
+        A = Analyzer(setup_data1(nt=70, nx=150), npca=5)
+        pdata = A.stacked_data.copy()
+        pdata[:10, 5:30] = 1e20
+        pdata[20:25, 40:60] = 1e20
+        eof = npy.asfortranarray(A.pca_eof(raw=True))
+        ref = _core.pca_getec(npy.asfortranarray(pdata), eof, mv=1e20, method=1)
+        for method in 0, 2, 5: # invalid methods fall back to 2
+            ec = _core.pca_getec(npy.asfortranarray(pdata), eof, mv=1e20,
+                method=method)
+            self.assertTrue(npy.allclose(ec, ref))
+        self.assertTrue(npy.allclose(A.pca_ec(xdata=pdata, xraw=True, raw=True), ref))
+
     def test_pca_ndim3(self):
         A = Analyzer(setup_data2())
         A.pca()